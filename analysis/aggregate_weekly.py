@@ -8,9 +8,11 @@
 # --set specifies the measure set (appts_table (USE WITH SUBGROUPS), sro, resp)
 # --released uses already released data
 # --appt restricts measures to those with an appointment in interval
+# --partitioned reads processed measures partitioned by measure and year
 
 import pandas as pd
 from utils import *
+from rollup import *
 import pyarrow.feather as feather
 from parse_args import *
 import numpy as np
@@ -37,7 +39,7 @@ if config["group"] == "practice_subgroup":
     # Use sex subgroup for practice-level aggregation as its required in inclusion criteria
     input_path += "_sex" 
     
-practice_interval_df = read_write("read", input_path)
+practice_interval_df = read_measures(input_path)
 
 if config["group"] == "practice_subgroup":
     # Remove sex suffix from measure na,es
@@ -75,37 +77,11 @@ if config["test"]:
 
 # -------- Aggregate practice-weekly to practice-yearly ----------------------------------
 
-practice_interval_df['year'] = practice_interval_df['interval_start'].dt.year
-
-practice_yearly_df = build_aggregate_df(
-    practice_interval_df,
-    ["measure", "practice_pseudo_id", "year"],
-    {"numerator_midpoint6": ["sum"]},
-)
-
-# For list size we want the value from the earliest interval in the year
-list_size_df = (
-    practice_interval_df
-    .sort_values(by=["measure", "practice_pseudo_id", "year", "interval_start"])
-    .drop_duplicates(subset=["measure", "practice_pseudo_id", "year"], keep="first")
-    [["measure", "practice_pseudo_id", "year", "list_size_midpoint6"]]
-    .rename(columns={"list_size_midpoint6": "list_size_midpoint6_first"})
-)
-
-# Merge earliest list size into practice-yearly frame
-practice_yearly_df = practice_yearly_df.merge(
-    list_size_df, on=["measure", "practice_pseudo_id", "year"], how="left"
-)
-
-# Identify practices with zero counts for the year
-practice_yearly_df['zero_indicator'] = np.where(
-    practice_yearly_df['numerator_midpoint6_sum'] == 0, 1, 0
-)
-# Calculate rates = (number of cases / practice list size at start of yr) * 1000
-practice_yearly_df['rate_mp6'] = (
-    practice_yearly_df['numerator_midpoint6_sum'] /
-    practice_yearly_df['list_size_midpoint6_first']
-) * 1000
+# Sum numerators, take the list size from the earliest interval in the year, and flag
+# practices with zero counts for the year. Rates = (number of cases / practice list size
+# at start of yr) * 1000
+practice_yearly_df = rollup(RollupIndex(practice_interval_df), period="year", level="practice", denominator="first")
+practice_yearly_df = practice_yearly_df.rename(columns={"rate_per_1000": "rate_mp6"})
 print(practice_yearly_df.head())
 
 # Save practice yearly outputs
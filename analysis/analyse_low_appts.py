@@ -8,9 +8,11 @@
 # --set specifies the measure set (appts_table, sro, resp)
 # --released uses already released data
 # --appt restricts measures to those with an appointment in interval
+# --partitioned reads processed measures partitioned by measure and year
 
 import pandas as pd
 from utils import *
+from rollup import *
 import pyarrow.feather as feather
 from parse_args import *
 import numpy as np
@@ -38,22 +40,17 @@ for subgroup in config['subgroups']:
 
     # Load each subgroup dataframe into a dictionary
     input_path = f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}/proc_{config['group']}_measures_midpoint6_{subgroup}"
-    practice_interval_dict[subgroup] = read_write("read", input_path, file_type="arrow")
-
     # Only need seen_in_interval
-    practice_interval_dict[subgroup] = practice_interval_dict[subgroup][practice_interval_dict[subgroup]['measure'].str.contains('seen_in_interval')]
-    # Remove non-sex categories from the measure column
-    practice_interval_dict[subgroup]['measure'] = practice_interval_dict[subgroup]['measure'].cat.remove_unused_categories()
+    practice_interval_dict[subgroup] = read_measures(input_path, measure_pattern="seen_in_interval")
     # Aggregate weeks to years
-    practice_interval_dict[subgroup]["year"] = practice_interval_dict[subgroup]["interval_start"].dt.year
+    practice_interval_dict[subgroup] = practice_interval_dict[subgroup].wp.add("year")
 
 # ------------- Calculate ranks of practices -------------------------
 
 # Use sex as measure for practice-level aggregation as its required in inclusion criteria
 practice_interval_df = practice_interval_dict['sex']
-practice_agg_df = practice_interval_df.groupby(["practice_pseudo_id", "year"]).agg({"numerator_midpoint6": "sum", "list_size_midpoint6": "sum"}).reset_index()
-# Calculate rate per 1000
-practice_agg_df["rate_per_1000"] = (practice_agg_df["numerator_midpoint6"] / practice_agg_df["list_size_midpoint6"])*1000
+# Sum counts and list sizes over the weeks of each year, and calculate rate per 1000
+practice_agg_df = rollup(RollupIndex(practice_interval_df), period="year", level="practice", denominator="sum")
 # Calculate percentile position for each practice
 practice_agg_df["percentile"] = practice_agg_df.groupby("year")["rate_per_1000"].rank(pct=True)*100
 # Extract bottom 10% of practices for each measure
@@ -71,13 +68,38 @@ for subgroup in practice_interval_dict.keys():
         on=["practice_pseudo_id", "year"],
         how="left"
     )
-    # Select columns to aggregate
-    cols_to_agg = [subgroup, 'bottom_10pct', 'year']
+    # Both rollups of the subgroup share one index
+    subgroup_df = practice_interval_dict[subgroup]
+    subgroup_index = RollupIndex(subgroup_df)
     # Find total list size per year-bottom_10pct combo
-    total_list_size = practice_interval_dict[subgroup].groupby(["bottom_10pct", "year"])["list_size_midpoint6"].sum().reset_index().rename(columns={"list_size_midpoint6": "total_list_size"})
-    # Groupby low_appt identifier and aggregate list size sums
-    practice_interval_dict[subgroup] = practice_interval_dict[subgroup].groupby(cols_to_agg).agg({"list_size_midpoint6": "sum", "numerator_midpoint6": "sum"}).reset_index().rename(columns={"list_size_midpoint6": "list_size", "numerator_midpoint6": "numerator"})
-    practice_interval_dict[subgroup]["rate_per_1000_mp6"] = (practice_interval_dict[subgroup]["numerator"] / practice_interval_dict[subgroup]["list_size"])*1000
+    total_list_size = rollup(
+        subgroup_index, period="year", level="national", denominator="sum", by=["bottom_10pct"]
+    )[["bottom_10pct", "year", "list_size_midpoint6_sum"]].rename(columns={"list_size_midpoint6_sum": "total_list_size"})
+    # Aggregate list size sums by subgroup and low_appt identifier
+    cols_to_agg = [subgroup, "bottom_10pct", "year"]
+    practice_interval_dict[subgroup] = rollup(
+        subgroup_index, period="year", level="subgroup", denominator="sum", subgroup=subgroup, by=["bottom_10pct"]
+    ).rename(
+        columns={"list_size_midpoint6_sum": "list_size", "numerator_midpoint6_sum": "numerator", "rate_per_1000": "rate_per_1000_mp6"}
+    )[cols_to_agg + ["list_size", "numerator", "rate_per_1000_mp6"]]
+    # Keep unobserved categories of categorical subgroups with zero counts
+    if isinstance(subgroup_df[subgroup].dtype, pd.CategoricalDtype):
+        all_keys = pd.MultiIndex.from_product(
+            [
+                subgroup_df[subgroup].cat.categories,
+                np.sort(subgroup_df["bottom_10pct"].dropna().unique()),
+                np.sort(subgroup_df["year"].unique()),
+            ],
+            names=cols_to_agg,
+        )
+        practice_interval_dict[subgroup] = (
+            practice_interval_dict[subgroup]
+            .set_index(cols_to_agg)
+            .reindex(all_keys)
+            .fillna({"list_size": 0, "numerator": 0})
+            .astype({"list_size": np.int64, "numerator": np.int64})
+            .reset_index()
+        )
     # Merge total list size back in to calculate percentage of list size in each demographic group
     practice_interval_dict[subgroup] = practice_interval_dict[subgroup].merge(total_list_size, on=["bottom_10pct", "year"], how="left")
     practice_interval_dict[subgroup]["pct_list_size"] = round((practice_interval_dict[subgroup]["list_size"] / practice_interval_dict[subgroup]["total_list_size"])*100, 2)
@@ -0,0 +1,750 @@
+# This script benchmarks optimised pipeline functions against the implementations they replace.
+# It runs on simulated data, so it does not need access to real measures outputs.
+# USAGE: python analysis/benchmarks.py --practice_subgroup_measures
+# Options
+# --practice_measures/practice_subgroup_measures to choose which measures dtypes to simulate
+# --test runs each benchmark on a small simulated dataset
+# --benchmark runs a single benchmark (e.g. typed_read), default runs all
+
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+from scipy import stats
+from utils import *
+from rollup import *
+from parse_args import config
+
+# --------- Configuration ------------------------------------------------
+
+np.random.seed(42)  # For reproducibility of simulated data
+benchmark_dir = tempfile.mkdtemp()
+results = []
+
+# --------- Helper functions ------------------------------------------------
+
+
+def time_call(benchmark, method, func, *args, **kwargs):
+    """
+    Times a function call and records the result in the benchmark results.
+    Args:
+        benchmark (str): Name of the benchmark.
+        method (str): Name of the method being timed (e.g. 'original', 'optimised').
+        func (callable): Function to time.
+    Returns:
+        The return value of func.
+    """
+    start = time.perf_counter()
+    output = func(*args, **kwargs)
+    seconds = round(time.perf_counter() - start, 3)
+
+    # Size of the output if it is a dataframe
+    if isinstance(output, pd.DataFrame):
+        output_mb = round(output.memory_usage(deep=True).sum() / 1024**2, 2)
+    else:
+        output_mb = np.nan
+
+    print(f"{benchmark} - {method}: {seconds} s, output {output_mb} mb", flush=True)
+    log_memory_usage(label=f"{benchmark} - {method}")
+    results.append(
+        {"benchmark": benchmark, "method": method, "seconds": seconds, "output_mb": output_mb}
+    )
+    return output
+
+
+def simulate_measures(n_rows):
+    """
+    Simulates a raw measures file in the format written by generate-measures.
+    Args:
+        n_rows (int): Number of rows to generate.
+    Returns:
+        pd.DataFrame: Simulated measures with the configured dtypes.
+    """
+    df = simulate_dataframe(config["dtype_dict"], n_rows)
+    weeks = [date(2016, 6, 6) + timedelta(weeks=i) for i in range(52)]
+    df["interval_start"] = np.random.choice(np.array(weeks, dtype=object), size=n_rows)
+    df["practice_pseudo_id"] = np.random.randint(0, 6500, size=n_rows).astype(np.int16)
+    df["measure"] = pd.Categorical(
+        np.random.choice(config["measures_list"]["appts_table"], size=n_rows)
+    )
+    return df
+
+
+def simulate_practice_intervals(n_practices, n_years, n_measures):
+    """
+    Simulates processed practice-interval measures in the format used by normalization.
+    Args:
+        n_practices (int): Number of practices.
+        n_years (int): Number of years of weekly intervals.
+        n_measures (int): Number of measures.
+    Returns:
+        pd.DataFrame: One row per measure, practice and week.
+    """
+    n_weeks = 52 * n_years
+    n_rows = n_measures * n_practices * n_weeks
+    measures = [f"measure_{i}" for i in range(n_measures)]
+    weeks = pd.date_range("2016-06-06", periods=n_weeks, freq="7D")
+
+    df = pd.DataFrame(
+        {
+            "measure": pd.Categorical.from_codes(
+                np.repeat(np.arange(n_measures), n_practices * n_weeks), categories=measures
+            ),
+            "practice_pseudo_id": np.tile(
+                np.repeat(np.arange(n_practices, dtype=np.int16), n_weeks), n_measures
+            ),
+            "interval_start": np.tile(weeks.values, n_measures * n_practices),
+        }
+    )
+    df["pandemic"] = pd.cut(
+        df["interval_start"],
+        bins=pd.to_datetime(["2000-01-01", "2020-03-01", "2022-03-01", "2100-01-01"]),
+        labels=["pre", "during", "post"],
+    )
+    df["season"] = assign_season(df["interval_start"].dt.month)
+    df["summer_year"] = (df["interval_start"] - pd.DateOffset(months=5)).dt.year.astype(np.int16)
+    df["numerator_midpoint6"] = roundmid_any(np.random.poisson(20, size=n_rows))
+    df["list_size_midpoint6"] = roundmid_any(np.random.randint(1000, 20000, size=n_rows))
+    df["rate_per_1000_midpoint6_derived"] = (
+        df["numerator_midpoint6"] / df["list_size_midpoint6"] * 1000
+    )
+    return df
+
+
+def build_aggregate_df_groupby(rate_df, strata, aggregation_dict, initial_list_size=False):
+    """
+    Original pandas groupby implementation of build_aggregate_df, kept as a reference.
+    """
+    agg = (rate_df.groupby(strata, observed=True).agg(aggregation_dict)).reset_index()
+
+    if initial_list_size == True:
+        first_week_denominator = (
+            rate_df.sort_values("interval_start")
+            .groupby(strata, as_index=False)["denominator"]
+            .first()
+        )
+        agg = agg.merge(first_week_denominator, on=strata, how="left")
+        agg.rename(columns={"denominator": "list_size_initial"}, inplace=True)
+
+    new_columns = []
+    for col in agg.columns.values:
+        if isinstance(col, tuple):
+            parts = [str(part) for part in col if part is not None]
+            new_col = "_".join(parts).strip("_")
+        else:
+            new_col = str(col)
+        new_columns.append(new_col)
+    agg.columns = new_columns
+
+    return agg
+
+
+def peak_call(benchmark, method, func, *args, **kwargs):
+    """
+    Runs a function under tracemalloc and records the peak memory it allocated.
+    Args:
+        benchmark (str): Name of the benchmark.
+        method (str): Name of the method being measured.
+        func (callable): Function to run.
+    Returns:
+        The return value of func.
+    """
+    tracemalloc.start()
+    output = func(*args, **kwargs)
+    peak_mb = round(tracemalloc.get_traced_memory()[1] / 1024**2, 2)
+    tracemalloc.stop()
+
+    print(f"{benchmark} - {method}: peak {peak_mb} mb", flush=True)
+    log_memory_usage(label=f"{benchmark} - {method}")
+    results.append({"benchmark": benchmark, "method": method, "peak_mb": peak_mb})
+    return output
+
+
+def replace_ethnicity_original(df):
+    """
+    Original ethnicity recoding from replace_nums, kept as a reference.
+    """
+    df_ethnicity = df[df["measure"].str.contains("ethnicity", case=False, na=False)]
+    df_ethnicity["ethnicity"].replace("6", pd.NA, inplace=True)
+    df_ethnicity["ethnicity"] = df_ethnicity["ethnicity"].fillna(df_ethnicity["ethnicity_sus"])
+    df_ethnicity["ethnicity"] = df_ethnicity["ethnicity"].astype("category")
+    df_ethnicity["ethnicity"] = df_ethnicity["ethnicity"].cat.add_categories(
+        ["White", "Mixed", "South Asian", "Black", "Other", "Not stated"]
+    )
+    df_ethnicity["ethnicity"].replace(
+        {
+            "1": "White", "2": "Mixed", "3": "South Asian", "4": "Black", "5": "Other",
+            "A": "White", "B": "White", "C": "White",
+            "D": "Mixed", "E": "Mixed", "F": "Mixed", "G": "Mixed",
+            "H": "South Asian", "J": "South Asian", "K": "South Asian", "L": "South Asian",
+            "M": "Black", "N": "Black", "P": "Black",
+            "R": "Other", "S": "Other",
+            "Z": "Not stated",
+        },
+        inplace=True,
+    )
+    df_ethnicity["ethnicity"] = df_ethnicity["ethnicity"].fillna(df_ethnicity["ethnicity_sus"])
+    df = df.drop("ethnicity_sus", axis=1)
+    df_ethnicity = df_ethnicity.drop("ethnicity_sus", axis=1)
+
+    group_cols = [col for col in df_ethnicity.columns if col not in ["numerator", "list_size"]]
+    df_ethnicity = df_ethnicity.groupby(group_cols, as_index=False, observed=True, dropna=False)[
+        ["numerator", "list_size"]
+    ].sum()
+
+    df = df[~df["measure"].str.contains("ethnicity", case=False, na=False)]
+    return pd.concat([df, df_ethnicity], ignore_index=True)
+
+
+def replace_rur_urb_original(values):
+    """
+    Original rur_urb_class recoding from replace_nums, kept as a reference.
+    """
+    values = values.astype("string").astype("category")
+    values = values.cat.add_categories(["Urban", "Rural", "Unknown"])
+    values = values.fillna("Unknown")
+    return values.replace(
+        {
+            "1": "Urban", "2": "Urban", "3": "Urban", "4": "Urban",
+            "5": "Rural", "6": "Rural", "7": "Rural", "8": "Rural",
+        }
+    ).fillna("Unknown")
+
+
+def yearly_rollup_original(practice_interval_df):
+    """
+    Original practice-yearly aggregation in aggregate_weekly.py, kept for benchmarking.
+    """
+    practice_interval_df = practice_interval_df.wp.add("year")
+    practice_yearly_df = build_aggregate_df(
+        practice_interval_df, ["measure", "practice_pseudo_id", "year"], {"numerator_midpoint6": ["sum"]}
+    )
+    list_size_df = (
+        practice_interval_df
+        .sort_values(by=["measure", "practice_pseudo_id", "year", "interval_start"])
+        .drop_duplicates(subset=["measure", "practice_pseudo_id", "year"], keep="first")
+        [["measure", "practice_pseudo_id", "year", "list_size_midpoint6"]]
+        .rename(columns={"list_size_midpoint6": "list_size_midpoint6_first"})
+    )
+    practice_yearly_df = practice_yearly_df.merge(
+        list_size_df, on=["measure", "practice_pseudo_id", "year"], how="left"
+    )
+    practice_yearly_df["zero_indicator"] = np.where(practice_yearly_df["numerator_midpoint6_sum"] == 0, 1, 0)
+    practice_yearly_df["rate_mp6"] = (
+        practice_yearly_df["numerator_midpoint6_sum"] / practice_yearly_df["list_size_midpoint6_first"]
+    ) * 1000
+    return practice_yearly_df
+
+
+def merge_seasons_original(summer_df, non_summer_df, practice_level):
+    """
+    Original merge-based implementation of merge_seasons, kept as a reference.
+    """
+    merge_cols = ["measure", "summer_year", "pandemic"]
+    if practice_level:
+        merge_cols.append("practice_pseudo_id")
+    combined_seasons_df = non_summer_df.merge(
+        summer_df, on=merge_cols, how="left", suffixes=[None, "_prev_summr"]
+    )
+
+    first_summer_years = summer_df.groupby("measure", observed=False)["summer_year"].min().reset_index()
+    first_summer_df = summer_df.merge(first_summer_years, on=["measure", "summer_year"]).drop(
+        columns="summer_year"
+    )
+    merge_cols = ["measure", "pandemic"]
+    if practice_level:
+        merge_cols.append("practice_pseudo_id")
+    return combined_seasons_df.merge(
+        first_summer_df, on=merge_cols, how="left", suffixes=[None, "_first_summr"]
+    )
+
+
+# --------- Benchmarks ------------------------------------------------
+
+
+def table_one_original(df, variables):
+    """
+    Original freq_table.py counts: list sizes summed over a dense matrix of indicator variables
+    from pd.get_dummies, for each variable of each week.
+    """
+    tables = []
+    for week, week_df in df.groupby("interval_start"):
+        for var in variables:
+            table = pd.get_dummies(week_df[var]).multiply(week_df["list_size"], axis=0).sum().reset_index()
+            table.columns = ["level", "count"]
+            tables.append(table.assign(interval_start=week, variable=var))
+    return pd.concat(tables, ignore_index=True)[["interval_start", "variable", "level", "count"]]
+
+
+def benchmark_typed_read():
+    """
+    Compares the post-hoc astype read of a measures file with the schema-driven arrow read.
+    """
+    n_rows = 10_000 if config["test"] else 5_000_000
+    path = os.path.join(benchmark_dir, "typed_read")
+    feather.write_feather(simulate_measures(n_rows), path + ".arrow")
+
+    original = time_call(
+        "typed_read", "astype", read_write, "read", path,
+        dtype=config["dtype_dict"], test=False, schema_read=False,
+    )
+    optimised = time_call(
+        "typed_read", "schema", read_write, "read", path,
+        dtype=config["dtype_dict"], test=False, schema_read=True,
+    )
+    pd.testing.assert_frame_equal(original, optimised)
+
+
+def benchmark_aggregate():
+    """
+    Compares the pandas groupby aggregation with the factorised single-pass aggregation,
+    using the normalization aggregations at national scale (6500 practices, 10 years, 20 measures).
+    """
+    if config["test"]:
+        df = simulate_practice_intervals(n_practices=50, n_years=2, n_measures=3)
+    else:
+        df = simulate_practice_intervals(n_practices=6500, n_years=10, n_measures=20)
+    log_memory_usage(label=f"Simulated {len(df)} practice-interval rows")
+
+    aggregations = {
+        "interval_var": (
+            ["measure", "interval_start", "pandemic"],
+            {"rate_per_1000_midpoint6_derived": ["var", "median", "count"]},
+        ),
+        "practice_season": (
+            ["measure", "practice_pseudo_id", "season", "pandemic", "summer_year"],
+            {"numerator_midpoint6": ["sum"], "list_size_midpoint6": ["sum", "count"]},
+        ),
+    }
+    group_codes = {}
+    for name, (strata, aggregation_dict) in aggregations.items():
+        original = time_call(
+            f"aggregate_{name}", "groupby", build_aggregate_df_groupby,
+            df, strata, aggregation_dict,
+        )
+        optimised = time_call(
+            f"aggregate_{name}", "factorised", build_aggregate_df,
+            df, strata, aggregation_dict, cache=group_codes,
+        )
+        pd.testing.assert_frame_equal(original, optimised, check_exact=False)
+
+
+def benchmark_poisson_test():
+    """
+    Compares per-row Poisson rate tests with the batched conditional binomial test_difference.
+    The per-row E-test is the approach previously used, and per-row scipy binomtest checks
+    the batched p-values.
+    """
+    n_rows = 200 if config["test"] else 5_000
+    count = roundmid_any(np.random.poisson(300, size=n_rows))
+    baseline_count = roundmid_any(np.random.poisson(250, size=n_rows))
+    exposure = roundmid_any(np.random.randint(10_000, 100_000, size=n_rows))
+    baseline_exposure = roundmid_any(np.random.randint(10_000, 100_000, size=n_rows))
+    rows = list(zip(count, exposure, baseline_count, baseline_exposure))
+
+    def etest_per_row():
+        return np.array(
+            [stats.poisson_means_test(int(k1), n1, int(k2), n2).pvalue for k1, n1, k2, n2 in rows]
+        )
+
+    def binomtest_per_row():
+        pvalues = []
+        for k1, n1, k2, n2 in rows:
+            n, p = int(k1 + k2), n1 / (n1 + n2)
+            less = stats.binomtest(int(k1), n, p, alternative="less").pvalue
+            greater = stats.binomtest(int(k1), n, p, alternative="greater").pvalue
+            pvalues.append(min(1, 2 * min(less, greater)))
+        return np.array(pvalues)
+
+    time_call("poisson_test", "etest_per_row", etest_per_row)
+    expected = time_call("poisson_test", "binomtest_per_row", binomtest_per_row)
+    batched = time_call(
+        "poisson_test", "batched", test_difference,
+        count, exposure, baseline_count, baseline_exposure,
+    )
+    np.testing.assert_allclose(batched, expected, rtol=1e-6)
+
+
+def benchmark_ethnicity_recode():
+    """
+    Compares the peak memory of the original ethnicity recoding in replace_nums with the
+    categorical code remapping in recode_ethnicity, and checks the outputs match.
+    """
+    n_rows = 20_000 if config["test"] else 5_000_000
+    measures = ["seen_in_interval_ethnicity", "start_in_interval_ethnicity", "seen_in_interval_age"]
+    weeks = pd.date_range("2023-05-08", periods=52, freq="7D")
+    df = pd.DataFrame(
+        {
+            "measure": pd.Categorical(np.random.choice(measures, size=n_rows)),
+            "interval_start": np.random.choice(weeks.values, size=n_rows),
+            "practice_pseudo_id": np.random.randint(0, 500, size=n_rows),
+            "ethnicity": pd.Series(
+                np.random.choice(["1", "2", "3", "4", "5", "6", "9", None], size=n_rows),
+                dtype="string",
+            ),
+            "ethnicity_sus": pd.Series(
+                np.random.choice(["A", "D", "H", "M", "R", "Z", "99", None], size=n_rows),
+                dtype="string",
+            ),
+            "numerator": np.random.randint(0, 100, size=n_rows),
+            "list_size": np.random.randint(0, 1000, size=n_rows),
+        }
+    )
+
+    original = peak_call("ethnicity_recode", "replace", replace_ethnicity_original, df)
+    optimised = peak_call("ethnicity_recode", "code_remap", recode_ethnicity, df)
+    pd.testing.assert_frame_equal(original, optimised)
+
+    # Regression check: the code remapping must not use more memory than the original
+    peaks = pd.DataFrame(results).query("benchmark == 'ethnicity_recode'")
+    assert peaks["peak_mb"].iloc[-1] <= peaks["peak_mb"].iloc[-2], "Ethnicity recoding peak memory regressed"
+
+
+def benchmark_rur_urb_recode():
+    """
+    Compares the string round-trip recoding of rur_urb_class with the integer lookup in
+    recode_rur_urb, and checks the outputs are identical.
+    """
+    n_rows = 20_000 if config["test"] else 20_000_000
+    values = pd.Series(
+        pd.arrays.IntegerArray(
+            np.random.randint(1, 9, size=n_rows).astype(np.int8), np.random.rand(n_rows) < 0.05
+        )
+    )
+
+    original = time_call("rur_urb_recode", "string_replace", replace_rur_urb_original, values)
+    optimised = time_call(
+        "rur_urb_recode", "code_lookup", lambda values: pd.Series(recode_rur_urb(values)), values
+    )
+    pd.testing.assert_series_equal(original, optimised)
+
+
+def benchmark_roundmid():
+    """
+    Compares the float midpoint rounding in roundmid_any with the integer kernel in
+    roundmid_int. The two are checked against each other in the pre_processing test action.
+    """
+    n_rows = 20_000 if config["test"] else 50_000_000
+    counts = np.random.randint(0, 5000, size=n_rows)
+
+    original = peak_call("roundmid", "float_roundmid_any", roundmid_any, counts)
+    optimised = peak_call(
+        "roundmid", "int_in_place", lambda counts: roundmid_int(counts, out=counts), counts.copy()
+    )
+    np.testing.assert_array_equal(original, optimised)
+    time_call("roundmid", "float_roundmid_any", roundmid_any, counts)
+    time_call("roundmid", "int_in_place", lambda counts: roundmid_int(counts, out=counts), counts.copy())
+
+
+def benchmark_dtype_policy():
+    """
+    Compares the file and in-memory size of processed measures in the original layout, with
+    the dtype policy from compact_dtypes, and with derived columns left to the wp accessor.
+    Checks that each layout holds the same values.
+    """
+    n_practices = 100 if config["test"] else 6500
+    df = simulate_practice_intervals(n_practices, n_years=2, n_measures=5)
+    df = df[["measure", "practice_pseudo_id", "interval_start"]]
+    df["numerator_midpoint6"] = roundmid_int(np.random.poisson(20, size=len(df)))
+    df["list_size_midpoint6"] = roundmid_int(np.random.randint(1000, 20000, size=len(df)))
+
+    # Original layout: default integer types, derived columns stored and pandemic as strings
+    original = df.copy()
+    original["month"] = original["interval_start"].dt.month
+    original["summer_year"] = np.where(
+        original["month"] <= 5,
+        original["interval_start"].dt.year - 1,
+        original["interval_start"].dt.year,
+    )
+    original["rate_per_1000_midpoint6_derived"] = (
+        original["numerator_midpoint6"] / original["list_size_midpoint6"] * 1000
+    )
+    original["pandemic"] = np.asarray(assign_pandemic(original["interval_start"]), dtype=object)
+
+    compact = compact_dtypes(df.copy().wp.add("month", "summer_year", "rate", "pandemic"))
+    derived_on_access = compact_dtypes(df.copy())
+
+    layouts = {"original": original, "compact": compact, "derived_on_access": derived_on_access}
+    for method, layout in layouts.items():
+        path = os.path.join(benchmark_dir, f"dtype_policy_{method}.arrow")
+        feather.write_feather(layout, path)
+        file_mb = round(path_size_mb(path), 2)
+        output_mb = round(layout.memory_usage(deep=True).sum() / 1024**2, 2)
+        print(f"dtype_policy - {method}: file {file_mb} mb, in memory {output_mb} mb", flush=True)
+        results.append(
+            {"benchmark": "dtype_policy", "method": method, "output_mb": output_mb, "file_mb": file_mb}
+        )
+
+    pd.testing.assert_frame_equal(
+        original, compact.astype({"pandemic": object}), check_dtype=False
+    )
+    derived = feather.read_feather(os.path.join(benchmark_dir, "dtype_policy_derived_on_access.arrow"))
+    derived = derived.wp.add("month", "summer_year", "rate", "pandemic")
+    pd.testing.assert_frame_equal(derived, compact)
+
+
+def benchmark_merge_seasons():
+    """
+    Compares the two left merges of the original merge_seasons with the baseline index in
+    merge_seasons, at practice level, and checks the outputs are identical, including when
+    some baselines are missing.
+    """
+    n_practices = 100 if config["test"] else 6500
+    df = simulate_practice_intervals(n_practices, n_years=4, n_measures=5)
+    practice_season_df = df.groupby(
+        ["measure", "practice_pseudo_id", "season", "summer_year", "pandemic"], observed=True
+    ).agg({"numerator_midpoint6": "sum", "list_size_midpoint6": "sum"}).reset_index()
+    practice_season_df["Rate_per_1000"] = (
+        practice_season_df["numerator_midpoint6"] / practice_season_df["list_size_midpoint6"] * 1000
+    )
+    summer_df = practice_season_df[practice_season_df["season"] == "Jun-Jul"]
+    non_summer_df = practice_season_df[practice_season_df["season"] != "Jun-Jul"]
+
+    # Property check: drop random summer rows so some practices have no previous or first summer
+    for fraction in [0, 0.1, 0.5, 1]:
+        sample_summer_df = summer_df.sample(frac=1 - fraction, random_state=1).sort_index()
+        for practice_level in [True, False]:
+            level_cols = None if practice_level else ["measure", "season", "summer_year", "pandemic"]
+            level_summer_df, level_non_summer_df = [
+                frame if practice_level else frame.drop_duplicates(level_cols)
+                for frame in [sample_summer_df, non_summer_df]
+            ]
+            pd.testing.assert_frame_equal(
+                merge_seasons_original(level_summer_df, level_non_summer_df, practice_level),
+                merge_seasons(level_summer_df, level_non_summer_df, practice_level),
+            )
+
+    original = peak_call("merge_seasons", "merge", merge_seasons_original, summer_df, non_summer_df, True)
+    optimised = peak_call("merge_seasons", "baseline_index", merge_seasons, summer_df, non_summer_df, True)
+    pd.testing.assert_frame_equal(original, optimised)
+    time_call("merge_seasons", "merge", merge_seasons_original, summer_df, non_summer_df, True)
+    time_call("merge_seasons", "baseline_index", merge_seasons, summer_df, non_summer_df, True)
+
+
+def benchmark_join_mask():
+    """
+    Compares removing practice seasons with a zero summer baseline by a left merge with an
+    indicator against the anti-join mask from join_mask, and checks they keep the same rows.
+    """
+    n_practices = 100 if config["test"] else 6500
+    df = simulate_practice_intervals(n_practices, n_years=4, n_measures=5)
+    keys = ["measure", "summer_year", "practice_pseudo_id"]
+    practice_season_df = df.groupby(
+        keys + ["season", "pandemic"], observed=True
+    ).agg({"numerator_midpoint6": "sum", "list_size_midpoint6": "sum"}).reset_index()
+
+    def merge_indicator(df, keys_df):
+        merged = df.merge(keys_df[keys], on=keys, how="left", indicator=True)
+        return merged[merged["_merge"] == "left_only"].drop(columns="_merge")
+
+    def anti_join(df, keys_df):
+        return df[join_mask(df, keys_df, keys, how="anti")]
+
+    # Property check: random key subsets, with duplicated keys, for semi and anti joins
+    for fraction in [0, 0.01, 0.5, 1]:
+        keys_df = practice_season_df.sample(frac=fraction, random_state=1)
+        keys_df = pd.concat([keys_df, keys_df.head(10)])
+        semi = join_mask(practice_season_df, keys_df, keys)
+        expected = practice_season_df.set_index(keys).index.isin(keys_df.set_index(keys).index)
+        np.testing.assert_array_equal(semi, expected)
+        np.testing.assert_array_equal(join_mask(practice_season_df, keys_df, keys, how="anti"), ~expected)
+        pd.testing.assert_frame_equal(
+            merge_indicator(practice_season_df, keys_df).reset_index(drop=True),
+            anti_join(practice_season_df, keys_df).reset_index(drop=True),
+        )
+
+    # Practices with a low summer count stand in for zero counts in the simulated data
+    summer_df = practice_season_df[practice_season_df["season"] == "Jun-Jul"]
+    keys_df = summer_df[summer_df["numerator_midpoint6"] < summer_df["numerator_midpoint6"].quantile(0.1)]
+    peak_call("join_mask", "merge_indicator", merge_indicator, practice_season_df, keys_df)
+    peak_call("join_mask", "anti_join_mask", anti_join, practice_season_df, keys_df)
+    time_call("join_mask", "merge_indicator", merge_indicator, practice_season_df, keys_df)
+    time_call("join_mask", "anti_join_mask", anti_join, practice_season_df, keys_df)
+
+
+def benchmark_streaming_variance():
+    """
+    Compares the between-practice variance per interval computed on the whole frame with
+    moments accumulated over the record batches of an arrow file, and checks that merged
+    moments match the variance of all rows for random splits.
+    """
+    strata = ["measure", "interval_start", "pandemic"]
+    col = "rate_per_1000_midpoint6_derived"
+
+    # Property check: split rows into random batches, including groups with missing values
+    # and single rows, and merge the batch moments in one step or in a tree of merges
+    df = simulate_practice_intervals(20, n_years=2, n_measures=3)
+    df.loc[np.random.rand(len(df)) < 0.05, col] = np.nan
+    df = df.drop(np.random.choice(df.index, size=len(df) // 2, replace=False))
+    expected = df.groupby(strata, observed=True)[col].agg(["count", "var"]).reset_index()
+    for n_batches in [1, 2, 7, 50]:
+        batch_ids = np.random.randint(0, n_batches, size=len(df))
+        parts = [group_moments(df[batch_ids == i], strata, col) for i in range(n_batches)]
+        merges = [merge_moments(parts, strata, col)]
+        if n_batches > 1:
+            halves = [merge_moments(parts[::2], strata, col), merge_moments(parts[1::2], strata, col)]
+            merges.append(merge_moments(halves, strata, col))
+        for merged in merges:
+            np.testing.assert_array_equal(merged[f"{col}_count"], expected["count"])
+            np.testing.assert_allclose(moments_var(merged, col), expected["var"], rtol=1e-9)
+
+    n_practices = 100 if config["test"] else 6500
+    df = simulate_practice_intervals(n_practices, n_years=4, n_measures=2)
+    path = os.path.join(benchmark_dir, "streaming_variance")
+    feather.write_feather(df, f"{path}.arrow", chunksize=64_000)
+
+    def in_memory():
+        df = feather.read_feather(f"{path}.arrow")
+        return df.groupby(strata, observed=True)[col].var().to_numpy()
+
+    def streamed():
+        parts = [
+            group_moments(batch_df, strata, col)
+            for batch_df in iter_measures(path, partitioned=False, test=False)
+        ]
+        return moments_var(merge_moments(parts, strata, col), col)
+
+    original = peak_call("streaming_variance", "in_memory", in_memory)
+    optimised = peak_call("streaming_variance", "record_batches", streamed)
+    np.testing.assert_allclose(original, optimised, rtol=1e-9)
+    time_call("streaming_variance", "in_memory", in_memory)
+    time_call("streaming_variance", "record_batches", streamed)
+
+
+def benchmark_quantiles():
+    """
+    Compares pandas groupby deciles with group_quantiles, and with quantile sketches merged
+    over batches of rows. Checks exact deciles match pandas and sketch deciles stay within
+    their reported rank error bounds.
+    """
+    n_practices = 100 if config["test"] else 6500
+    df = simulate_practice_intervals(n_practices, n_years=4, n_measures=5)
+    df.loc[np.random.rand(len(df)) < 0.01, "rate_per_1000_midpoint6_derived"] = np.nan
+    strata = ["measure", "pandemic"]
+    col = "rate_per_1000_midpoint6_derived"
+    deciles = [i / 10 for i in range(1, 10)]
+
+    def pandas_deciles(df):
+        return df.groupby(strata, observed=True)[col].quantile(deciles).unstack().to_numpy()
+
+    def exact_deciles(df):
+        codes, n_groups, _ = factorize_groups(df, strata)
+        return group_quantiles(df[col], codes, n_groups, deciles)
+
+    def sketch_deciles(df):
+        sketches = [quantile_sketch(batch, strata, col) for batch in np.array_split(df, 20)]
+        return sketch_quantiles(merge_sketches(sketches, strata, col), strata, col, deciles)
+
+    original = time_call("quantiles", "pandas_quantile", pandas_deciles, df)
+    exact = time_call("quantiles", "group_quantiles", exact_deciles, df)
+    np.testing.assert_allclose(original, exact, rtol=1e-12)
+    sketched = time_call("quantiles", "merged_sketches", sketch_deciles, df)
+
+    # Rank of each sketch decile among the exact values, against the reported error bound
+    for i, (_, group) in enumerate(df.dropna(subset=[col]).groupby(strata, observed=True)):
+        values = np.sort(group[col].to_numpy())
+        for j, decile in enumerate(deciles):
+            estimate = sketched[f"{col}_q{round(decile * 100)}"].iloc[i]
+            rank_error = abs(np.searchsorted(values, estimate) / len(values) - decile)
+            bound = sketched[f"{col}_rank_error"].iloc[i] + 1 / len(values)
+            assert rank_error <= bound, f"Sketch decile rank error {rank_error} exceeds bound {bound}"
+    print(f"quantiles - merged_sketches: rank error bound {sketched[f'{col}_rank_error'].max():.4f}", flush=True)
+
+
+def benchmark_rollup():
+    """
+    Compares the sort, drop_duplicates and merge of the original practice-yearly aggregation
+    with rollup, on rows in time order and on shuffled rows. Also checks every period, level
+    and denominator policy against a pandas groupby, with one index shared by all rollups.
+    """
+    n_practices = 100 if config["test"] else 6500
+    df = simulate_practice_intervals(n_practices, n_years=4, n_measures=5)
+    df = df[["measure", "practice_pseudo_id", "interval_start", "numerator_midpoint6", "list_size_midpoint6"]]
+    df.loc[np.random.rand(len(df)) < 0.05, "numerator_midpoint6"] = 0
+    df["region"] = pd.Categorical.from_codes(df["practice_pseudo_id"] % 7, categories=[f"region_{i}" for i in range(7)])
+
+    def fused_rollup(df):
+        rollup_df = rollup(RollupIndex(df), period="year", level="practice", denominator="first")
+        return rollup_df.drop(columns=["rate_per_1000"]).assign(rate_mp6=rollup_df["rate_per_1000"])
+
+    for label, frame in [("ordered", df), ("shuffled", df.sample(frac=1, random_state=1))]:
+        original = time_call("rollup", f"sort_merge_{label}", yearly_rollup_original, frame.drop(columns="region"))
+        optimised = time_call("rollup", f"fused_{label}", fused_rollup, frame.drop(columns="region"))
+        pd.testing.assert_frame_equal(original, optimised)
+
+    # Property check: practice rollups match a groupby of the rows sorted by interval_start,
+    # and higher levels match a groupby of the practice rollup
+    shuffled = df.sample(frac=1, random_state=2)
+    index = RollupIndex(shuffled)
+    level_keys = {"practice": ["measure", "practice_pseudo_id"], "region": ["measure", "region"], "national": ["measure"]}
+    for period in periods:
+        period_df = shuffled.assign(**period_columns(shuffled, period)).sort_values("interval_start", kind="stable")
+        practice_strata = level_keys["practice"] + periods[period]
+        expected_practice = period_df.groupby(practice_strata, observed=True).agg(
+            numerator_midpoint6_sum=("numerator_midpoint6", "sum"),
+            list_size_midpoint6_sum=("list_size_midpoint6", "sum"),
+            list_size_midpoint6_first=("list_size_midpoint6", "first"),
+            list_size_midpoint6_count=("list_size_midpoint6", "count"),
+            region=("region", "first"),
+        )
+        for level, keys in level_keys.items():
+            rolled = rollup(index, period=period, level=level, denominator=["sum", "first", "count"])
+            expected = expected_practice.reset_index().groupby(keys + periods[period], observed=True).sum(numeric_only=True)
+            for col in ["numerator_midpoint6_sum", "list_size_midpoint6_sum", "list_size_midpoint6_first", "list_size_midpoint6_count"]:
+                np.testing.assert_array_equal(rolled[col].to_numpy(), expected[col].to_numpy())
+
+
+def benchmark_table_one():
+    """
+    Compares the table one counts of freq_table.py from pd.get_dummies indicator matrices with
+    weighted_counts for every variable and week, and checks they give the same counts.
+    """
+    n_rows = 100_000 if config["test"] else 1_000_000
+    df = simulate_measures(n_rows).rename(columns={"denominator": "list_size"})
+    df = df[df["interval_start"] < date(2016, 6, 6) + timedelta(weeks=10)]
+    # freq_table.py also counts practices, limit them so the indicator matrices fit in memory
+    df["practice_pseudo_id"] = df["practice_pseudo_id"] % 200
+    excluded_cols = ["numerator", "list_size", "measure", "interval_start", "interval_end", "ratio"]
+    variables = [col for col in df.columns if col not in excluded_cols]
+
+    original = peak_call("table_one", "get_dummies", table_one_original, df, variables)
+    optimised = peak_call("table_one", "weighted_counts", weighted_counts, df, variables, "list_size", ["interval_start"])
+    # get_dummies gives nullable counts for nullable variables
+    as_compared = {"interval_start": str, "level": str, "count": np.int64}
+    pd.testing.assert_frame_equal(original.astype(as_compared), optimised.astype(as_compared))
+    time_call("table_one", "get_dummies", table_one_original, df, variables)
+    time_call("table_one", "weighted_counts", weighted_counts, df, variables, "list_size", ["interval_start"])
+
+
+benchmarks = {
+    "typed_read": benchmark_typed_read,
+    "aggregate": benchmark_aggregate,
+    "poisson_test": benchmark_poisson_test,
+    "ethnicity_recode": benchmark_ethnicity_recode,
+    "rur_urb_recode": benchmark_rur_urb_recode,
+    "roundmid": benchmark_roundmid,
+    "dtype_policy": benchmark_dtype_policy,
+    "merge_seasons": benchmark_merge_seasons,
+    "join_mask": benchmark_join_mask,
+    "streaming_variance": benchmark_streaming_variance,
+    "quantiles": benchmark_quantiles,
+    "rollup": benchmark_rollup,
+    "table_one": benchmark_table_one,
+}
+
+# --------- Run benchmarks ------------------------------------------------
+
+if config["benchmark"] is not None:
+    benchmarks = {config["benchmark"]: benchmarks[config["benchmark"]]}
+
+for name, benchmark in benchmarks.items():
+    print(f"Running benchmark: {name}", flush=True)
+    benchmark()
+
+print(pd.DataFrame(results).to_string(index=False))
@@ -25,7 +25,15 @@ non_appts_table_measures <- FALSE # Set to TRUE to process non-appts table measu
 
 # ------------ Generate decile tables ----------------------------------------------------
 
-if (config$released == FALSE){
+# Deciles written by normalization.py, used instead of the practice-level data when available
+deciles_path <- glue("output/{config$group}_measures_{config$set}{config$appt_suffix}{config$agg_suffix}/deciles_rate_mp6")
+python_deciles <- file.exists(paste0(deciles_path, config$test_suffix, ".csv")) & !config$yearly
+
+if (config$released == FALSE & python_deciles) {
+
+  practice_deciles <- read_write("read", deciles_path, file_type = "csv")
+
+} else if (config$released == FALSE){
 
   # Determine file paths
   input_path <- glue("output/{config$group}_measures_{config$set}{config$appt_suffix}{config$agg_suffix}/proc_{config$group}_measures_midpoint6")
@@ -79,6 +87,9 @@ if (config$released == FALSE){
     ) %>%
     ungroup() %>%
     pivot_longer(cols = starts_with("d"), names_to = "decile", values_to = "rate_per_1000")
+}
+
+if (config$released == FALSE) {
 
   # Save tables, generating a separate file for each measure
   for (measure in unique(practice_deciles$measure)) {
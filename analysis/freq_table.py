@@ -5,6 +5,7 @@
 # --released uses already released data
 # --appt restricts measures to those with an appointment in interval
 # --weekly_agg aggregates weekly intervals to yearly
+# Writes the list size of each level of every variable in the first week of each year
 
 import pandas as pd
 from utils import *
@@ -12,32 +13,36 @@ import pyarrow.feather as feather
 from parse_args import *
 import numpy as np
 
+dates = generate_annual_dates(config["study_end_date"], config["n_years"])
 if config["test"]:
-    year = "2016"
-else:
-    year = "2020"
+    # For testing, use only one date
+    dates = [config["test_config"]["start_date"]]
 
-dates = generate_annual_dates(config["study_end_date"], config["n_years"])
-date = [date for date in dates if date.startswith(year)][0]
+measures_dir = f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}"
+output_path = f"{measures_dir}/freq_table_{config['group']}"
 
-# Load and format data for each interval
-print(f"Loading {config['group']} measures {date}", flush=True)
-input_path = f"output/{config['group']}_measures_{config['set']}/{config['group']}_measures_{date}"
-output_path = f"output/{config['group']}_measures_{config['set']}/freq_table_{config['group']}"
+# Load the first week of each year
+patient_dfs = []
+for date in dates:
+    print(f"Loading {config['group']} measures {date}", flush=True)
+    patient_df = read_write(
+        read_or_write="read",
+        path=f"{measures_dir}/{config['group']}_measures_{date}",
+        dtype=config["dtype_dict"],
+        true_values=["T"],
+        false_values=["F"],
+    )
 
-patient_df = read_write(
-    read_or_write="read",
-    path=input_path,
-    dtype=config["dtype_dict"],
-    true_values=["T"],
-    false_values=["F"],
-)
+    # Extract first week of data
+    patient_df = patient_df[
+        (patient_df["interval_start"].astype(str) == date)
+        & (patient_df["measure"] == "seen_in_interval")
+    ]
+    patient_dfs.append(patient_df)
+    log_memory_usage(label=f"After loading {config['group']} measures {date}")
 
-# Extract first week of data
-patient_df = patient_df[
-    (patient_df["interval_start"].astype(str) == date)
-    & (patient_df["measure"] == "seen_in_interval")
-]
+patient_df = concat_categorical(patient_dfs)
+del patient_dfs
 patient_df.rename(columns={"denominator": "list_size"}, inplace=True)
 
 if config["test"]:
@@ -60,43 +65,23 @@ excluded_cols = [
     "ratio",
 ]
 table_one_vars = [col for col in patient_df.columns if col not in excluded_cols]
-table_one = {}
-# Iterate over all the demographic variables we want in table one
-for var in table_one_vars:
-    # Create an binary matrix composed of indicator variables representing the categorical value for each group (e.g. cols ethnicity_black: 0, ethnicity_white: 1)
-    # Multiply this matrix by the vector of list_sizes representing the size of the given group
-    # Sum to get the total denominator value from all the groups (Sum(Categories x list_size))
-    # e.g. (e.g. cols ethnicity_black: 0, ethnicity_white: 1, list_size: 500) -> 1 X 500 -> level: white, count: 500
-    table_one[var] = (
-        pd.get_dummies(patient_df[var])
-        .multiply(patient_df["list_size"], axis=0)
-        .sum()
-        .reset_index()
-    )
-    table_one[var].columns = ["level", "count"]
-    table_one[var]["prop"] = table_one[var]["count"] / table_one[var]["count"].sum()
-
-# Initialize an empty list to hold formatted DataFrames
-formatted_list = []
-
-# Loop over each item in the dictionary
-for key, df in table_one.items():
-    # Add a column for the category (e.g., age, sex, ethnicity)
-    df["Category"] = key
-    # Append the DataFrame to the list
-    formatted_list.append(df[["Category", "level", "count", "prop"]])
 
-# Concatenate all DataFrames into one
-result_df = pd.concat(formatted_list, axis=0, ignore_index=True)
-result_df["prop"] = (result_df["prop"]) * 100
+# Sum the list sizes of each level of every demographic variable in each year's first week,
+# e.g. ethnicity: white, list_size: 500 -> interval_start: 2020-04-06, level: white, count: 500
+result_df = weighted_counts(patient_df, table_one_vars, weight="list_size", by=["interval_start"])
+result_df = result_df.rename(columns={"variable": "Category"})
+result_df["prop"] = (
+    result_df["count"] / result_df.groupby(["interval_start", "Category"], sort=False)["count"].transform("sum")
+) * 100
 
 # Add total row for each category
 total_row = (
-    result_df.groupby("Category").agg({"count": "sum", "prop": "sum"}).reset_index()
+    result_df.groupby(["interval_start", "Category"]).agg({"count": "sum", "prop": "sum"}).reset_index()
 )
-# Merge total row with the original DataFrame
+# Merge total row with the original DataFrame, keeping the rows of each year together
 result_df = pd.concat([result_df, total_row.assign(level="Total")], ignore_index=True)
-result_df = result_df.round(3)
+result_df = result_df.sort_values("interval_start", kind="stable", ignore_index=True)
+result_df = result_df[["interval_start", "Category", "level", "count", "prop"]].round(3)
 
 # Save processed file
 result_df.to_csv(output_path + ".csv", index=False)
@@ -194,6 +194,7 @@ yaml_processing_template = """
     outputs:
       highly_sensitive:
         measures: output/{group}_measures_{set}{appt_suffix}{agg_suffix}/proc_{group}_measures_midpoint6*{test_suffix}.arrow
+        cube: output/{group}_measures_{set}{appt_suffix}{agg_suffix}/cube_{group}_measures*{test_suffix}.arrow
   generate_normalization_{group}_{set}{appt_suffix}{test_suffix}:
     run: python:v2 analysis/normalization.py --{group}_measures --set {set}{appt_flag}{test_flag}
     needs: [generate_pre_processing_{group}_{set}{appt_suffix}{test_suffix}]
@@ -201,9 +202,13 @@ yaml_processing_template = """
       highly_sensitive:
         practice_level_tables: output/{group}_measures_{set}{appt_suffix}{agg_suffix}/practice_level_counts{test_suffix}.arrow
       moderately_sensitive:
-        seasonal_tables_tables: output/{group}_measures_{set}{appt_suffix}{agg_suffix}/Results*{test_suffix}.csv
+        seasonal_tables_tables: output/{group}_measures_{set}{appt_suffix}{agg_suffix}/Results*{test_suffix}.csv{deciles_output}
 """
 
+# Normalization of practice measures also writes the deciles used by decile_charts.r
+deciles_output_template = """
+        deciles_table: output/{group}_measures_{set}{appt_suffix}{agg_suffix}/deciles_rate_mp6{test_suffix}.csv"""
+
 yaml_processing = ""
 yaml_processing_test = ""
 for group in groups:
@@ -219,6 +224,9 @@ for group in groups:
                 appt_suffix=appt_suffix,
                 appt_flag=appt_flag,
                 agg_suffix="",
+                deciles_output=deciles_output_template.format(
+                    group=group, set=set, appt_suffix=appt_suffix, agg_suffix="", test_suffix=""
+                ) if group == "practice" else "",
             )
 
 for group in groups:
@@ -234,6 +242,9 @@ for group in groups:
                 appt_suffix=appt_suffix,
                 appt_flag=appt_flag,
                 agg_suffix="",
+                deciles_output=deciles_output_template.format(
+                    group=group, set=set, appt_suffix=appt_suffix, agg_suffix="", test_suffix="_test"
+                ) if group == "practice" else "",
             )
 
 yaml_viz = " \n # --------------- VISUALIZATION ACTIONS ------------------------------------------"
@@ -243,7 +254,7 @@ yaml_viz_template = """
   generate_deciles_charts_{set}{appt_suffix}{test_suffix}:
     run: >
       r:v2 analysis/decile_charts.r {test_flag} --set {set}{appt_flag}
-    needs: [generate_pre_processing_practice_{set}{appt_suffix}{test_suffix}] 
+    needs: [generate_normalization_practice_{set}{appt_suffix}{test_suffix}] 
     outputs:
       moderately_sensitive:
         deciles_charts: output/{group}_measures_{set}{appt_suffix}{agg_suffix}/plots{test_suffix}/decile_chart_*_rate_mp6.png
@@ -308,7 +319,7 @@ yaml_sense_check_template = """
 
   generate_sense_check_{set}{appt_suffix}:
     run: python:v2 analysis/sense_check.py --test --practice_measures --set {set}{appt_flag}
-    needs: [generate_practice_measures_{set}{appt_suffix}_test]
+    needs: [generate_pre_processing_practice_{set}{appt_suffix}_test]
     outputs:
       moderately_sensitive:
         totals: output/{group}_measures_{set}{appt_suffix}{agg_suffix}/sense_check*.csv
@@ -353,10 +364,24 @@ yaml_other = """
   # Generate national weekly aggregates for a measure, for sense checking with other work packages.
   generate_national_weekly:
     run: python:v2 analysis/national_weekly.py
-    needs: [generate_practice_measures_resp_2023-04-03]
+    needs: [generate_pre_processing_practice_resp]
     outputs:
       moderately_sensitive:
         national_weekly_aggregates: output/practice_measures_resp/national_weekly*.csv
+
+  # Generate national weekly and yearly series for every measure and year of a measure set
+  generate_national_weekly_batch:
+    run: python:v2 analysis/national_weekly.py --batch --set resp
+    needs: [generate_pre_processing_practice_resp]
+    outputs:
+      moderately_sensitive:
+        national_series: output/practice_measures_resp/national_series_resp*.csv
+  generate_national_weekly_batch_test:
+    run: python:v2 analysis/national_weekly.py --batch --set resp --test
+    needs: [generate_practice_measures_resp_test, generate_pre_processing_practice_resp_test]
+    outputs:
+      moderately_sensitive:
+        national_series: output/practice_measures_resp/national_series_resp*_test.csv
 """
 
 yaml_yearly = " \n # --------------- VISUALIZATION ACTIONS  WEEKLY------------------------------------------"
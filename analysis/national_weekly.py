@@ -2,6 +2,11 @@
 # for sense checking with other work packages.
 
 # python analysis/national_weekly.py
+# Options
+# --batch generates national weekly and yearly series for every measure and year of a measure set
+# --set specifies the measure set in batch mode (default resp)
+# --appt restricts measures to those with an appointment in interval, in batch mode
+# --test uses test data in batch mode
 
 import json
 import pandas as pd
@@ -11,80 +16,119 @@ import argparse
 from datetime import datetime, timedelta
 import os
 from utils import *
+from rollup import *
 import pyarrow.feather as feather
 from parse_args import config
 
 INTERVAL_TO_TEST = "2023-04-03" # Action will need to be edited if this is edited
 DISEASE_TO_TEST = "rsv_specific" # Action will need to be edited if this is edited
 
-input_path = f"output/practice_measures_resp/practice_measures_{INTERVAL_TO_TEST}"
-output_path = f"output/practice_measures_resp/national_weekly_{DISEASE_TO_TEST}_{INTERVAL_TO_TEST}"   
-practice_weekly_df = read_write(read_or_write="read", path=input_path, dtype=config["dtype_dict"], test = False)
 
-# -------------- Test cases -----------------------------
-
-if config["test"]:
-
-    # 1 - {DISEASE_TO_TEST} in {INTERVAL_TO_TEST} where 2 practices have counts of 10
-    test_date = pd.Timestamp(INTERVAL_TO_TEST)
-    test_practice_ids = practice_weekly_df["practice_pseudo_id"].unique()[:2]
-    practice_weekly_df['numerator'] = np.where(
-        (practice_weekly_df['measure'] == DISEASE_TO_TEST) &
-        (pd.to_datetime(practice_weekly_df['interval_start']) == test_date) &
-        (practice_weekly_df['practice_pseudo_id'].isin(test_practice_ids)),
-        10,
-        practice_weekly_df['numerator']
+def national_series(cube_df, measures=None):
+    """
+    Gets national weekly and yearly series from the rollup cube written by pre_processing.py.
+    Every measure and year is rolled up in the same scan of the input, so the series are
+    read from the cube rather than rescanning the practice rows.
+    Args:
+        cube_df (pd.DataFrame): Rollup cube, restricted to the years to include.
+        measures (list): Measures to include, all measures in the cube if None.
+    Returns:
+        tuple: National weekly and yearly dataframes, with the start of each input year in
+            'year_start'.
+    """
+    # ------------- Aggregate measures to national level -------------------------
+
+    national_weekly_df = query_cube(cube_df, period="week", level="national", measures=measures)
+
+    # Post-aggregation column edits
+    national_weekly_df = national_weekly_df.rename(
+        columns={'numerator_sum': 'numerator', 'list_size_sum': 'denominator', 'n_practices': 'n_practices_week'}
+    )[['measure', 'interval_start', 'numerator', 'denominator', 'n_practices_week', 'year_start']]
+    national_weekly_df.insert(
+        5, 'rate_per_1000', (national_weekly_df['numerator'] / national_weekly_df['denominator']) * 1000
     )
 
+    # ------------- Aggregate weekly to yearly -------------------------
 
-# ------------- Aggregate rsv_sensitive measure to national level -------------------------
-
-# Drop unnecessary columns and filter to RSV_sensitive measure
-practice_weekly_df.drop(columns=["interval_end", "ratio"], inplace=True)
-practice_weekly_df = practice_weekly_df[practice_weekly_df['measure'] == DISEASE_TO_TEST]
+    # Count number of unique practices in the overall year.
+    # Use the practices' first weekly denominators (week 1) as yearly list size to avoid
+    # inflating denominator by summing list sizes across weeks.
+    national_yearly_df = query_cube(cube_df, period="all", level="national", measures=measures)
 
-# Redefine categories of measure to avoid aggregation issues
-practice_weekly_df['measure'] = practice_weekly_df['measure'].cat.set_categories([DISEASE_TO_TEST])
-
-# Aggregate practice level data to national level
-national_weekly_df = build_aggregate_df(practice_weekly_df, ['measure', 'interval_start'], {'numerator': 'sum', 'denominator': 'sum', 'practice_pseudo_id': 'nunique'})
-
-# Post-aggregation column edits
-national_weekly_df.rename(columns={'practice_pseudo_id': 'n_practices_week'}, inplace=True)
-national_weekly_df['rate_per_1000'] = (national_weekly_df['numerator'] / national_weekly_df['denominator']) * 1000
+    # Post-aggregation column edits
+    national_yearly_df = national_yearly_df.rename(
+        columns={'numerator_sum': 'numerator', 'n_practices': 'n_practices_year', 'list_size_first': 'list_size_initial'}
+    )[['measure', 'numerator', 'n_practices_year', 'list_size_initial', 'year_start']]
+    national_yearly_df.insert(
+        4, 'rate_per_1000', (national_yearly_df['numerator'] / national_yearly_df['list_size_initial']) * 1000
+    )
+    return national_weekly_df, national_yearly_df
+
+
+# National totals are read from the rollup cube written by pre_processing.py rather than
+# rescanning the practice rows of each year
+if config["batch"]:
+    # Every measure and year of the measure set
+    measures_dir = f"output/practice_measures_{config['set'] or 'resp'}{config['appt_suffix']}"
+    input_path = f"{measures_dir}/cube_practice_measures"
+    output_path = f"{measures_dir}/national_series_{config['set'] or 'resp'}"
+    cube_df = read_write(read_or_write="read", path=input_path)
+    national_weekly_df, national_yearly_df = national_series(cube_df)
+else:
+    input_path = "output/practice_measures_resp/cube_practice_measures"
+    output_path = f"output/practice_measures_resp/national_weekly_{DISEASE_TO_TEST}_{INTERVAL_TO_TEST}"
+    cube_df = read_write(read_or_write="read", path=input_path, test = False)
+    cube_df = cube_df[cube_df['year_start'] == INTERVAL_TO_TEST]
+    national_weekly_df, national_yearly_df = national_series(cube_df, measures=[DISEASE_TO_TEST])
 
 print(national_weekly_df)
-read_write(read_or_write="write", df=national_weekly_df, path=output_path, file_type="csv", test = False)
-
-# ------------- Aggregate weekly to yearly -------------------------
-
-# Count number of unique practices in the overall year.
-# Use the first weekly denominator (week 1) as yearly list size to avoid
-# inflating denominator by summing list sizes across weeks.
-national_yearly_df = build_aggregate_df(practice_weekly_df, ['measure'], 
-                                        {'numerator': 'sum', 'practice_pseudo_id': 'nunique'}, 
-                                        initial_list_size = True)
-
-# Post-aggregation column edits
-national_yearly_df.rename(columns={'practice_pseudo_id': 'n_practices_year'}, inplace=True)
-national_yearly_df['rate_per_1000'] = (national_yearly_df['numerator'] / national_yearly_df['list_size_initial']) * 1000
-national_yearly_df['year_start'] = INTERVAL_TO_TEST
-
 print(national_yearly_df)
-read_write(read_or_write="write", df=national_yearly_df, path=f"{output_path}_yearly", file_type="csv", test = False)
-
-
-# ----------- Test case outputs --------------------------
-
-# Print test cases
-if config["test"]:
+if config["batch"]:
+    read_write(read_or_write="write", df=national_weekly_df, path=output_path, file_type="csv")
+    read_write(read_or_write="write", df=national_yearly_df, path=f"{output_path}_yearly", file_type="csv")
+else:
+    read_write(read_or_write="write", df=national_weekly_df.drop(columns='year_start'), path=output_path, file_type="csv", test = False)
+    read_write(read_or_write="write", df=national_yearly_df, path=f"{output_path}_yearly", file_type="csv", test = False)
+
+
+# ----------- Test cases --------------------------
+
+# Test cases run in batch mode, on the test measures the test cube was built from
+if config["batch"] and config["test"]:
+    test_date = pd.Timestamp(config['test_config']['start_date'])
+    practice_weekly_df = read_write(
+        read_or_write="read",
+        path=f"{measures_dir}/practice_measures_{config['test_config']['start_date']}",
+        dtype=config["dtype_dict"],
+    )
 
-    # 1 - numerator should be 20 for {DISEASE_TO_TEST} in {INTERVAL_TO_TEST}
-    test_output = national_weekly_df[
-        (national_weekly_df['measure'] == DISEASE_TO_TEST) &
-        (national_weekly_df['interval_start'] == INTERVAL_TO_TEST)
-    ]
-    print(f"Test Output for {DISEASE_TO_TEST} in {INTERVAL_TO_TEST}:")
+    # 1 - weekly national totals of the cube should match the sums of every practice row,
+    # including rows with 0 or nan list_size
+    practice_totals = practice_weekly_df.groupby(['measure', 'interval_start'], observed=True).agg(
+        {'numerator': 'sum', 'denominator': 'sum'}
+    )
+    cube_totals = national_weekly_df[national_weekly_df['year_start'] == test_date].set_index(
+        ['measure', 'interval_start']
+    )[['numerator', 'denominator']].loc[practice_totals.index]
+    print("Test Output of practice row totals for the test year:")
+    print(practice_totals)
+    assert np.allclose(cube_totals.to_numpy(dtype=float), practice_totals.to_numpy(dtype=float))
+
+    # 2 - {DISEASE_TO_TEST} in the first test interval where 2 practices have counts of 10 and
+    # the others 0, rolled up into a cube as pre_processing.py does
+    test_practice_ids = practice_weekly_df["practice_pseudo_id"].unique()[:2]
+    test_rows = (practice_weekly_df['measure'] == DISEASE_TO_TEST) & (
+        pd.to_datetime(practice_weekly_df['interval_start']) == test_date
+    )
+    practice_weekly_df['numerator'] = np.where(
+        test_rows,
+        np.where(practice_weekly_df['practice_pseudo_id'].isin(test_practice_ids), 10, 0),
+        practice_weekly_df['numerator']
+    )
+    test_cube_df = build_cube(practice_weekly_df.rename(columns={"denominator": "list_size"}))
+    test_cube_df.insert(0, "year_start", test_date)
+    test_weekly_df, test_yearly_df = national_series(test_cube_df, measures=[DISEASE_TO_TEST])
+    test_output = test_weekly_df[test_weekly_df['interval_start'] == test_date]
+    print(f"Test Output for {DISEASE_TO_TEST} in {config['test_config']['start_date']}:")
     print(test_output)
     assert test_output['numerator'].values[0] == 20
-
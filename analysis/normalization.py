@@ -7,9 +7,14 @@
 # --set specifies the measure set (appts_table, sro, resp)
 # --released uses already released data
 # --appt restricts measures to those with an appointment in interval
+# --partitioned reads processed measures partitioned by measure and year
+# --out_of_core streams one measure at a time in record batches, appending to the outputs
+# --workers analyses measures in parallel with this many worker processes
+# --sketch approximates the deciles with mergeable quantile sketches in --out_of_core and --workers runs
 
 import pandas as pd
 from utils import *
+from rollup import *
 import pyarrow.feather as feather
 from parse_args import *
 import numpy as np
@@ -21,274 +26,670 @@ import pyarrow.feather as feather
 from itertools import combinations
 from scipy.stats import pearsonr, spearmanr
 import os
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-# -------- Load data ----------------------------------
+# -------- Configuration ----------------------------------
 
 # Generate dates
 dates = generate_annual_dates(config["study_end_date"], config["n_years"])
 date_objects = [datetime.strptime(date, "%Y-%m-%d") for date in dates]
 
-log_memory_usage(label="Before loading data")
-
 input_path = (
     f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}/proc_{config['group']}_measures_midpoint6"
 )
-practice_interval_df = read_write("read", input_path)
+output_dir = f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}"
+
+# Only months inside the seasons of interest are needed
+season_months = [month for months in config["seasons"].values() for month in months]
+
+# Deciles of practice rates over all intervals are written for decile_charts.r, which only
+# charts practice measures. Test rates are simulated from the row keys, so practices are read too
+write_deciles = config["group"] == "practice"
+decile_columns = ["measure", "interval_start", "numerator_midpoint6", "list_size_midpoint6"]
+if config["test"]:
+    decile_columns.append("practice_pseudo_id")
+
+
+def filter_measures(practice_interval_df):
+    """
+    Removes unrepresentative intervals and the pandemic period from practice-interval measures.
+    Args:
+        practice_interval_df (pd.DataFrame): Processed measures, or one batch of them.
+    Returns:
+        pd.DataFrame: Practice-interval measures with season, pandemic, summer_year and rate.
+    """
+    # -------- Filter out unrepresentative intervals for calculating RRs ----------------------------------
+
+    # Remove interval containing xmas shutdown
+    date_col = practice_interval_df["interval_start"]
+    exclude_mask = (
+        ((date_col.dt.month == 12) & date_col.dt.day.between(19, 26))
+        | (date_col >= pd.Timestamp("2025-06-01"))
+    )
+    # Copy, so the derived columns below are added to a frame of its own rather than a slice
+    # of the caller's frame
+    practice_interval_df = practice_interval_df.loc[~exclude_mask].copy()
 
-print(f"1. Total numerator = {practice_interval_df['numerator_midpoint6'].sum()}, \nTotal denominator = {practice_interval_df['list_size_midpoint6'].sum()}, \nTotal practices = {practice_interval_df['practice_pseudo_id'].nunique()}")
-log_memory_usage(label="After loading data")
+    # Derive only the columns used below
+    practice_interval_df = practice_interval_df.wp.add("season", "pandemic", "summer_year", "rate")
 
-# -------- Filter out unrepresentative intervals for calculating RRs ----------------------------------
+    # Only keep intervals inside the periods of interest
+    practice_interval_df = practice_interval_df.loc[practice_interval_df["season"].notna()]
 
-# Remove interval containing xmas shutdown
-date_col = practice_interval_df["interval_start"]
-exclude_mask = (
-    ((date_col.dt.month == 12) & date_col.dt.day.between(19, 26))
-    | (date_col >= pd.Timestamp("2025-06-01"))
-)
-practice_interval_df = practice_interval_df.loc[~exclude_mask]
+    # Remove pandemic period from main dataset
+    practice_interval_df = practice_interval_df.loc[
+        ~practice_interval_df["pandemic"].isin(["During"])
+    ]
+    return practice_interval_df
+
+
+def practice_rates(practice_interval_df):
+    """
+    Gets the practice rates per 1000 that the deciles are computed from.
+    Args:
+        practice_interval_df (pd.DataFrame): Processed measures, or one batch of them.
+    Returns:
+        np.ndarray: Rate per 1000 of each row.
+    """
+    numerator = practice_interval_df["numerator_midpoint6"].to_numpy()
+    list_size = practice_interval_df["list_size_midpoint6"].to_numpy()
+    if config["test"]:
+        # Generate simulated rate data (since dummy data contains too many 0's to graph). Values
+        # are hashed from the row keys, so they are the same however the rows are batched or
+        # split between workers
+        row_hash = pd.util.hash_pandas_object(
+            practice_interval_df[["measure", "interval_start", "practice_pseudo_id"]], index=False
+        ).to_numpy()
+        numerator = (row_hash % 100 + 1).astype(np.int64)
+        list_size = (row_hash // 100 % 100 + 101).astype(np.int64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return numerator / list_size * 1000
+
+
+def long_deciles(groups_df, deciles):
+    """
+    Puts deciles per measure and interval in the long format that decile_charts.r plots.
+    Args:
+        groups_df (pd.DataFrame): measure and interval_start of each group.
+        deciles (np.ndarray): Deciles of each group, one row per group and one column per decile.
+    Returns:
+        pd.DataFrame: interval_start, measure, decile ('d1' to 'd9') and rate_per_1000.
+    """
+    n_groups = len(groups_df)
+    deciles_df = groups_df.iloc[np.repeat(np.arange(n_groups), 9)][["interval_start", "measure"]]
+    deciles_df["decile"] = np.tile([f"d{i}" for i in range(1, 10)], n_groups)
+    deciles_df["rate_per_1000"] = np.asarray(deciles).ravel()
+    return deciles_df.reset_index(drop=True)
+
+
+def interval_deciles(practice_interval_df):
+    """
+    Computes deciles of practice rates per measure and interval, in the long format that
+    decile_charts.r plots, so the charts do not need the practice-level data.
+    Args:
+        practice_interval_df (pd.DataFrame): Processed measures for all intervals.
+    Returns:
+        pd.DataFrame: interval_start, measure, decile ('d1' to 'd9') and rate_per_1000.
+    """
+    rate = practice_rates(practice_interval_df)
+    codes, n_groups, groups_df = factorize_groups(practice_interval_df, ["measure", "interval_start"])
+    valid = codes >= 0
+    deciles = group_quantiles(rate[valid], codes[valid], n_groups, [i / 10 for i in range(1, 10)])
+    return long_deciles(groups_df, deciles)
+
+
+def sketch_deciles(measure):
+    """
+    Approximates interval_deciles for one measure from mergeable quantile sketches of the
+    record batches, so only one batch of rows and the merged sketch are held in memory.
+    Prints the largest rank error bound of the deciles.
+    Args:
+        measure (str): Measure to compute deciles for.
+    Returns:
+        pd.DataFrame: Deciles in the format of interval_deciles, or None if there are no rows.
+    """
+    strata = ["measure", "interval_start"]
+    sketch = None
+    for batch_df in iter_measures(input_path, measures=[measure], columns=decile_columns):
+        batch_df["rate_per_1000"] = practice_rates(batch_df)
+        batch_sketch = quantile_sketch(batch_df, strata, "rate_per_1000")
+        sketch = batch_sketch if sketch is None else merge_sketches([sketch, batch_sketch], strata, "rate_per_1000")
+    if sketch is None:
+        return None
+
+    quantiles_df = sketch_quantiles(sketch, strata, "rate_per_1000", [i / 10 for i in range(1, 10)])
+    print(
+        f"Largest decile rank error bound for {measure}: {quantiles_df['rate_per_1000_rank_error'].max():.4f}",
+        flush=True,
+    )
+    deciles = quantiles_df[[f"rate_per_1000_q{i * 10}" for i in range(1, 10)]].to_numpy()
+    return long_deciles(quantiles_df, deciles)
+
+
+def stream_deciles(measures=None):
+    """
+    Computes interval_deciles in their own pass over the record batches, reading only the
+    columns they need, as they cover every interval while the season analysis only reads the
+    season months. Without measures, every measure is read in a single pass. Otherwise the
+    measures are read one at a time, and with --sketch in --out_of_core and --workers runs
+    they are approximated with sketch_deciles.
+    Args:
+        measures (list): Measures to compute deciles for, all in one pass if None.
+    Returns:
+        pd.DataFrame: Output of interval_deciles for each measure, in measure order.
+    """
+    if measures is None:
+        return interval_deciles(concat_categorical(list(iter_measures(input_path, columns=decile_columns))))
+
+    use_sketch = config["sketch"] and (config["out_of_core"] or config["workers"] > 1)
+    deciles_dfs = []
+    for measure in measures:
+        if use_sketch:
+            deciles_df = sketch_deciles(measure)
+        else:
+            batch_dfs = list(iter_measures(input_path, measures=[measure], columns=decile_columns))
+            deciles_df = interval_deciles(concat_categorical(batch_dfs)) if batch_dfs else None
+            del batch_dfs
+        if deciles_df is not None:
+            deciles_dfs.append(deciles_df)
+    return pd.concat(deciles_dfs, ignore_index=True)
+
+
+def load_measures(measures=None, categories=None):
+    """
+    Loads processed measures for the seasons of interest, removing unrepresentative intervals
+    and the pandemic period.
+    Args:
+        measures (list): Measures to load, all if None.
+        categories (list): Measure categories to keep, so every chunk shares the same categories.
+    Returns:
+        pd.DataFrame: Practice-interval measures with season, pandemic, summer_year and rate.
+    """
+    practice_interval_df = read_measures(input_path, measures=measures, months=season_months)
+    if categories is not None:
+        practice_interval_df["measure"] = practice_interval_df["measure"].cat.set_categories(categories)
+
+    print(f"1. Total numerator = {practice_interval_df['numerator_midpoint6'].sum()}, \nTotal denominator = {practice_interval_df['list_size_midpoint6'].sum()}, \nTotal practices = {practice_interval_df['practice_pseudo_id'].nunique()}")
+    log_memory_usage(label="After loading data")
+
+    practice_interval_df = filter_measures(practice_interval_df)
+    print(f"2. Total numerator after filtering = {practice_interval_df['numerator_midpoint6'].sum()}, \nTotal denominator after filtering = {practice_interval_df['list_size_midpoint6'].sum()}, \nTotal practices after filtering = {practice_interval_df['practice_pseudo_id'].nunique()}")
+    return practice_interval_df
+
+
+# Keys of the aggregates built from practice-interval rows
+interval_strata = ["measure", "interval_start", "pandemic"]
+practice_season_strata = ["measure", "practice_pseudo_id", "season", "pandemic", "summer_year"]
+
+
+def aggregate_seasons(practice_interval_df):
+    """
+    Aggregates practice-interval measures separately for summer and non-summer seasons:
+    moments of the practice rates per interval, for the between-practice variances, and counts
+    per practice season. Aggregates of separate batches of rows can be combined with
+    merge_season_aggregates.
+    Args:
+        practice_interval_df (pd.DataFrame): Output of filter_measures.
+    Returns:
+        dict: 'interval_moments' and 'practice_season_df' per seasonal group name.
+    """
+    is_summer = practice_interval_df["season"] == "Jun-Jul"
+    aggregates = {}
+    for name, group_df in [
+        ("summer", practice_interval_df[is_summer]),
+        ("non-summer", practice_interval_df[~is_summer]),
+    ]:
+        # Key codes shared by both aggregations of the group
+        group_index = RollupIndex(group_df)
+        aggregates[name] = {
+            "interval_moments": group_moments(
+                group_df, interval_strata, "rate_per_1000_midpoint6_derived", cache=group_index.cache
+            ),
+            "practice_season_df": rollup(
+                group_index,
+                period="season",
+                level="practice",
+                denominator=["sum", "count"],
+                by=["pandemic"],
+                order=practice_season_strata,
+            )[practice_season_strata + ["numerator_midpoint6_sum", "list_size_midpoint6_sum", "list_size_midpoint6_count"]],
+        }
+    return aggregates
+
+
+def merge_season_aggregates(parts):
+    """
+    Combines the outputs of aggregate_seasons on separate batches of rows.
+    Args:
+        parts (list): Outputs of aggregate_seasons or merge_season_aggregates.
+    Returns:
+        dict: Aggregates of all the rows, as aggregate_seasons would give on them together.
+    """
+    return {
+        name: {
+            "interval_moments": merge_moments(
+                [part[name]["interval_moments"] for part in parts],
+                interval_strata,
+                "rate_per_1000_midpoint6_derived",
+            ),
+            "practice_season_df": build_aggregate_df(
+                pd.concat([part[name]["practice_season_df"] for part in parts], ignore_index=True),
+                practice_season_strata,
+                {
+                    "numerator_midpoint6_sum": "sum",
+                    "list_size_midpoint6_sum": "sum",
+                    "list_size_midpoint6_count": "sum",
+                },
+            ),
+        }
+        for name in parts[0]
+    }
+
+
+def stream_aggregates(measures, categories):
+    """
+    Builds the season aggregates of some measures one record batch at a time, so the
+    practice-interval rows are never all held in memory. Between-practice variances are
+    combined from mergeable moments, so they match an in-memory run up to floating point
+    rounding.
+    Args:
+        measures (list): Measures to aggregate.
+        categories (list): Measure categories to keep, so every chunk shares the same categories.
+    Returns:
+        dict: Output of merge_season_aggregates over all batches.
+    """
+    parts = []
+    totals = {"loaded": [0, 0, set()], "filtered": [0, 0, set()]}
+    for batch_df in iter_measures(input_path, measures=measures, months=season_months):
+        batch_df["measure"] = batch_df["measure"].cat.set_categories(categories)
+        for stage in ["loaded", "filtered"]:
+            if stage == "filtered":
+                batch_df = filter_measures(batch_df)
+            totals[stage][0] += batch_df["numerator_midpoint6"].sum()
+            totals[stage][1] += batch_df["list_size_midpoint6"].sum()
+            totals[stage][2].update(batch_df["practice_pseudo_id"].unique())
+        parts.append(aggregate_seasons(batch_df))
+        # Merge as batches arrive, so only the running aggregates are kept
+        if len(parts) == 16:
+            parts = [merge_season_aggregates(parts)]
+
+    numerator, list_size, practices = totals["loaded"]
+    print(f"1. Total numerator = {numerator}, \nTotal denominator = {list_size}, \nTotal practices = {len(practices)}")
+    numerator, list_size, practices = totals["filtered"]
+    print(f"2. Total numerator after filtering = {numerator}, \nTotal denominator after filtering = {list_size}, \nTotal practices after filtering = {len(practices)}")
+    return merge_season_aggregates(parts)
+
+
+def seasonal_analysis(aggregates):
+    """
+    Runs the seasonality analysis on the season aggregates of practice-interval measures.
+    Every grouping key includes measure, so it can be run on all measures at once or on one
+    measure at a time.
+    Args:
+        aggregates (dict): Output of aggregate_seasons or merge_season_aggregates.
+    Returns:
+        dict: Result frames. 'weighted_long' holds the summer and non-summer practice seasons,
+            indexed by position before the removal of missing baselines, and
+            'n_practice_seasons' the number of practice seasons before that removal.
+            'practice_summary' holds the practice-level rates, RRs and p-values used for
+            plotting and significance testing across all measures.
+    """
+    # ----------------------- Seasonality analysis ----------------------------------
+
+    # Iterate over two summer baseline options: 1) Compare winter to prev summer 2) Compare winter to first summer
+
+    non_summer = {"name": "non-summer", **aggregates["non-summer"]}
+    summer = {"name": "summer", **aggregates["summer"]}
+    seasonal_groups = [summer, non_summer]
+    del aggregates
+
+    for seasonal_group in seasonal_groups:
+
+        # -------- 1 - VARIANCES --------------------
+
+        # Variance between practices at each timepoint
+        seasonal_group["interval_season_df"] = seasonal_group["interval_moments"][interval_strata].copy()
+        seasonal_group["interval_season_df"]["rate_per_1000_midpoint6_derived_var"] = moments_var(
+            seasonal_group["interval_moments"], "rate_per_1000_midpoint6_derived"
+        )
 
-practice_interval_df["season"] = practice_interval_df["month"].apply(get_season)
+        seasonal_group["interval_season_df"] = seasonal_group["interval_season_df"].wp.add("season")
 
-# Only keep intervals inside the periods of interest
-practice_interval_df = practice_interval_df.loc[
-        practice_interval_df["season"].isin(
-            ["Jun-Jul", "Sep-Oct", "Nov-Dec", "Jan-Feb"]
+        # Variance at each timepoint, averaged per season
+        seasonal_group["season_var_df"] = build_aggregate_df(
+            seasonal_group["interval_season_df"],
+            ["measure", "season", "pandemic"],
+            {"rate_per_1000_midpoint6_derived_var": ["median", "count"]},
         )
-    ]
 
-# Separate pandemic period from main dataset
-pandemic_df = practice_interval_df.loc[
-        practice_interval_df["pandemic"].isin(
-            ["During"]
+        # Rename columns for clarity
+        seasonal_group["season_var_df"].rename(
+            columns={
+                "rate_per_1000_midpoint6_derived_var_median": "rate_var_btwn_prac_median",
+                "rate_per_1000_midpoint6_derived_var_count": "rate_var_btwn_prac_n_intervals"
+            },
+            inplace=True,
         )
-    ]
-practice_interval_df = practice_interval_df.loc[
-    ~practice_interval_df["pandemic"].isin(["During"])
-]
-print(f"2. Total numerator after filtering = {practice_interval_df['numerator_midpoint6'].sum()}, \nTotal denominator after filtering = {practice_interval_df['list_size_midpoint6'].sum()}, \nTotal practices after filtering = {practice_interval_df['practice_pseudo_id'].nunique()}")
-# ----------------------- Seasonality analysis ----------------------------------
+        print(f"3. Total numerator for {seasonal_group['name']} = {seasonal_group['practice_season_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for {seasonal_group['name']} = {seasonal_group['practice_season_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for {seasonal_group['name']} = {seasonal_group['practice_season_df']['practice_pseudo_id'].nunique()}")
+        del seasonal_group["interval_moments"], seasonal_group["interval_season_df"]
 
-# Iterate over two summer baseline options: 1) Compare winter to prev summer 2) Compare winter to first summer
+    # -------- 2 - REMOVE SEASONS WITH MISSING BASELINES --------------------
 
-non_summer = {}
-summer = {}
-seasonal_groups = [summer, non_summer]
-non_summer['practice_interval_df'] = practice_interval_df[practice_interval_df['season'] != 'Jun-Jul']
-summer['practice_interval_df'] = practice_interval_df[practice_interval_df['season'] == 'Jun-Jul']
+    # Generate total counts per measure per summer
+    summer["zero_or_nan_df"] = summer["practice_season_df"][
+        (summer["practice_season_df"]["numerator_midpoint6_sum"] == 0)
+        | (summer["practice_season_df"]["numerator_midpoint6_sum"].isna())
+    ]
 
-for seasonal_group in seasonal_groups:
+    print(f"4. Total numerator for {summer['name']} = {summer['practice_season_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for {summer['name']} = {summer['practice_season_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for {summer['name']} = {summer['practice_season_df']['practice_pseudo_id'].nunique()}")
+    print(f"5. Total numerator for {non_summer['name']} = {non_summer['practice_season_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for {non_summer['name']} = {non_summer['practice_season_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for {non_summer['name']} = {non_summer['practice_season_df']['practice_pseudo_id'].nunique()}")
+    print(f"6. Total numerator for zero/nan summer practices = {summer['zero_or_nan_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for zero/nan summer practices = {summer['zero_or_nan_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for zero/nan summer practices = {summer['zero_or_nan_df']['practice_pseudo_id'].nunique()}")
+
+    for seasonal_group in seasonal_groups:
+
+        # Remove practice seasons without a valid baseline rate
+        keys = ['measure', 'summer_year', 'practice_pseudo_id']
+        seasonal_group['n_practice_seasons'] = len(seasonal_group['practice_season_df'])
+        has_baseline = join_mask(seasonal_group['practice_season_df'], summer['zero_or_nan_df'], keys, how='anti')
+        print(f"7. Total numerator for {seasonal_group['name']} after merging with zero/nan df = {seasonal_group['practice_season_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for {seasonal_group['name']} after merging with zero/nan df = {seasonal_group['practice_season_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for {seasonal_group['name']} after merging with zero/nan df = {seasonal_group['practice_season_df']['practice_pseudo_id'].nunique()}")
+        seasonal_group['practice_season_df'] = seasonal_group['practice_season_df'][has_baseline]
+        print(f"8. Total numerator for {seasonal_group['name']} after removing zero/nan practices = {seasonal_group['practice_season_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for {seasonal_group['name']} after removing zero/nan practices = {seasonal_group['practice_season_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for {seasonal_group['name']} after removing zero/nan practices = {seasonal_group['practice_season_df']['practice_pseudo_id'].nunique()}")
+
+        # -------- 3 - PATIENT LEVEL (LIST_SIZE-WEIGHTED) EFFECTS --------------------
+
+        seasonal_group["season_df"] = build_aggregate_df(
+            seasonal_group["practice_season_df"],
+            ["measure", "season", "pandemic", "summer_year"],
+            {
+                "numerator_midpoint6_sum": ["sum"],
+                "list_size_midpoint6_sum": ["sum"],
+                "list_size_midpoint6_count": ["sum"],
+            },
+        )
 
-    # -------- 1 - VARIANCES --------------------
+        print(f"9. Total numerator for {seasonal_group['name']} after season-level aggregation = {seasonal_group['season_df']['numerator_midpoint6_sum_sum'].sum()}, \nTotal denominator for {seasonal_group['name']} after season-level aggregation = {seasonal_group['season_df']['list_size_midpoint6_sum_sum'].sum()}, \nTotal practices for {seasonal_group['name']} after season-level aggregation = {seasonal_group['season_df']['list_size_midpoint6_count_sum'].sum()}")
+    long_dfs = [summer['practice_season_df'].copy(), non_summer['practice_season_df'].copy()]
 
-    seasonal_group["interval_season_df"] = build_aggregate_df(
-        seasonal_group["practice_interval_df"],
-        ["measure", "interval_start", "pandemic"],
-        {"rate_per_1000_midpoint6_derived": ["var"]},
+    combined_seasons_df = merge_seasons(
+        summer["season_df"], non_summer["season_df"], practice_level=False
     )
 
-    seasonal_group["interval_season_df"]["season"] = seasonal_group[
-        "interval_season_df"
-    ]["interval_start"].dt.month.apply(get_season)
+    # Calculate rate ratios
+    combined_seasons_df[f"rate_per_1000"] = (
+        combined_seasons_df[f"numerator_midpoint6_sum_sum"]
+        / combined_seasons_df[f"list_size_midpoint6_sum_sum"]
+    ) * 1000
+    baselines = ["_prev_summr", "_first_summr"]
+
+    for baseline in baselines:
+        combined_seasons_df[f"rate_per_1000{baseline}"] = (
+            combined_seasons_df[f"numerator_midpoint6_sum_sum{baseline}"]
+            / combined_seasons_df[f"list_size_midpoint6_sum_sum{baseline}"]
+        ) * 1000
+        combined_seasons_df[f"RR{baseline}"] = (
+            combined_seasons_df[f"rate_per_1000"]
+            / combined_seasons_df[f"rate_per_1000{baseline}"]
+        )
+        combined_seasons_df[f"RD{baseline}"] = (
+            combined_seasons_df[f"rate_per_1000"]
+            - combined_seasons_df[f"rate_per_1000{baseline}"]
+        )
 
-    # Variance at each timepoint, averaged per season
-    seasonal_group["season_var_df"] = build_aggregate_df(
-        seasonal_group["interval_season_df"],
-        ["measure", "season", "pandemic"],
-        {"rate_per_1000_midpoint6_derived_var": ["median", "count"]},
+    rename_map = {
+        "numerator_midpoint6_sum_sum": "num_sum",
+        "list_size_midpoint6_sum_sum": "list_sum",
+        "list_size_midpoint6_count_sum": "list_count",
+        "numerator_midpoint6_sum_sum_prev_summr": "num_prev",
+        "list_size_midpoint6_sum_sum_prev_summr": "list_prev",
+        "list_size_midpoint6_count_sum_prev_summr": "list_count_prev",
+        "numerator_midpoint6_sum_sum_first_summr": "num_first",
+        "list_size_midpoint6_sum_sum_first_summr": "list_first",
+        "list_size_midpoint6_count_sum_first_summr": "list_count_first",
+        "rate_per_1000": "rate",
+        "rate_per_1000_prev_summr": "rate_prev",
+        "rate_per_1000_first_summr": "rate_first",
+        "RR_prev_summr": "RR_prev",
+        "RD_prev_summr": "RD_prev",
+        "RR_first_summr": "RR_first",
+        "RD_first_summr": "RD_first",
+    }
+
+    combined_seasons_df = combined_seasons_df.rename(columns=rename_map)
+    combined_seasons_df = combined_seasons_df.drop(
+        columns=["season_prev_summr", "season_first_summr"]
     )
 
-    # Rename columns for clarity
-    seasonal_group["season_var_df"].rename(
-        columns={
-            "rate_per_1000_midpoint6_derived_var_median": "rate_var_btwn_prac_median",
-            "rate_per_1000_midpoint6_derived_var_count": "rate_var_btwn_prac_n_intervals"
-        },
-        inplace=True,
+    combined_var_df = summer["season_var_df"].merge(
+        non_summer["season_var_df"], on=["measure", "season", "pandemic"], how="left"
     )
-    print(f"3. Total numerator for {seasonal_group['practice_interval_df']['season'].iloc[0]} = {seasonal_group['practice_interval_df']['numerator_midpoint6'].sum()}, \nTotal denominator for {seasonal_group['practice_interval_df']['season'].iloc[0]} = {seasonal_group['practice_interval_df']['list_size_midpoint6'].sum()}, \nTotal practices for {seasonal_group['practice_interval_df']['season'].iloc[0]} = {seasonal_group['practice_interval_df']['practice_pseudo_id'].nunique()}")
-
-    # -------- 2 - REMOVE SEASONS WITH MISSING BASELINES --------------------
 
-    # Aggregate counts per practice per season
-    seasonal_group["practice_season_df"] = build_aggregate_df(
-        seasonal_group["practice_interval_df"],
-        ["measure", "practice_pseudo_id", "season", "pandemic", "summer_year"],
-        {"numerator_midpoint6": ["sum"], "list_size_midpoint6": ["sum", "count"]},
-    )
+    # Check medians and var ratio
+    # practice_season_df["var/mean"] = (
+    #     practice_season_df["rate_per_1000_midpoint6_derived_var_mean"]
+    #     / practice_season_df["rate_per_1000_midpoint6_derived_mean_mean"]
+    # )
 
-# Generate total counts per measure per summer
-summer["zero_or_nan_df"] = summer["practice_season_df"][
-    (summer["practice_season_df"]["numerator_midpoint6_sum"] == 0)
-    | (summer["practice_season_df"]["numerator_midpoint6_sum"].isna())
-]
-
-print(f"4. Total numerator for {summer['practice_season_df']['season'].iloc[0]} = {summer['practice_season_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for {summer['practice_season_df']['season'].iloc[0]} = {summer['practice_season_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for {summer['practice_season_df']['season'].iloc[0]} = {summer['practice_season_df']['practice_pseudo_id'].nunique()}")
-print(f"5. Total numerator for {non_summer['practice_season_df']['season'].iloc[0]} = {non_summer['practice_season_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for {non_summer['practice_season_df']['season'].iloc[0]} = {non_summer['practice_season_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for {non_summer['practice_season_df']['season'].iloc[0]} = {non_summer['practice_season_df']['practice_pseudo_id'].nunique()}")
-print(f"6. Total numerator for zero/nan summer practices = {summer['zero_or_nan_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for zero/nan summer practices = {summer['zero_or_nan_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for zero/nan summer practices = {summer['zero_or_nan_df']['practice_pseudo_id'].nunique()}")
-
-for seasonal_group in seasonal_groups:
-
-    # Remove practice seasons without a valid baseline rate
-    keys = ['measure', 'summer_year', 'practice_pseudo_id']
-    seasonal_group['practice_season_df'] = seasonal_group['practice_season_df'].merge(summer['zero_or_nan_df'][keys], on=keys, how='left', indicator=True)
-    print(f"7. Total numerator for {seasonal_group['practice_season_df']['season'].iloc[0]} after merging with zero/nan df = {seasonal_group['practice_season_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for {seasonal_group['practice_season_df']['season'].iloc[0]} after merging with zero/nan df = {seasonal_group['practice_season_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for {seasonal_group['practice_season_df']['season'].iloc[0]} after merging with zero/nan df = {seasonal_group['practice_season_df']['practice_pseudo_id'].nunique()}")
-    seasonal_group['practice_season_df'] = seasonal_group['practice_season_df'][seasonal_group['practice_season_df']['_merge'] == 'left_only'].drop(columns='_merge')
-    print(f"8. Total numerator for {seasonal_group['practice_season_df']['season'].iloc[0]} after removing zero/nan practices = {seasonal_group['practice_season_df']['numerator_midpoint6_sum'].sum()}, \nTotal denominator for {seasonal_group['practice_season_df']['season'].iloc[0]} after removing zero/nan practices = {seasonal_group['practice_season_df']['list_size_midpoint6_sum'].sum()}, \nTotal practices for {seasonal_group['practice_season_df']['season'].iloc[0]} after removing zero/nan practices = {seasonal_group['practice_season_df']['practice_pseudo_id'].nunique()}")
-    
-    # -------- 3 - PATIENT LEVEL (LIST_SIZE-WEIGHTED) EFFECTS --------------------
-
-    seasonal_group["season_df"] = build_aggregate_df(
-        seasonal_group["practice_season_df"],
-        ["measure", "season", "pandemic", "summer_year"],
-        {
-            "numerator_midpoint6_sum": ["sum"],
-            "list_size_midpoint6_sum": ["sum"],
-            "list_size_midpoint6_count": ["sum"],
-        },
-    )
+    # ------------ 4 - PRACTICE-LEVEL (UNWEIGHTED) EFFECT -------------------------
 
-    print(f"9. Total numerator for {seasonal_group['season_df']['season'].iloc[0]} after season-level aggregation = {seasonal_group['season_df']['numerator_midpoint6_sum_sum'].sum()}, \nTotal denominator for {seasonal_group['season_df']['season'].iloc[0]} after season-level aggregation = {seasonal_group['season_df']['list_size_midpoint6_sum_sum'].sum()}, \nTotal practices for {seasonal_group['season_df']['season'].iloc[0]} after season-level aggregation = {seasonal_group['season_df']['list_size_midpoint6_count_sum'].sum()}")
-long_df = pd.concat([summer['practice_season_df'], non_summer['practice_season_df']])
-read_write(read_or_write="write", path=f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}/Results_weighted_long", df=long_df, file_type = 'csv')    
+    non_summer["practice_season_df"]["Rate_per_1000"] = (
+        non_summer["practice_season_df"]["numerator_midpoint6_sum"]
+        / non_summer["practice_season_df"]["list_size_midpoint6_sum"]
+    ) * 1000
+    summer["practice_season_df"]["Rate_per_1000"] = (
+        summer["practice_season_df"]["numerator_midpoint6_sum"]
+        / summer["practice_season_df"]["list_size_midpoint6_sum"]
+    ) * 1000
 
-combined_seasons_df = merge_seasons(
-    summer["season_df"], non_summer["season_df"], practice_level=False
-)
+    combined_practice_seasons_df = merge_seasons(
+        summer["practice_season_df"], non_summer["practice_season_df"], practice_level=True
+    )
 
-# Calculate rate ratios
-combined_seasons_df[f"rate_per_1000"] = (
-    combined_seasons_df[f"numerator_midpoint6_sum_sum"]
-    / combined_seasons_df[f"list_size_midpoint6_sum_sum"]
-) * 1000
-baselines = ["_prev_summr", "_first_summr"]
-
-for baseline in baselines:
-    combined_seasons_df[f"rate_per_1000{baseline}"] = (
-        combined_seasons_df[f"numerator_midpoint6_sum_sum{baseline}"]
-        / combined_seasons_df[f"list_size_midpoint6_sum_sum{baseline}"]
-    ) * 1000
-    combined_seasons_df[f"RR{baseline}"] = (
-        combined_seasons_df[f"rate_per_1000"]
-        / combined_seasons_df[f"rate_per_1000{baseline}"]
+    combined_practice_seasons_df["RR_prev_summr"] = (
+        combined_practice_seasons_df["Rate_per_1000"]
+        / combined_practice_seasons_df["Rate_per_1000_prev_summr"]
     )
-    combined_seasons_df[f"RD{baseline}"] = (
-        combined_seasons_df[f"rate_per_1000"]
-        - combined_seasons_df[f"rate_per_1000{baseline}"]
+    combined_practice_seasons_df["RR_first_summr"] = (
+        combined_practice_seasons_df["Rate_per_1000"]
+        / combined_practice_seasons_df["Rate_per_1000_first_summr"]
+    )
+    combined_practice_seasons_df["RD_prev_summr"] = (
+        combined_practice_seasons_df["Rate_per_1000"]
+        - combined_practice_seasons_df["Rate_per_1000_prev_summr"]
+    )
+    combined_practice_seasons_df["RD_first_summr"] = (
+        combined_practice_seasons_df["Rate_per_1000"]
+        - combined_practice_seasons_df["Rate_per_1000_first_summr"]
     )
 
-rename_map = {
-    "numerator_midpoint6_sum_sum": "num_sum",
-    "list_size_midpoint6_sum_sum": "list_sum",
-    "list_size_midpoint6_count_sum": "list_count",
-    "numerator_midpoint6_sum_sum_prev_summr": "num_prev",
-    "list_size_midpoint6_sum_sum_prev_summr": "list_prev",
-    "list_size_midpoint6_count_sum_prev_summr": "list_count_prev",
-    "numerator_midpoint6_sum_sum_first_summr": "num_first",
-    "list_size_midpoint6_sum_sum_first_summr": "list_first",
-    "list_size_midpoint6_count_sum_first_summr": "list_count_first",
-    "rate_per_1000": "rate",
-    "rate_per_1000_prev_summr": "rate_prev",
-    "rate_per_1000_first_summr": "rate_first",
-    "RR_prev_summr": "RR_prev",
-    "RD_prev_summr": "RD_prev",
-    "RR_first_summr": "RR_first",
-    "RD_first_summr": "RD_first",
-}
-
-combined_seasons_df = combined_seasons_df.rename(columns=rename_map)
-combined_seasons_df = combined_seasons_df.drop(
-    columns=["season_prev_summr", "season_first_summr"]
-)
-read_write(
-    read_or_write="write",
-    path=f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}/Results_weighted",
-    df=combined_seasons_df,
-    file_type="csv",
-)
-
-combined_var_df = summer["season_var_df"].merge(
-    non_summer["season_var_df"], on=["measure", "season", "pandemic"], how="left"
-)
+    # Aggregate from practice level to pandemic level
+    combined_seasons_df_results = build_aggregate_df(
+        combined_practice_seasons_df,
+        ["measure", "season", "pandemic"],
+        {"RR_prev_summr": ["median"], "RR_first_summr": ["median"], "list_size_midpoint6_count_first_summr": ['sum'], "list_size_midpoint6_count_prev_summr": ["sum"],
+         "RD_prev_summr": ["median"], "RD_first_summr": ["median"]},
+    )
 
-read_write(
-    read_or_write="write",
-    path=f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}/Results_variance",
-    df=combined_var_df,
-    file_type="csv",
-)
+    # Save unweighted RRs per season
+    rename_map = {
+        # rate ratios
+        "RR_prev_summr_median": "RR_prev_median",
+        "RR_first_summr_median": "RR_first_median",
+
+        # list sizes (counts of practices contributing)
+        "list_size_midpoint6_count_first_summr_sum": "list_count_first",
+        "list_size_midpoint6_count_prev_summr_sum": "list_count_prev",
+        # rate differences
+        "RD_prev_summr_median": "RD_prev_median",
+        "RD_first_summr_median": "RD_first_median",
+    }
+    combined_seasons_df_results = combined_seasons_df_results.rename(columns=rename_map)
+
+    # Test every practice-season against its summer baselines in one batched call per baseline.
+    # Only the p-values are kept, as the multiple testing adjustment is across all measures
+    practice_summary_df = combined_practice_seasons_df[
+        ["measure", "season", "pandemic", "Rate_per_1000", "RR_prev_summr"]
+    ].copy()
+    for baseline in ["prev_summr", "first_summr"]:
+        practice_summary_df[f"p_{baseline}"] = test_difference(
+            combined_practice_seasons_df["numerator_midpoint6_sum"],
+            combined_practice_seasons_df["list_size_midpoint6_sum"],
+            combined_practice_seasons_df[f"numerator_midpoint6_sum_{baseline}"],
+            combined_practice_seasons_df[f"list_size_midpoint6_sum_{baseline}"],
+        )
 
-# Check medians and var ratio
-# practice_season_df["var/mean"] = (
-#     practice_season_df["rate_per_1000_midpoint6_derived_var_mean"]
-#     / practice_season_df["rate_per_1000_midpoint6_derived_mean_mean"]
-# )
+    return {
+        "weighted_long": long_dfs,
+        "n_practice_seasons": [summer["n_practice_seasons"], non_summer["n_practice_seasons"]],
+        "weighted": combined_seasons_df,
+        "variance": combined_var_df,
+        "unweighted": combined_seasons_df_results,
+        "practice_level": combined_practice_seasons_df,
+        "practice_summary": practice_summary_df,
+    }
 
-# ------------ 4 - PRACTICE-LEVEL (UNWEIGHTED) EFFECT -------------------------
 
-non_summer["practice_season_df"]["Rate_per_1000"] = (
-    non_summer["practice_season_df"]["numerator_midpoint6_sum"]
-    / non_summer["practice_season_df"]["list_size_midpoint6_sum"]
-) * 1000
-summer["practice_season_df"]["Rate_per_1000"] = (
-    summer["practice_season_df"]["numerator_midpoint6_sum"]
-    / summer["practice_season_df"]["list_size_midpoint6_sum"]
-) * 1000
+# -------- Run analysis ----------------------------------
 
-combined_practice_seasons_df = merge_seasons(
-    summer["practice_season_df"], non_summer["practice_season_df"], practice_level=True
-)
+log_memory_usage(label="Before loading data")
 
-combined_practice_seasons_df["RR_prev_summr"] = (
-    combined_practice_seasons_df["Rate_per_1000"]
-    / combined_practice_seasons_df["Rate_per_1000_prev_summr"]
-)
-combined_practice_seasons_df["RR_first_summr"] = (
-    combined_practice_seasons_df["Rate_per_1000"]
-    / combined_practice_seasons_df["Rate_per_1000_first_summr"]
-)
-combined_practice_seasons_df["RD_prev_summr"] = (
-    combined_practice_seasons_df["Rate_per_1000"]
-    - combined_practice_seasons_df["Rate_per_1000_prev_summr"]
-)
-combined_practice_seasons_df["RD_first_summr"] = (
-    combined_practice_seasons_df["Rate_per_1000"]
-    - combined_practice_seasons_df["Rate_per_1000_first_summr"]
-)
+if config["out_of_core"] or config["workers"] > 1:
+    # Every grouping key includes measure, so measures can be analysed one at a time
+    measure_categories = list_measures(input_path)
+    measure_chunks = [[measure] for measure in measure_categories]
+else:
+    measure_categories = None
+    measure_chunks = [None]
+n_workers = min(config["workers"], len(measure_chunks))
+print(f"Analysing {len(measure_chunks)} chunk(s) with {n_workers} worker(s)", flush=True)
+
+
+def analyse_chunk(chunk):
+    """
+    Loads and analyses one chunk of measures.
+    Args:
+        chunk (int): Position of the chunk in measure_chunks.
+    Returns:
+        dict: Results of seasonal_analysis for the chunk, with the chunk's 'deciles'.
+    """
+    measures = measure_chunks[chunk]
+    if measures is not None:
+        print(f"Analysing {measures[0]} ({chunk + 1} of {len(measure_chunks)})", flush=True)
+    if config["out_of_core"]:
+        aggregates = stream_aggregates(measures, categories=measure_categories)
+    else:
+        practice_interval_df = load_measures(measures, categories=measure_categories)
+        aggregates = aggregate_seasons(practice_interval_df)
+        del practice_interval_df
+    results = seasonal_analysis(aggregates)
+    if write_deciles:
+        results["deciles"] = stream_deciles(measures)
+    return results
+
+
+# Results are appended chunk by chunk. Row labels continue across chunks, and the non-summer
+# half of the long results is staged in a part file, so outputs match a single-chunk run
+long_part_path = f"{output_dir}/Results_weighted_long_non_summer_part"
+written_rows = {"weighted": 0, "variance": 0, "unweighted": 0}
+long_offsets = [0, 0]
+practice_summary_dfs = []
+
+# Fork so workers inherit the configuration and measure chunks without re-running this script.
+# Results are returned in chunk order and written by this process, so outputs match a serial run
+if n_workers > 1:
+    pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("fork"))
+    chunk_results = pool.map(analyse_chunk, range(len(measure_chunks)))
+else:
+    pool = None
+    chunk_results = map(analyse_chunk, range(len(measure_chunks)))
+
+with ArrowChunkWriter(f"{output_dir}/practice_level_counts") as practice_level_writer:
+    for chunk, results in enumerate(chunk_results):
+        # Long results: summer practice seasons first, then non-summer
+        for part, (long_df, long_path) in enumerate(
+            zip(results["weighted_long"], [f"{output_dir}/Results_weighted_long", long_part_path])
+        ):
+            long_df.index += long_offsets[part]
+            append_csv(long_df, long_path, first=chunk == 0, header=part == 0)
+            long_offsets[part] += results["n_practice_seasons"][part]
+
+        for name, file_name in [
+            ("weighted", "Results_weighted"),
+            ("variance", "Results_variance"),
+            ("unweighted", "Results_unweighted"),
+        ]:
+            results[name].index += written_rows[name]
+            append_csv(results[name], f"{output_dir}/{file_name}", first=chunk == 0)
+            written_rows[name] += len(results[name])
+
+        practice_level_writer.write(results["practice_level"])
+        practice_summary_dfs.append(results["practice_summary"])
+        if write_deciles:
+            append_csv(results["deciles"], f"{output_dir}/deciles_rate_mp6", first=chunk == 0, index=False)
+        del results
+        log_memory_usage(label="After analysing chunk")
+
+if pool is not None:
+    pool.shutdown()
+
+# Move the staged non-summer long results to the end of the long results
+with open(f"{output_dir}/Results_weighted_long{config['test_suffix']}.csv", "a") as long_file:
+    with open(f"{long_part_path}{config['test_suffix']}.csv") as part_file:
+        shutil.copyfileobj(part_file, long_file)
+os.remove(f"{long_part_path}{config['test_suffix']}.csv")
+
+practice_summary_df = pd.concat(practice_summary_dfs, ignore_index=True)
+del practice_summary_dfs
 
 # Visualise distributions of rates and RRs
-plot_dir = f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}/plots"
+plot_dir = f"{output_dir}/plots"
 os.makedirs(plot_dir, exist_ok=True)
 
-rate_plots = generate_dist_plot(df = combined_practice_seasons_df, var = "Rate_per_1000", facet_var = 'measure')
+rate_plots = generate_dist_plot(df = practice_summary_df, var = "Rate_per_1000", facet_var = 'measure')
 rate_plots.savefig(f"{plot_dir}/rates.png")
-RR_plots = generate_dist_plot(df = combined_practice_seasons_df, var = "RR_prev_summr", facet_var = 'measure')
+RR_plots = generate_dist_plot(df = practice_summary_df, var = "RR_prev_summr", facet_var = 'measure')
 RR_plots.savefig(f"{plot_dir}/RR_prev_summer.png")
-read_write(read_or_write="write", path=f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}/practice_level_counts", df=combined_practice_seasons_df, file_type = 'arrow')    
-
-# Aggregate from practice level to pandemic level
-combined_seasons_df_results = build_aggregate_df(
-    combined_practice_seasons_df,
-    ["measure", "season", "pandemic"],
-    {"RR_prev_summr": ["median"], "RR_first_summr": ["median"], "list_size_midpoint6_count_first_summr": ['sum'], "list_size_midpoint6_count_prev_summr": ["sum"],
-     "RD_prev_summr": ["median"], "RD_first_summr": ["median"]},
+
+# ------------ 5 - PRACTICE-LEVEL SIGNIFICANCE TESTING -------------------------
+
+signif_aggregations = {}
+for baseline in ["prev_summr", "first_summr"]:
+    pvalues = practice_summary_df.pop(f"p_{baseline}").to_numpy()
+
+    # Adjust for multiple testing, only over practice-seasons that could be tested
+    valid_mask = ~np.isnan(pvalues)
+    adj_pvalues = np.full_like(pvalues, np.nan)
+    if valid_mask.any():
+        adj_pvalues[valid_mask] = stats.false_discovery_control(pvalues[valid_mask], method="bh")
+
+    # Significance indicators are missing for untested practice-seasons so they are not counted
+    practice_summary_df[f"signif_{baseline}"] = np.where(valid_mask, pvalues < 0.05, np.nan)
+    practice_summary_df[f"signif_adj_{baseline}"] = np.where(
+        valid_mask, adj_pvalues < 0.05, np.nan
+    )
+    signif_aggregations[f"signif_{baseline}"] = ["sum", "count"]
+    signif_aggregations[f"signif_adj_{baseline}"] = ["sum"]
+
+# Proportion of practices with a significant difference at measure-season level
+signif_df = build_aggregate_df(
+    practice_summary_df, ["measure", "season", "pandemic"], signif_aggregations
 )
+for baseline in ["prev_summr", "first_summr"]:
+    for col in [f"signif_{baseline}_sum", f"signif_{baseline}_count", f"signif_adj_{baseline}_sum"]:
+        signif_df[col] = roundmid_any(signif_df[col], to=6)
+    signif_df[f"signif_%_{baseline}"] = (
+        signif_df[f"signif_{baseline}_sum"] / signif_df[f"signif_{baseline}_count"]
+    ) * 100
+    signif_df[f"signif_%_adj_{baseline}"] = (
+        signif_df[f"signif_adj_{baseline}_sum"] / signif_df[f"signif_{baseline}_count"]
+    ) * 100
+
+signif_df = signif_df.round(2)
+read_write(read_or_write="write", path=f"{output_dir}/Results_practice_tests", df=signif_df, file_type = 'csv')
+
+log_memory_usage(label="After practice-level testing")
 
-# Save unweighted RRs per season
-rename_map = {
-    # rate ratios
-    "RR_prev_summr_median": "RR_prev_median",
-    "RR_first_summr_median": "RR_first_median",
-
-    # list sizes (counts of practices contributing)
-    "list_size_midpoint6_count_first_summr_sum": "list_count_first",
-    "list_size_midpoint6_count_prev_summr_sum": "list_count_prev",
-    # rate differences
-    "RD_prev_summr_median": "RD_prev_median",
-    "RD_first_summr_median": "RD_first_median",
-}
-combined_seasons_df_results = combined_seasons_df_results.rename(columns=rename_map)
-read_write(read_or_write="write", path=f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}/Results_unweighted", df=combined_seasons_df_results, file_type = 'csv')    
 # # --------------- Describing long-term trend --------------------------------------------
 
 # from scipy import stats
@@ -422,73 +823,3 @@ read_write(read_or_write="write", path=f"output/{config['group']}_measures_{conf
 # )
 
 # log_memory_usage(label="After trend analysis")
-
-# ------------ PRACTICE LEVEL SIGNIFICANCE TESTING ----------------------
-
-# Apply efficiently (no repeated filtering)
-# practice_season_df["test_summer_vs_winter"] = practice_season_df.apply(
-#     lambda row: test_difference(row, agg_df), axis=1
-# )
-
-# breakpoint()
-
-# values = ['numerator_midpoint6_sum', 'list_size_midpoint6_sum', 'numerator_midpoint6_sum_prev_summr', 'list_size_midpoint6_sum_prev_summr']
-# for value in values:
-#     combined_practice_seasons_df = combined_practice_seasons_df[combined_practice_seasons_df[value].notna()]
-#     if 'list_size' in value:
-#         combined_practice_seasons_df = combined_practice_seasons_df[combined_practice_seasons_df[value] > 0]
-
-# def run_poisson_test(row):
-
-#     res = stats.poisson_means_test(
-#         row['numerator_midpoint6_sum'], row['list_size_midpoint6_sum'],
-#         row['numerator_midpoint6_sum_prev_summr'], row['list_size_midpoint6_sum_prev_summr'],
-#         alternative='two-sided'
-#     )
-
-#     return res.pvalue   # or res.statistic
-
-# combined_practice_seasons_df['test_prev_summr'] = combined_practice_seasons_df.apply(run_poisson_test, axis=1)
-
-# breakpoint()
-# # Adjust for multiple testing
-# # Identify non-NaN indices
-# valid_mask = ~np.isnan(practice_season_df["test_summer_vs_winter"])
-# # Run FDR correction only on valid values
-# adj_pvals = np.full_like(
-#     practice_season_df["test_summer_vs_winter"], np.nan, dtype=float
-# )
-# adj_pvals[valid_mask] = stats.false_discovery_control(
-#     practice_season_df["test_summer_vs_winter"][valid_mask], method="bh"
-# )
-# practice_season_df["test_summer_vs_winter_adj"] = adj_pvals
-
-# # Calculate proportion of significant results at measure-season level
-# practice_season_df["signif"] = practice_season_df["test_summer_vs_winter"] < 0.05
-# practice_season_df["signif_adj"] = (
-#     practice_season_df["test_summer_vs_winter_adj"] < 0.05
-# )
-
-# results = build_aggregate_df(
-#     practice_season_df,
-#     ["measure", "season", "pandemic"],
-#     {
-#         "signif": ["sum", "count"],
-#         "signif_adj": ["sum"],
-#     },
-# )
-
-# # Merge with the results df
-# results = season_df.merge(
-#     results, on=["measure", "season", "pandemic"], how="left"
-# )
-# results["signif_%"] = (results["signif_sum"] / results["signif_count"]) * 100
-# results["signif_%_adj"] = (
-#     results["signif_adj_sum"] / results["signif_count"]
-# ) * 100
-
-
-# # Round results
-# results = results.round(2)
-
-# log_memory_usage(label="After practice-level testing data")
@@ -62,6 +62,54 @@ parser.add_argument(
     default=argparse.SUPPRESS,
     help="Uses csv instead of arrow for ease of file inspection",
 )
+parser.add_argument(
+    "--partitioned",
+    action="store_true",
+    default=argparse.SUPPRESS,
+    help="Writes/reads processed measures as a dataset partitioned by measure and year",
+)
+parser.add_argument(
+    "--cache",
+    action="store_true",
+    default=argparse.SUPPRESS,
+    help="Reuses unchanged processed years from a cache kept next to the outputs, for local runs",
+)
+parser.add_argument(
+    "--drop_derived",
+    action="store_true",
+    default=argparse.SUPPRESS,
+    help="Drops month, summer_year, rate and pandemic from processed measures, Python scripts derive them on access",
+)
+parser.add_argument(
+    "--out_of_core",
+    action="store_true",
+    default=argparse.SUPPRESS,
+    help="Normalises one measure at a time, appending to the outputs",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=argparse.SUPPRESS,
+    help="Number of worker processes for per-subgroup processing and per-measure normalization",
+)
+parser.add_argument(
+    "--sketch",
+    action="store_true",
+    default=argparse.SUPPRESS,
+    help="Approximates the practice rate deciles with mergeable quantile sketches in --out_of_core and --workers runs",
+)
+parser.add_argument(
+    "--batch",
+    action="store_true",
+    default=argparse.SUPPRESS,
+    help="Generates national series for every measure and year in national_weekly.py",
+)
+parser.add_argument(
+    "--memory_budget_mb",
+    type=int,
+    default=argparse.SUPPRESS,
+    help="Memory budget in mb used to limit the number of worker processes",
+)
 parser.add_argument(
     "--set",
     default=argparse.SUPPRESS,
@@ -93,6 +141,13 @@ parser.add_argument(
     help="Restrict measures to those with an appointment in interval",
 )
 
+# Select a single benchmark in benchmarks.py
+parser.add_argument(
+    "--benchmark",
+    default=argparse.SUPPRESS,
+    help="Choose which benchmark to run in benchmarks.py (default runs all)",
+)
+
 args = parser.parse_args()  # Stores arguments in 'args'
 
 # Override config with provided args
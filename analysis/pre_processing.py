@@ -6,8 +6,18 @@
 # --set specifies the measure set (appts_table, sro, resp)
 # --released uses already released data
 # --appt restricts measures to those with an appointment in interval
+# --partitioned writes outputs as datasets partitioned by measure and year
+# --workers processes subgroups and years in parallel with this many worker processes
+# --memory_budget_mb caps the number of workers by the estimated memory per subgroup
+# --cache reuses unchanged processed years from a previous local run
+# --drop_derived leaves month, summer_year, rate and pandemic out of the outputs, to be derived on access
+# Also writes a rollup cube of national and regional totals of the input measures next to the outputs
 
 import json
+import multiprocessing
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from scipy import stats
@@ -16,6 +26,7 @@ import argparse
 from datetime import datetime, timedelta
 import os
 from utils import *
+from rollup import *
 import pyarrow.feather as feather
 from parse_args import config
 
@@ -31,101 +42,165 @@ if config["test"]:
     # For testing, use only one date
     dates = [config["test_config"]["start_date"]]
 
-core_columns = ["practice_pseudo_id", "measure", "interval_start", "numerator", "list_size"]
+core_columns = ["practice_pseudo_id", "measure", "interval_start", "numerator", "denominator"]
 
-# -------- Patient measures processing ----------------------------------
-
-# Instantiate list of yearly dataframes for each subgroup
-measures_dict = {}
-    
-for subgroup in config['subgroups']:
-    measures_dict[subgroup] = []
-
-log_memory_usage(label="Before loading data")
-# Load and format data for each interval
-for date in dates:
+measures_dir = f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}"
 
-    print(f"Loading {config['group']} measures {date}", flush=True)
-    input_path = f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}/{config['group']}_measures_{date}"
-    output_path = f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}/proc_{config['group']}_measures_midpoint6"    # Read in measures
-    df = read_write(read_or_write="read", path=input_path, dtype=config["dtype_dict"])
+# Settings that change the processed output. A cached year is only reused when these and its
+# input file are unchanged. Bump cache_version when the processing steps below change.
+processing_config = {
+    "cache_version": 5,
+    "group": config["group"],
+    "dtype_dict": config["dtype_dict"],
+    "test": config["test"],
+    "yearly": config["yearly"],
+    "store_derived": not config["drop_derived"],
+    "rounding_base": 6,
+    "min_list_size": config["min_list_size"],
+    "pandemic_start": config["pandemic_start"],
+    "pandemic_end": config["pandemic_end"],
+}
 
-    df.drop(columns=["interval_end", "ratio"], inplace=True)  # Drop interval end column as not needed for analysis and saves memory
-    log_memory_usage(label=f"After loading measures {date}")
-    print(f"Initial shape of input: {df.shape}", flush=True)
+# -------------- Test cases -----------------------------
 
-    # Rename denominator column to list_size
-    df.rename(columns={"denominator": "list_size"}, inplace=True)
-    print(f"Data types of input: {df.dtypes}", flush=True)
-    nan_counts = df.isna().sum()
-    print(
-        f"""Number of NA's in each columns {nan_counts}\n
-            count without 0 numerator: {df[(df['numerator'] > 0)].shape}\n
-            count without nan numerator: {df[(df['numerator'].notna())].shape}\n
-            count without 0 list_size: {df[(df['list_size'] > 0)].shape}\n
-            count without nan list_size: {df[(df['list_size'].notna())].shape}""",
-        flush=True,
-    )
+if config["test"]:
 
-    # Drop rows with 0 list_size or nan list_size
-    df = df[(df["list_size"] > 0) & (df["list_size"].notna())]
-    print(
-        f"After dropping rows with 0 list_size or nan list_size shape: {df.shape}",
-        flush=True,
-    )
-    
-    # Loop through each subgroup and append the subgroups measures
-    for subgroup in config['subgroups']:
-         
-        core_columns_i = core_columns.copy()
-
-        # Ethnicity_sus needed for imputation
-        if subgroup == "ethnicity":
-            core_columns_i = core_columns_i + ["ethnicity_sus"]
-
-        if config["practice_subgroup_measures"]:
-            subgroup_df = df[df["measure"].str.endswith(subgroup)]
+    # 1 - Integer midpoint rounding agrees with roundmid_any for signed and unsigned dtypes,
+    # with zeros and values at the limits of each dtype, and keeps the dtype when the rounded
+    # values fit it
+    rng = np.random.default_rng(42)
+    for dtype in [np.int8, np.int16, np.int32, np.uint8, np.uint16, np.uint32, np.uint64]:
+        info = np.iinfo(dtype)
+        for to in [1, 2, 3, 5, 6, 7, 10, 100]:
+            values = rng.integers(max(info.min, -1000), min(info.max, 1000), size=1000, endpoint=True)
+            values = values.astype(dtype)
+            values[::10] = 0
+            if info.bits < 64:
+                limits = [info.min, info.min + to, info.max - to, info.max]
+                values = np.concatenate([values, np.array(limits, dtype=dtype)])
+            expected = roundmid_any(values, to=to)
+
+            rounded = roundmid_int(values, to=to)
+            np.testing.assert_array_equal(rounded, expected)
+            if info.min <= expected.min() and expected.max() <= info.max:
+                assert rounded.dtype == dtype
+                in_place = values.copy()
+                assert roundmid_int(in_place, to=to, out=in_place) is in_place
+                np.testing.assert_array_equal(in_place, expected)
+            else:
+                assert rounded.dtype.kind == "i" and rounded.dtype.itemsize > values.dtype.itemsize
+
+            # Arrow arrays keep their type and nulls, for values whose rounded values fit it
+            fits = (info.min <= expected) & (expected <= info.max)
+            values, expected = values[fits], expected[fits]
+            mask = rng.random(len(values)) < 0.1
+            rounded = roundmid_int(pa.array(values, mask=mask), to=to)
+            assert rounded.type == pa.from_numpy_dtype(dtype)
+            assert rounded.null_count == mask.sum()
+            np.testing.assert_array_equal(rounded.to_numpy(zero_copy_only=False)[~mask], expected[~mask])
+
+    # 2 - 64-bit values are rounded exactly up to the limits of int64, beyond which rounding raises
+    int64 = np.iinfo(np.int64)
+    for dtype, values in [
+        (np.int64, [int64.max - 6, int64.min + 6, 0]),
+        (np.uint64, [int64.max - 6, 0]),
+    ]:
+        rounded = roundmid_int(np.array(values, dtype=dtype), to=6)
+        assert rounded.tolist() == [-(-value // 6) * 6 - 3 if value else 0 for value in values]
+        try:
+            roundmid_int(np.array([np.iinfo(dtype).max], dtype=dtype), to=6)
+        except OverflowError:
+            pass
         else:
-            subgroup_df = df
-
-        # Drop unneeded columns from each measure dataframe
-        for col in subgroup_df.columns:
+            raise AssertionError(f"Rounding the maximum {np.dtype(dtype)} should raise")
 
-            # If the column is not the subgroup identifier or a core column, drop it to save memory
-            if (not subgroup.endswith(col)) and (col not in core_columns_i):
-                subgroup_df = subgroup_df.drop(columns=[col])
+# -------- Patient measures processing ----------------------------------
 
-        measures_dict[subgroup].append(subgroup_df)
-    
-    del df
-    log_memory_usage(label=f"After deletion of df")
+# Hash each annual input file once, so every subgroup can look up its cached years. Without
+# --cache no processed year is reused, so the inputs are not hashed
+input_paths = {date: f"{measures_dir}/{config['group']}_measures_{date}" for date in dates}
+input_hashes = {
+    date: file_hash(f"{path}{config['test_suffix']}.arrow") if config["cache"] else ""
+    for date, path in input_paths.items()
+}
+
+
+def process_measures_year(subgroup, date):
+    """
+    Processes one year of one subgroup and rolls its input counts up into a cube. Years are
+    independent, so in parallel mode they run in worker processes that read their own columns
+    straight from the arrow input files.
+    Args:
+        subgroup (str): Subgroup to process.
+        date (str): Start date of the year to process.
+    Returns:
+        tuple: Processed measures of the year and their rollup cube.
+    """
+    print(f"Loading {config['group']} measures {date} for {subgroup}", flush=True)
+
+    # Read only the columns the subgroup needs. Rows with 0 list_size or nan list_size are kept
+    # until the cube is built, so its totals match the raw measures
+    subgroup_df = load_subgroup_measures(
+        path=input_paths[date],
+        subgroups=[subgroup],
+        core_columns=core_columns,
+        practice_subgroup=config["practice_subgroup_measures"],
+        dtype=config["dtype_dict"],
+        drop_empty_list_size=False,
+    )[subgroup]
+    log_memory_usage(label=f"After loading {subgroup} measures {date}")
 
-# Apply pre-processing to each subgroup dataframe
-for subgroup in config['subgroups']:
+    # Rename denominator column to list_size
+    subgroup_df.rename(columns={"denominator": "list_size"}, inplace=True)
 
-    # Save Concatenate yearly intervals into a single dataframe
-    measures_dict[subgroup] = pd.concat(measures_dict[subgroup])
+    # Roll the input counts up to national and regional totals once, so national series can
+    # be queried from the cube instead of rescanning the practice rows
+    cube_df = build_cube(subgroup_df)
+    cube_df.insert(0, "year_start", pd.Timestamp(date))
 
-    print(f"Data types of input: {measures_dict[subgroup].dtypes}", flush=True)
-    log_memory_usage(label=f"After deletion of dataframes")
+    # Drop rows with 0 list_size or nan list_size
+    subgroup_df = subgroup_df[subgroup_df["list_size"] > 0].reset_index(drop=True)
+    print(f"Shape of {subgroup} input: {subgroup_df.shape}", flush=True)
+    print(f"Data types of input: {subgroup_df.dtypes}", flush=True)
 
     if subgroup == "rur_urb_class":
         # Replace numerical values with string values
-        measures_dict[subgroup] = replace_nums(measures_dict[subgroup], replace_ethnicity=False, replace_rur_urb=True)
+        subgroup_df = replace_nums(subgroup_df, replace_ethnicity=False, replace_rur_urb=True)
 
     if subgroup == "ethnicity":
+        ethnicity_totals = subgroup_df[["numerator", "list_size"]].sum()
         # Replace numerical values with string values
-        measures_dict[subgroup] = replace_nums(measures_dict[subgroup], replace_ethnicity=True, replace_rur_urb=False)
+        subgroup_df = replace_nums(subgroup_df, replace_ethnicity=True, replace_rur_urb=False)
+
+        if config["test"]:
+            # 1 - Recoding only merges ethnicity levels, so the totals are unchanged
+            assert (subgroup_df[["numerator", "list_size"]].sum() == ethnicity_totals).all()
+
+            # 2 - Recorded codes are used first, '6' and missing codes fall back to SUS
+            test_df = recode_ethnicity(pd.DataFrame({
+                "measure": pd.Categorical(["seen_in_interval_ethnicity"] * 5),
+                "interval_start": pd.Timestamp(date),
+                "practice_pseudo_id": 1,
+                "ethnicity": pd.Series(["1", "6", "6", None, "6"], dtype="string"),
+                "ethnicity_sus": pd.Series(["H", "A", "H", "M", None], dtype="string"),
+                "numerator": [1, 2, 4, 8, 16],
+                "list_size": [10, 20, 40, 80, 160],
+            }))
+            print("Test Output of recoded ethnicity:")
+            print(test_df)
+            test_counts = test_df.set_index("ethnicity")["numerator"]
+            assert test_counts[["White", "South Asian", "Black"]].tolist() == [3, 4, 8]
+            assert test_df.loc[test_df["ethnicity"].isna(), "numerator"].tolist() == [16]
 
 
     if config["test"]:
         np.random.seed(42)  # For reproducibility in testing
         # Increase numerator and list_size for testing of downstream functions
-        measures_dict[subgroup]["numerator"] = np.random.randint(0, 500, size=len(measures_dict[subgroup]))
-        measures_dict[subgroup]["list_size"] = np.random.randint(500, 1000, size=len(measures_dict[subgroup]))
+        subgroup_df["numerator"] = np.random.randint(0, 500, size=len(subgroup_df))
+        subgroup_df["list_size"] = np.random.randint(500, 1000, size=len(subgroup_df))
 
         # Simulate extra data for downstream testing
-        print(measures_dict[subgroup]["interval_start"].unique())
+        print(subgroup_df["interval_start"].unique())
         print("Simulating practice measures data for testing")
 
         # Define number of repeats and time delta based on yearly or weekly config
@@ -139,106 +214,217 @@ for subgroup in config['subgroups']:
         # Generate extended rows by shifting weeks and randomizing values
         extended_rows = []
         for i in range(1, n_intervals + 1):
-            df_copy = measures_dict[subgroup].copy()
+            df_copy = subgroup_df.copy()
             df_copy["interval_start"] = df_copy["interval_start"] + timedelta(weeks=time_delta_weeks * i)
             df_copy["numerator"] = np.random.randint(0, 500, size=len(df_copy))
             df_copy["list_size"] = np.random.randint(500, 1000, size=len(df_copy))
             extended_rows.append(df_copy)
 
         # Combine original and simulated rows
-        measures_dict[subgroup] = pd.concat([measures_dict[subgroup]] + extended_rows, ignore_index=True)
+        subgroup_df = pd.concat([subgroup_df] + extended_rows, ignore_index=True)
 
         # Sample 10 unique practice_pseudo_ids
-        test_practices = pd.Series(measures_dict[subgroup]["practice_pseudo_id"].unique()).sample(10)
-        measures_dict[subgroup] = measures_dict[subgroup][measures_dict[subgroup]["practice_pseudo_id"].isin(test_practices)]
+        test_practices = pd.Series(subgroup_df["practice_pseudo_id"].unique()).sample(10)
+        subgroup_df = subgroup_df[subgroup_df["practice_pseudo_id"].isin(test_practices)]
 
         # Set values in 'numerator' column to 0 for the selected rows to simulate real data missingness
         # Define mask for conditional rows
-        mask = (measures_dict[subgroup]["measure"] == "online_consult") & (
-            measures_dict[subgroup]["interval_start"] < "2016-11-30"
+        mask = (subgroup_df["measure"] == "online_consult") & (
+            subgroup_df["interval_start"] < "2016-11-30"
         )
         # Get indices that meet condition
-        matching_indices = measures_dict[subgroup][mask].index
-        measures_dict[subgroup].loc[matching_indices, "numerator"] = 0
+        matching_indices = subgroup_df[mask].index
+        subgroup_df.loc[matching_indices, "numerator"] = 0
 
         # Drop some rows to simulate real data missingness
         # Define mask for conditional rows
-        mask = (measures_dict[subgroup]["measure"] == "call_from_gp") & (
-            measures_dict[subgroup]["interval_start"] < "2016-11-30"
+        mask = (subgroup_df["measure"] == "call_from_gp") & (
+            subgroup_df["interval_start"] < "2016-11-30"
         )
         # Get indices that meet condition
-        matching_indices = measures_dict[subgroup][mask].index
+        matching_indices = subgroup_df[mask].index
         # Drop rows
-        measures_dict[subgroup] = measures_dict[subgroup].drop(matching_indices)
+        subgroup_df = subgroup_df.drop(matching_indices)
         # Drop duplicates
-        measures_dict[subgroup] = pd.concat([measures_dict[subgroup]] + extended_rows, ignore_index=True)
-        measures_dict[subgroup] = measures_dict[subgroup].drop_duplicates(
+        subgroup_df = pd.concat([subgroup_df] + extended_rows, ignore_index=True)
+        subgroup_df = subgroup_df.drop_duplicates(
             subset=["practice_pseudo_id", "measure", "interval_start"]
         )
 
-        print(measures_dict[subgroup].head())
+        print(subgroup_df.head())
 
     # Remove intervals before the first summer reference period
-    measures_dict[subgroup] = measures_dict[subgroup][measures_dict[subgroup]["interval_start"] > "2016-05-31"]
+    subgroup_df = subgroup_df[subgroup_df["interval_start"] > "2016-05-31"]
 
-    # Remove practices with < 750 list size
+    # Remove practices with a small list size
     if config["practice_measures"]:
         print(
-            f"Number of practices before filtering: {measures_dict[subgroup]['practice_pseudo_id'].nunique()}",
+            f"Number of practices before filtering: {subgroup_df['practice_pseudo_id'].nunique()}",
             flush=True,
         )
-        measures_dict[subgroup] = measures_dict[subgroup][(measures_dict[subgroup]["list_size"] > 750)]
+        subgroup_df = subgroup_df[(subgroup_df["list_size"] > processing_config["min_list_size"])]
         print(
-            f"Number of practices after filtering: {measures_dict[subgroup]['practice_pseudo_id'].nunique()}",
+            f"Number of practices after filtering: {subgroup_df['practice_pseudo_id'].nunique()}",
             flush=True,
         )
 
     # Round measures using midpoint 6 rounding
-    print(f"Before rounding: {measures_dict[subgroup].head()}")
-
-    # Round the numerator and list_size columns
-    measures_dict[subgroup][["numerator_midpoint6", "list_size_midpoint6"]] = roundmid_any(measures_dict[subgroup][["numerator", "list_size"]], to=6)
-    measures_dict[subgroup].drop(columns=["numerator", "list_size"], inplace=True)  # Drop original columns to save memory
+    print(f"Before rounding: {subgroup_df.head()}")
+
+    # Round the numerator and list_size columns, in place where possible to keep integer counts
+    for col in ["numerator", "list_size"]:
+        counts = subgroup_df.pop(col).to_numpy()  # Remove original column to save memory
+        if counts.dtype.kind in "iu":
+            out = counts if counts.flags.writeable else None
+            subgroup_df[f"{col}_midpoint6"] = roundmid_int(counts, to=processing_config["rounding_base"], out=out)
+        else:
+            # Counts with missing values are read as floats
+            subgroup_df[f"{col}_midpoint6"] = roundmid_any(counts, to=processing_config["rounding_base"])
 
-    print(f"After rounding: {measures_dict[subgroup].head()}")
+    print(f"After rounding: {subgroup_df.head()}")
 
     # Ensure correct datetime format
-    measures_dict[subgroup]["interval_start"] = pd.to_datetime(
-        measures_dict[subgroup]["interval_start"]
+    subgroup_df["interval_start"] = pd.to_datetime(
+        subgroup_df["interval_start"]
     ).dt.tz_localize(None)
-    measures_dict[subgroup]["month"] = measures_dict[subgroup]["interval_start"].dt.month
-    # If Jan - May, RR is relative to prev years summer. If June - Dec, RR is relative to same years summer.
-    measures_dict[subgroup]["summer_year"] = np.where(
-        measures_dict[subgroup]["month"] <= 5,
-        measures_dict[subgroup]["interval_start"].dt.year - 1,
-        measures_dict[subgroup]["interval_start"].dt.year,
-    )
-
-    # Calculate rate per 1000
-    measures_dict[subgroup]["rate_per_1000_midpoint6_derived"] = (
-        measures_dict[subgroup]["numerator_midpoint6"]
-        / measures_dict[subgroup]["list_size_midpoint6"]
-        * 1000
-    )
-
-    # Define pandemic dates
-    pandemic_conditions = [
-        measures_dict[subgroup]["interval_start"] < pd.to_datetime(config["pandemic_start"]),
-        (measures_dict[subgroup]["interval_start"] >= pd.to_datetime(config["pandemic_start"]))
-        & (measures_dict[subgroup]["interval_start"] <= pd.to_datetime(config["pandemic_end"])),
-        measures_dict[subgroup]["interval_start"] > pd.to_datetime(config["pandemic_end"]),
-    ]
-    choices = ["Before", "During", "After"]
-    measures_dict[subgroup]["pandemic"] = np.select(pandemic_conditions, choices)
 
+    if not config["drop_derived"]:
+        # Store the derived columns, with --drop_derived Python scripts derive them on access with df.wp
+        subgroup_df = subgroup_df.wp.add("month", "summer_year", "rate", "pandemic")
+
+    # Apply the dtype policy: smallest safe integer counts and ordered categorical periods
+    before_mb = subgroup_df.memory_usage(deep=True).sum() / 1024**2
+    subgroup_df = compact_dtypes(subgroup_df)
+    after_mb = subgroup_df.memory_usage(deep=True).sum() / 1024**2
+    print(f"In-memory size of {subgroup} {date}: {before_mb:.2f} mb before, {after_mb:.2f} mb after dtype policy", flush=True)
+    print(f"Data types of output: {subgroup_df.dtypes}", flush=True)
+    log_memory_usage(label=f"After processing {subgroup} measures {date}")
+    return subgroup_df, cube_df
+
+
+def process_year(task):
+    """
+    Processes one year of one subgroup and caches the processed rows and their rollup cube,
+    reusing the cached year when its input and settings are unchanged.
+    Args:
+        task (tuple): Subgroup and start date of the year to process.
+    Returns:
+        tuple: Cache paths of the processed year and of its cube, without extension.
+    """
+    subgroup, date = task
+    yearly_path = cache_path(cache_dir, f"{subgroup}_{date}", input_hashes[date], processing_config)
+    cube_yearly_path = cache_path(cache_dir, f"{subgroup}_cube_{date}", input_hashes[date], processing_config)
+    if os.path.exists(yearly_path + ".arrow") and os.path.exists(cube_yearly_path + ".arrow"):
+        print(f"Reusing processed {subgroup} measures {date}", flush=True)
+        return yearly_path, cube_yearly_path
+
+    subgroup_df, cube_df = process_measures_year(subgroup, date)
+    write_cache(cube_df, cube_yearly_path)
+    write_cache(subgroup_df, yearly_path)
+    del subgroup_df, cube_df  # Delete dataframes to save memory
+    return yearly_path, cube_yearly_path
+
+
+def process_subgroup(subgroup):
+    """
+    Processes every year of one subgroup and writes the subgroup output and its rollup cube.
+    Without a cache directory the years are kept in memory, otherwise cached years are reused.
+    In parallel mode this runs in a worker process, so no dataframes are pickled between
+    processes.
+    Args:
+        subgroup (str): Subgroup to process.
+    Returns:
+        str: Path of the written output, without extension.
+    """
+    if cache_dir is None:
+        yearly_dfs, cube_dfs = map(list, zip(*[process_measures_year(subgroup, date) for date in dates]))
+    else:
+        # Years already processed in parallel are reused from the cache
+        yearly_paths, cube_paths = zip(*[process_year((subgroup, date)) for date in dates])
+        yearly_dfs = [
+            read_write(read_or_write="read", path=path, file_type='arrow', test=False) for path in yearly_paths
+        ]
+        cube_dfs = [
+            read_write(read_or_write="read", path=path, file_type='arrow', test=False) for path in cube_paths
+        ]
+
+    # Concatenate processed years into a single file
+    subgroup_df = concat_categorical(yearly_dfs)
+    del yearly_dfs
     log_memory_usage(label=f"Final memory usage") # test is 10 times higher for practice_subgroups
 
     # Save processed file
+    output_path = f"{measures_dir}/proc_{config['group']}_measures_midpoint6"
     if config['practice_subgroup_measures']:
         output_path_subgroup = output_path + f"_{subgroup}"
     elif config['practice_measures']:
         output_path_subgroup = output_path
 
-    read_write(read_or_write="write", path=output_path_subgroup, df=measures_dict[subgroup], file_type='arrow')
-    del measures_dict[subgroup]  # Delete dataframe to save memory
+    if config["partitioned"]:
+        # Partition by measure and year so downstream scripts can skip unneeded partitions
+        write_partitioned(subgroup_df, output_path_subgroup)
+    else:
+        read_write(read_or_write="write", path=output_path_subgroup, df=subgroup_df, file_type='arrow')
+    del subgroup_df  # Delete dataframe to save memory
     log_memory_usage(label=f"After saving and deleting {subgroup} dataframe")
+
+    # Save the rollup cube of every year
+    cube_df = concat_categorical(cube_dfs)
+    cube_path_subgroup = f"{measures_dir}/cube_{config['group']}_measures"
+    if config['practice_subgroup_measures']:
+        cube_path_subgroup += f"_{subgroup}"
+    read_write(read_or_write="write", path=cube_path_subgroup, df=cube_df, file_type='arrow')
+
+    if config["partitioned"]:
+        output_size_mb = path_size_mb(f"{output_path_subgroup}{config['test_suffix']}")
+    else:
+        output_size_mb = path_size_mb(f"{output_path_subgroup}{config['test_suffix']}.arrow")
+    print(f"Size of {output_path_subgroup}: {output_size_mb:.2f} mb", flush=True)
+
+    return output_path_subgroup
+
+
+log_memory_usage(label="Before loading data")
+
+# Subgroups and years are independent, so they can be processed in parallel. Limit the number of
+# workers so that the estimated memory of the concurrent subgroups stays within the memory budget
+tasks = [(subgroup, date) for subgroup in config["subgroups"] for date in dates]
+n_workers = min(config["workers"], len(tasks))
+if config["memory_budget_mb"] is not None and n_workers > 1:
+    input_mb = sum(
+        os.path.getsize(f"{path}{config['test_suffix']}.arrow") for path in input_paths.values()
+    ) / 1024**2
+    # A worker holds its share of every year before and after processing, plus the final concat
+    worker_mb = 4 * input_mb / len(config["subgroups"])
+    n_workers = max(1, min(n_workers, int(config["memory_budget_mb"] // worker_mb)))
+print(f"Processing {len(config['subgroups'])} subgroups of {len(dates)} years with {n_workers} worker(s)", flush=True)
+
+if config["cache"]:
+    # Only local runs keep this directory between runs, it is not a declared output so the
+    # job server discards it
+    cache_dir = f"{measures_dir}/proc_cache"
+    os.makedirs(cache_dir, exist_ok=True)
+elif n_workers > 1:
+    # Workers hand their processed years to the subgroup concatenation through a temporary
+    # directory, which is removed at the end of the run
+    cache_dir = tempfile.mkdtemp()
+else:
+    # Processed years are kept in memory until each subgroup's years are concatenated
+    cache_dir = None
+
+try:
+    if n_workers > 1:
+        # Fork so workers inherit the configuration and input hashes without re-running this script.
+        # Process every year of every subgroup first, so a single subgroup still uses every worker,
+        # then concatenate the cached years of each subgroup
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            for yearly_path, cube_yearly_path in pool.map(process_year, tasks):
+                print(f"Cached {yearly_path}", flush=True)
+            for output_path_subgroup in pool.map(process_subgroup, config["subgroups"]):
+                print(f"Saved {output_path_subgroup}", flush=True)
+    else:
+        for subgroup in config["subgroups"]:
+            process_subgroup(subgroup)
+finally:
+    if cache_dir is not None and not config["cache"]:
+        shutil.rmtree(cache_dir, ignore_errors=True)
@@ -0,0 +1,274 @@
+# This module rolls practice-interval measures up to coarser periods and levels.
+# It is shared by the scripts that aggregate weekly practice rows, so they use the same
+# denominator rules and one optimised implementation.
+# USAGE: from rollup import *
+
+import numpy as np
+import pandas as pd
+from utils import *
+
+# Period columns added by period_columns
+periods = {
+    "week": ["interval_start"],
+    "month": ["month_start"],
+    "season": ["summer_year", "season"],
+    "summer_year": ["summer_year"],
+    "year": ["year"],
+    "financial_year": ["financial_year"],
+    "all": [],
+}
+
+# Denominator policies: the sum over weeks, the value of the earliest week or the number of weeks
+denominator_policies = ["sum", "first", "count"]
+
+
+def period_columns(df, period):
+    """
+    Gets the calendar period columns of each interval, to roll weekly rows up by.
+    Args:
+        df (pd.DataFrame): Dataframe with an interval_start column.
+        period (str): One of 'week', 'month', 'season' (season within its summer year, from
+            config["seasons"]), 'summer_year', 'year', 'financial_year' (starting in April) or
+            'all' to roll every interval up together.
+    Returns:
+        dict: Period column name to pd.Series, aligned with df.
+    """
+    if period == "week":
+        return {"interval_start": df["interval_start"]}
+    if period == "month":
+        month_start = df["interval_start"].to_numpy().astype("datetime64[M]").astype("datetime64[ns]")
+        return {"month_start": pd.Series(month_start, index=df.index)}
+    if period == "season":
+        return {"summer_year": df.wp.summer_year, "season": df.wp.season}
+    if period == "summer_year":
+        return {"summer_year": df.wp.summer_year}
+    if period == "year":
+        return {"year": df.wp.year}
+    if period == "all":
+        return {}
+    if period == "financial_year":
+        financial_year = (df.wp.year.to_numpy() - (df.wp.month.to_numpy() <= 3)).astype(np.int16)
+        return {"financial_year": pd.Series(financial_year, index=df.index)}
+    raise ValueError(f"Unknown period {period}, expected one of {list(periods)}")
+
+
+class RollupIndex:
+    """
+    Index of practice-interval rows shared by every rollup of a frame. It holds the codes
+    of the grouping and period columns and, once a rollup needs it, the time order of the
+    rows, so several periods and levels can be rolled up without refactorising or resorting.
+    """
+
+    def __init__(self, df, numerator="numerator_midpoint6", denominator="list_size_midpoint6", cache=None):
+        """
+        Args:
+            df (pd.DataFrame): Practice-interval rows with measure, practice_pseudo_id and
+                interval_start columns.
+            numerator (str): Column to sum.
+            denominator (str): Column the denominator policies apply to.
+            cache (dict): Optional codes cache to share with other aggregations of df,
+                see factorize_groups.
+        """
+        self.df = df
+        self.numerator = numerator
+        self.denominator = denominator
+        self.cache = {} if cache is None else cache
+        self.dates = df["interval_start"].to_numpy().view(np.int64)
+        self._time_order = None
+        self._time_rank = None
+
+    def period(self, period):
+        """
+        Factorises the period columns into the codes cache on first use.
+        Args:
+            period (str): Calendar period, see period_columns.
+        Returns:
+            list: Names of the period columns.
+        """
+        if period not in periods:
+            raise ValueError(f"Unknown period {period}, expected one of {list(periods)}")
+        if any(col not in self.cache for col in periods[period]):
+            for col, values in period_columns(self.df, period).items():
+                self.cache.setdefault(col, factorize_column(values))
+        return periods[period]
+
+    def time_order(self):
+        """
+        Sorts the rows by interval_start on first use, unless they are already sorted.
+        Returns:
+            tuple: Row positions in time order and the time rank of each row.
+        """
+        if self._time_order is None:
+            if (np.diff(self.dates) >= 0).all():
+                self._time_order = np.arange(len(self.dates))
+                self._time_rank = self._time_order
+            else:
+                self._time_order = np.argsort(self.dates, kind="stable")
+                self._time_rank = np.empty(len(self.dates), dtype=np.int64)
+                self._time_rank[self._time_order] = np.arange(len(self.dates))
+        return self._time_order, self._time_rank
+
+    def reduce(self, strata, policies):
+        """
+        Sums the numerator and applies the denominator policies per group in a single pass.
+        Processed measures are written in time order within each practice, so the first row of
+        each group is usually its earliest interval. This is checked in linear time and the
+        rows are only sorted by interval_start when it does not hold.
+        Args:
+            strata (list): Columns to group by, including practice_pseudo_id for 'first'.
+            policies (list): Denominator policies, see denominator_policies.
+        Returns:
+            pd.DataFrame: One row per group in sorted key order, with '{numerator}_sum' and
+                '{denominator}_{policy}' columns.
+        """
+        codes, n_groups, keys_df = factorize_groups(self.df, strata, self.cache)
+        reduced_df = keys_df.copy()
+
+        rows = np.flatnonzero(codes >= 0)
+        all_rows = len(rows) == len(codes)
+        codes = codes[rows]
+
+        def column(col):
+            return self.df[col] if all_rows else self.df[col].iloc[rows]
+
+        reduced_df[f"{self.numerator}_sum"] = reduce_groups(column(self.numerator), codes, n_groups, "sum")
+        for policy in policies:
+            if policy == "first":
+                first_row = np.full(n_groups, len(self.dates), dtype=np.int64)
+                np.minimum.at(first_row, codes, rows)
+                earliest = np.full(n_groups, np.iinfo(np.int64).max, dtype=np.int64)
+                np.minimum.at(earliest, codes, self.dates[rows])
+                if not np.array_equal(self.dates[first_row], earliest):
+                    time_order, time_rank = self.time_order()
+                    first_rank = np.full(n_groups, len(self.dates), dtype=np.int64)
+                    np.minimum.at(first_rank, codes, time_rank[rows])
+                    first_row = time_order[first_rank]
+                values = self.df[self.denominator].to_numpy()[first_row]
+            else:
+                values = reduce_groups(column(self.denominator), codes, n_groups, policy)
+            reduced_df[f"{self.denominator}_{policy}"] = values
+        return reduced_df
+
+
+def rollup(index, period="year", level="practice", denominator="first", subgroup=None, by=None, order=None):
+    """
+    Rolls practice-interval rows up to a calendar period and level.
+    Denominator policies are applied per practice and then summed over the practices of
+    the level, so a 'first' national list size is the sum of each practice's list size in
+    its earliest week.
+    Args:
+        index (RollupIndex): Index of the practice-interval rows.
+        period (str): Calendar period, see period_columns.
+        level (str): One of 'practice', 'subgroup', 'region' or 'national'. Every level is
+            also split by measure.
+        denominator (str or list): Denominator policy or policies: 'sum' over weeks, 'first'
+            for the earliest week or 'count' of weeks.
+        subgroup (str): Subgroup column, required for the 'subgroup' level. At practice
+            level it splits each practice by subgroup.
+        by (list): Other columns to keep as keys, e.g. ['pandemic'].
+        order (list): Optional order of all the key columns, which sets the row order.
+            Default is the level keys, then by and then the period columns.
+    Returns:
+        pd.DataFrame: One row per key combination with '{numerator}_sum' and
+            '{denominator}_{policy}' columns. Practice rows have 'zero_indicator' (1 when the
+            numerator sum is zero), higher levels 'n_practices' and 'n_practices_zero'.
+            'rate_per_1000' uses the first 'sum' or 'first' denominator.
+    """
+    policies = [denominator] if isinstance(denominator, str) else list(denominator)
+    unknown = [policy for policy in policies if policy not in denominator_policies]
+    if unknown:
+        raise ValueError(f"Unknown denominator policies {unknown}, expected {denominator_policies}")
+    if level == "subgroup" and subgroup is None:
+        raise ValueError("Rolling up to subgroup level needs a subgroup column")
+    level_keys = {
+        "practice": ["measure", "practice_pseudo_id"] + ([subgroup] if subgroup is not None else []),
+        "subgroup": ["measure", subgroup],
+        "region": ["measure", "region"],
+        "national": ["measure"],
+    }
+    if level not in level_keys:
+        raise ValueError(f"Unknown level {level}, expected one of {list(level_keys)}")
+
+    strata = level_keys[level] + list(by or []) + index.period(period)
+    if order is not None:
+        if sorted(order) != sorted(strata):
+            raise ValueError(f"order must list the key columns {strata}")
+        strata = list(order)
+
+    numerator = f"{index.numerator}_sum"
+    denominators = [f"{index.denominator}_{policy}" for policy in policies]
+    if level == "practice":
+        rollup_df = index.reduce(strata, policies)
+        rollup_df["zero_indicator"] = np.where(rollup_df[numerator] == 0, 1, 0)
+    else:
+        # Apply the denominator policies per practice, then sum the practices
+        practice_df = index.reduce(["practice_pseudo_id"] + strata, policies)
+        codes, n_groups, rollup_df = factorize_groups(practice_df, strata)
+        for col in [numerator] + denominators:
+            rollup_df[col] = reduce_groups(practice_df[col], codes, n_groups, "sum")
+        rollup_df["n_practices"] = np.bincount(codes, minlength=n_groups)
+        rollup_df["n_practices_zero"] = np.bincount(
+            codes, weights=practice_df[numerator].to_numpy() == 0, minlength=n_groups
+        ).astype(np.int64)
+
+    rate_denominators = [col for col, policy in zip(denominators, policies) if policy != "count"]
+    if rate_denominators:
+        rollup_df["rate_per_1000"] = rollup_df[numerator] / rollup_df[rate_denominators[0]] * 1000
+    return rollup_df
+
+
+def build_cube(df, numerator="numerator", denominator="list_size"):
+    """
+    Builds a rollup cube of practice-interval rows: national totals per measure and, when the
+    rows have a region column, regional totals, with practice counts. Totals are given for each
+    interval and for all intervals together, so national series can be queried from the cube
+    instead of rescanning the practice rows.
+    Args:
+        df (pd.DataFrame): Practice-interval rows, e.g. one year of measures.
+        numerator (str): Column to sum.
+        denominator (str): Column to sum, and to take from each practice's earliest interval.
+    Returns:
+        pd.DataFrame: Cube rows with 'period' ('week' or 'all'), 'level' ('national' or
+            'region'), 'region', 'measure' and 'interval_start' keys, where interval_start of
+            'all' rows is the first interval of df. Values are '{numerator}_sum',
+            '{denominator}_sum', '{denominator}_first', 'n_practices' and 'n_practices_zero'.
+    """
+    index = RollupIndex(df, numerator=numerator, denominator=denominator)
+    levels = ["national", "region"] if "region" in df.columns else ["national"]
+    parts = []
+    for period in ["week", "all"]:
+        for level in levels:
+            part = rollup(index, period=period, level=level, denominator=["sum", "first"])
+            part = part.drop(columns="rate_per_1000").assign(period=period, level=level)
+            if period == "all":
+                part["interval_start"] = df["interval_start"].min()
+            parts.append(part)
+
+    cube_df = pd.concat(parts, ignore_index=True)
+    if "region" not in cube_df.columns:
+        cube_df["region"] = None
+    keys = ["period", "level", "region", "measure", "interval_start"]
+    return cube_df[keys + [col for col in cube_df.columns if col not in keys]]
+
+
+def query_cube(cube_df, period="week", level="national", measures=None):
+    """
+    Selects national or regional totals from a rollup cube.
+    Args:
+        cube_df (pd.DataFrame): Output of build_cube.
+        period (str): 'week' for totals per interval or 'all' for totals over every interval.
+        level (str): 'national' or 'region'.
+        measures (list): Optional measures to keep.
+    Returns:
+        pd.DataFrame: Matching cube rows without the period and level columns, sorted by the
+            remaining keys.
+    """
+    keep = (cube_df["period"] == period) & (cube_df["level"] == level)
+    if measures is not None:
+        keep &= cube_df["measure"].isin(measures)
+    query_df = cube_df[keep].drop(columns=["period", "level"])
+    keys = ["region", "measure", "interval_start"]
+    if level == "national":
+        query_df = query_df.drop(columns="region")
+        keys = keys[1:]
+    return query_df.sort_values(keys, kind="stable").reset_index(drop=True)
@@ -1,22 +1,25 @@
 # This script sense checks test jobs by aggregating up to national level
 # to see if the measures worked (produced non-zero totals).
+# It reads the national totals from the rollup cube written by pre_processing.py.
 # Not used as part of the actual deployment pipeline.
 
 import pandas as pd
 from utils import *
+from rollup import *
 import pyarrow.feather as feather
 from parse_args import *
 import numpy as np
 
-# Load and format data for each interval
-print(f"Loading {config['group']} measures {config['test_config']['start_date']}", flush=True)
-input_path = f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}/{config['group']}_measures_{config['test_config']['start_date']}"
+# Load the national totals of the interval from the rollup cube written by pre_processing.py
+print(f"Loading {config['group']} measures cube {config['test_config']['start_date']}", flush=True)
+input_path = f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}/cube_{config['group']}_measures"
 output_path = f"output/{config['group']}_measures_{config['set']}{config['appt_suffix']}{config['agg_suffix']}/sense_check_{config['group']}_{config['test_config']['start_date']}"
-df = read_write(read_or_write="read", path=input_path)
+cube_df = read_write(read_or_write="read", path=input_path)
+cube_df = cube_df[cube_df["year_start"] == config['test_config']['start_date']]
 
-# Aggregate data to national level
-df = df.groupby(["measure", "interval_start"]).agg({"numerator": ["sum"], "denominator": ["sum"]})
-# Flatten column headings
-df.columns = df.columns.get_level_values(0)
+# National totals per measure and interval
+df = query_cube(cube_df, period="week", level="national")
+df = df.rename(columns={"numerator_sum": "numerator", "list_size_sum": "denominator"})
+df = df.set_index(["measure", "interval_start"])[["numerator", "denominator"]]
 df['ratio'] = (df['numerator'] / df['denominator'])*100000
 read_write(read_or_write="write", path=output_path, file_type="csv", df=df)
@@ -1,8 +1,15 @@
 from datetime import datetime, timedelta
+import glob
+import hashlib
+import json
+import os
 import resource
 import pandas as pd
 import numpy as np
 from scipy import stats
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.feather as feather
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -66,30 +73,8 @@ def replace_nums(df, replace_ethnicity=True, replace_rur_urb=True, **kwargs):
     # Reformat rur_urb column
     if replace_rur_urb:
         print(f"Replacing rur_urb, prior values:, {df['rur_urb_class'].unique()}")
-        # Convert string col to category for efficiency
-        df["rur_urb_class"] = df["rur_urb_class"].astype("string")
-        df["rur_urb_class"] = df["rur_urb_class"].astype("category")
-        df["rur_urb_class"] = df["rur_urb_class"].cat.add_categories(
-            ["Urban", "Rural", "Unknown"]
-        )
-        df["rur_urb_class"].fillna("Unknown", inplace=True)
-        # Aggregate urban and rural subcategories
-        df["rur_urb_class"] = (
-            df["rur_urb_class"]
-            .replace(
-                {
-                    "1": "Urban",
-                    "2": "Urban",
-                    "3": "Urban",
-                    "4": "Urban",  # Urban = 1
-                    "5": "Rural",
-                    "6": "Rural",
-                    "7": "Rural",
-                    "8": "Rural",  # Rural = 2
-                }
-            )
-            .fillna("Unknown")
-        )
+        # Build the Urban/Rural/Unknown categorical straight from the integer classes
+        df["rur_urb_class"] = recode_rur_urb(df["rur_urb_class"])
         print(f"New datatype of rur_urb: {df['rur_urb_class'].dtype}")
         print(f"Post-replace values:, {df['rur_urb_class'].unique()}")
 
@@ -98,110 +83,741 @@ def replace_nums(df, replace_ethnicity=True, replace_rur_urb=True, **kwargs):
         # 'Demograph measures' will require not filtering on measures with 'ethnicity' in the name
         if config["practice_subgroup_measures"] == True:
 
-            print(f"Replacing ethnicity, prior valuess:, {df['ethnicity'].unique()}")
-            df_ethnicity = df[df["measure"].str.contains("ethnicity", case=False, na=False)]
-            # Identify missing values
-            df_ethnicity["ethnicity"].replace("6", pd.NA, inplace=True)
-            print(f"Prior Nan count: {df_ethnicity['ethnicity'].isna().sum()}")
-            # Fill missing values with values from sus_ethnicity
-            df_ethnicity["ethnicity"] = df_ethnicity["ethnicity"].fillna(df_ethnicity["ethnicity_sus"])
-            # Convert string col to category for efficiency
-            df_ethnicity["ethnicity"] = df_ethnicity["ethnicity"].astype("category")
-            # Reformat ethnicity data
-            df_ethnicity["ethnicity"] = df_ethnicity["ethnicity"].cat.add_categories(
-                ["White", "Mixed", "South Asian", "Black", "Other", "Not stated"]
-            )
-            df_ethnicity["ethnicity"].replace(
-                {
-                    "1": "White",
-                    "2": "Mixed",
-                    "3": "South Asian",
-                    "4": "Black",
-                    "5": "Other",
-                    "A": "White",
-                    "B": "White",
-                    "C": "White",
-                    "D": "Mixed",
-                    "E": "Mixed",
-                    "F": "Mixed",
-                    "G": "Mixed",
-                    "H": "South Asian",
-                    "J": "South Asian",
-                    "K": "South Asian",
-                    "L": "South Asian",
-                    "M": "Black",
-                    "N": "Black",
-                    "P": "Black",
-                    "R": "Other",
-                    "S": "Other",
-                    "Z": "Not stated",
-                },
-                inplace=True,
-            )
-            # Impute missing ethnicity with ethnicity sus
-            df_ethnicity["ethnicity"] = df_ethnicity["ethnicity"].fillna(df_ethnicity["ethnicity_sus"])
-            print(f"New datatype of ethnicity: {df_ethnicity['ethnicity'].dtype}")
-            print(f"Post-replace Nan count: {df_ethnicity['ethnicity'].isna().sum()}")
-            print(f"Post-replace ehtnicity values:, {df_ethnicity['ethnicity'].unique()}")
-            df = df.drop("ethnicity_sus", axis=1)
-            df_ethnicity = df_ethnicity.drop("ethnicity_sus", axis=1)
-
-            # Aggregate ethnicity categories
-            group_cols = [
-                col for col in df_ethnicity.columns if col not in ["numerator", "list_size"]
-            ]
-            df_ethnicity = df_ethnicity.groupby(group_cols, as_index=False, observed=True, dropna=False)[
+            df = recode_ethnicity(df)
+
+    return df
+
+
+def recode_rur_urb(values):
+    """
+    Recodes rural urban classes into an Urban/Rural/Unknown categorical using a lookup array on
+    the integer values, without converting the column to strings. Classes 1-4 are Urban,
+    5-8 Rural and missing values Unknown. Any other class is kept as its own category.
+    Args:
+        values (pd.Series): Integer (nullable) rural urban classes.
+    Returns:
+        pd.Categorical: Recoded classes.
+    """
+    labels = ["Urban", "Rural", "Unknown"]
+    missing = values.isna().to_numpy()
+    classes = values.to_numpy(dtype=np.int64, na_value=0)
+    in_range = (classes >= 1) & (classes <= 8)
+
+    # Unrecognised classes come first as strings, in sorted order, matching a string recode
+    unrecognised = np.unique(classes[~in_range & ~missing])
+    categories = sorted(str(value) for value in unrecognised) + labels
+    n_unrecognised = len(unrecognised)
+
+    lookup = np.full(10, n_unrecognised + 2)  # Unknown
+    lookup[1:5] = n_unrecognised  # Urban
+    lookup[5:9] = n_unrecognised + 1  # Rural
+    codes = lookup[np.clip(classes, 0, 9)]
+    codes[missing] = n_unrecognised + 2
+    if n_unrecognised:
+        other = ~in_range & ~missing
+        codes[other] = pd.Index(categories).get_indexer(classes[other].astype(str))
+
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+
+def recode_ethnicity(df, measure_col="measure"):
+    """
+    Recodes ethnicity into the five ethnicity groups plus 'Not stated', imputing missing values
+    from ethnicity_sus, and re-aggregates counts for ethnicity measures one measure at a time.
+    Values are recoded by remapping category codes, so strings are never replaced row by row,
+    and only one measure's rows are copied at a time.
+    Args:
+        df (pd.DataFrame): Measures with 'ethnicity', 'ethnicity_sus', 'numerator' and 'list_size'.
+        measure_col (str): Column used to find ethnicity measures and to chunk the re-aggregation.
+    Returns:
+        pd.DataFrame: Non-ethnicity measures followed by the re-aggregated ethnicity measures,
+            without 'ethnicity_sus'.
+    """
+    ethnicity_map = {
+        "1": "White", "2": "Mixed", "3": "South Asian", "4": "Black", "5": "Other",
+        "A": "White", "B": "White", "C": "White",
+        "D": "Mixed", "E": "Mixed", "F": "Mixed", "G": "Mixed",
+        "H": "South Asian", "J": "South Asian", "K": "South Asian", "L": "South Asian",
+        "M": "Black", "N": "Black", "P": "Black",
+        "R": "Other", "S": "Other",
+        "Z": "Not stated",
+    }
+    labels = ["White", "Mixed", "South Asian", "Black", "Other", "Not stated"]
+
+    # Find ethnicity measures from the measure categories rather than scanning every row
+    measure = df[measure_col].astype("category")
+    is_ethnicity = measure.cat.categories.str.contains("ethnicity", case=False)
+    measure_codes = measure.cat.codes.to_numpy()
+    ethnicity_rows = np.append(is_ethnicity, False)[measure_codes]
+    rows = np.flatnonzero(ethnicity_rows)
+
+    # Codes of the recorded and SUS ethnicity for ethnicity measure rows. '6' is treated as missing
+    ethnicity = df["ethnicity"].iloc[rows].astype("category")
+    sus = df["ethnicity_sus"].iloc[rows].astype("category")
+    ethnicity_codes = ethnicity.cat.codes.to_numpy()
+    sus_codes = sus.cat.codes.to_numpy()
+    ethnicity_codes = np.where(
+        np.append(ethnicity.cat.categories == "6", False)[ethnicity_codes], -1, ethnicity_codes
+    )
+    print(f"Prior Nan count: {(ethnicity_codes < 0).sum()}")
+
+    # Unrecognised values are kept as their own categories, in sorted order, before the groups
+    fallback = ethnicity_codes < 0
+    observed = set(ethnicity.cat.categories[np.unique(ethnicity_codes[~fallback])])
+    observed |= set(sus.cat.categories[np.unique(sus_codes[fallback & (sus_codes >= 0)])])
+    unrecognised = sorted(value for value in observed if value not in ethnicity_map)
+    categories = unrecognised + [label for label in labels if label not in unrecognised]
+
+    # Remap each category index once, then impute from SUS where the recorded code is missing
+    def remap(source_categories):
+        targets = [ethnicity_map.get(value, value) for value in source_categories]
+        lookup = pd.Index(categories).get_indexer(targets)
+        return np.append(lookup, -1)
+
+    codes = remap(ethnicity.cat.categories)[ethnicity_codes]
+    codes[fallback] = remap(sus.cat.categories)[sus_codes[fallback]]
+    del ethnicity, sus, ethnicity_codes, sus_codes
+    print(f"Post-replace Nan count: {(codes < 0).sum()}")
+
+    # Re-aggregate one measure at a time, in measure category order
+    group_cols = [
+        col for col in df.columns if col not in ["numerator", "list_size", "ethnicity_sus"]
+    ]
+    order = np.argsort(measure_codes[rows], kind="stable")
+    _, chunk_starts = np.unique(measure_codes[rows][order], return_index=True)
+    chunk_ends = np.append(chunk_starts[1:], len(rows))
+    dtype = pd.CategoricalDtype(categories)
+
+    df_ethnicity = []
+    for start, end in zip(chunk_starts, chunk_ends):
+        chunk_rows = order[start:end]
+        chunk = df.iloc[rows[chunk_rows]].drop(columns="ethnicity_sus")
+        chunk["ethnicity"] = pd.Categorical.from_codes(codes[chunk_rows], dtype=dtype)
+        df_ethnicity.append(
+            chunk.groupby(group_cols, as_index=False, observed=True, dropna=False)[
                 ["numerator", "list_size"]
             ].sum()
-            
-            # Drop original ethnicity measures and merge back aggregated measures
-            df = df[~df["measure"].str.contains("ethnicity", case=False, na=False)]
-            df = pd.concat([df, df_ethnicity], ignore_index=True)
+        )
+        del chunk
+    log_memory_usage(label="After re-aggregating ethnicity measures")
 
-            print(f"Post-aggregation values:, {df['ethnicity'].unique()}")
-            print(f"Post-replace df: {df.head()}")
+    # Drop original ethnicity measures and append the aggregated measures
+    df = df.iloc[np.flatnonzero(~ethnicity_rows)].drop(columns="ethnicity_sus")
+    df = pd.concat([df] + df_ethnicity, ignore_index=True)
 
+    print(f"Post-aggregation values:, {df['ethnicity'].unique()}")
     return df
 
 
+def file_hash(path, chunk_size=2**23):
+    """
+    Hashes the contents of a file, reading it in chunks.
+    Args:
+        path (str): Path of the file, including extension.
+        chunk_size (int): Bytes read at a time.
+    Returns:
+        str: Hex sha256 digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def path_size_mb(path):
+    """
+    Gets the size of a file, or of all files in a directory such as a partitioned dataset.
+    Args:
+        path (str): Path of the file or directory, including extension.
+    Returns:
+        float: Size in mb.
+    """
+    if os.path.isdir(path):
+        size = sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(path)
+            for name in names
+        )
+    else:
+        size = os.path.getsize(path)
+    return size / 1024**2
+
+
+def cache_path(cache_dir, name, input_hash, settings):
+    """
+    Builds the path of a cached processed file, keyed on the hash of its input file and
+    the settings that affect processing. A changed input or setting gives a new path, so
+    stale cache entries are never reused.
+    Args:
+        cache_dir (str): Directory holding cached files.
+        name (str): Name of the cached file, e.g. subgroup and date.
+        input_hash (str): Hash of the raw input file, from file_hash.
+        settings (dict): JSON-serialisable settings that change the processed output.
+    Returns:
+        str: Path of the cached file, without extension.
+    """
+    key = hashlib.sha256(input_hash.encode())
+    key.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return os.path.join(cache_dir, f"{name}_{key.hexdigest()[:16]}")
+
+
+def write_cache(df, path):
+    """
+    Writes a processed file to the cache and removes older versions with the same name.
+    Only files named by cache_path for the same name, with a different key, are removed.
+    Args:
+        df (pd.DataFrame): Processed dataframe to cache.
+        path (str): Path from cache_path, without extension.
+    """
+    name = path.rsplit("_", 1)[0]
+    for stale_path in glob.glob(f"{glob.escape(name)}_{'[0-9a-f]' * 16}.arrow"):
+        if stale_path != path + ".arrow":
+            os.remove(stale_path)
+    read_write(read_or_write="write", path=path, df=df, file_type="arrow", test=False)
+
+
+def concat_categorical(dfs):
+    """
+    Concatenates dataframes after unifying the categories of categorical columns, so columns
+    stay categorical rather than falling back to object when categories differ.
+    Args:
+        dfs (list): Dataframes with the same columns.
+    Returns:
+        pd.DataFrame: Concatenated dataframe.
+    """
+    for col in dfs[0].columns:
+        if isinstance(dfs[0][col].dtype, pd.CategoricalDtype):
+            categories = (
+                dfs[0][col].cat.categories.append([df[col].cat.categories for df in dfs[1:]]).unique()
+            )
+            for df in dfs:
+                df[col] = df[col].cat.set_categories(categories)
+    return pd.concat(dfs)
+
+
 # ----------- Summer-winter comparison functions ---------------------------------------------
 
 
-def build_aggregate_df(rate_df, strata, aggregation_dict, initial_list_size = False):
+def factorize_column(values):
+    """
+    Factorises a grouping column into integer codes that follow the sorted order of its levels.
+    Categorical and small-range integer columns are coded without hashing, so their levels
+    can include unobserved values. These are dropped when the columns are combined into groups.
+
+    Args:
+        values (pd.Series): Column to factorise.
+    Returns:
+        tuple: Code per row (-1 where missing) and the levels the codes index into.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        levels = pd.Categorical.from_codes(
+            np.arange(len(values.cat.categories)), dtype=values.dtype
+        )
+        return values.cat.codes.to_numpy(), levels
+
+    # Nullable integer and boolean columns are hashed, so missing values are coded as -1
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind in "biu" and len(values) > 0:
+        x = values.to_numpy().astype(np.int64)
+        low, high = x.min(), x.max()
+        if high - low < 4 * len(x) + 1024:
+            return x - low, np.arange(low, high + 1).astype(values.dtype)
+
+    return pd.factorize(values, sort=True)
+
+
+def factorize_groups(df, strata, cache=None):
+    """
+    Factorises the grouping columns once into a single integer group code per row.
+    Groups are numbered in sorted key order and only observed key combinations are kept.
+
+    Args:
+        df (pd.DataFrame): Dataframe to group.
+        strata (list): Columns to group by.
+        cache (dict): Optional dictionary owned by the caller to reuse codes across calls on
+            the same dataframe. Column codes are keyed by column name and group codes by the
+            tuple of strata.
+    Returns:
+        tuple: Group code per row (-1 where any key is missing), the number of groups and a
+            dataframe of the group keys in group code order.
+    """
+    key_set = tuple(strata)
+    if cache is not None and key_set in cache:
+        return cache[key_set]
+
+    # Combine per-column codes into one code using mixed radix, which preserves the
+    # lexicographic order of the sorted per-column codes
+    combined = np.zeros(len(df), dtype=np.int64)
+    missing = np.zeros(len(df), dtype=bool)
+    levels = []
+    n_combinations = 1
+    for col in strata:
+        if cache is not None and col in cache:
+            col_codes, col_levels = cache[col]
+        else:
+            col_codes, col_levels = factorize_column(df[col])
+            if cache is not None:
+                cache[col] = (col_codes, col_levels)
+        n_combinations *= max(len(col_levels), 1)
+        if n_combinations >= 2**62:
+            raise ValueError(f"Too many key combinations to group by {strata}")
+        missing |= col_codes < 0
+        combined = combined * len(col_levels) + col_codes
+        levels.append(col_levels)
+
+    # Renumber the observed combinations as 0..n_groups-1, dropping rows with missing keys
+    # as groupby does by default. Dense combinations are renumbered by counting, sparse
+    # ones by hashing
+    codes = np.full(len(df), -1, dtype=np.int64)
+    if n_combinations <= 4 * len(df) + 1024:
+        is_observed = np.bincount(combined[~missing], minlength=n_combinations) > 0
+        observed = np.flatnonzero(is_observed)
+        codes[~missing] = (np.cumsum(is_observed) - 1)[combined[~missing]]
+    else:
+        observed_codes, observed = pd.factorize(combined[~missing], sort=True)
+        codes[~missing] = observed_codes
+        observed = np.asarray(observed, dtype=np.int64)
+
+    # Decode the observed combinations back into key columns, last column first
+    keys = {}
+    for col, col_levels in zip(reversed(strata), reversed(levels)):
+        observed, col_codes = np.divmod(observed, max(len(col_levels), 1))
+        keys[col] = col_levels.take(col_codes)
+    keys = pd.DataFrame({col: keys[col] for col in strata})
+
+    groups = (codes, len(keys), keys)
+    if cache is not None:
+        cache[key_set] = groups
+    return groups
+
+
+def reduce_groups(values, codes, n_groups, func, order_by=None):
+    """
+    Reduces a column to one value per group using sorted segment reductions.
+    Missing values are skipped, matching the pandas groupby aggregations.
+
+    Args:
+        values (pd.Series): Column to reduce, aligned with codes.
+        codes (np.ndarray): Group code per row from factorize_groups, without missing keys.
+        n_groups (int): Number of groups.
+        func (str): One of 'sum', 'count', 'mean', 'var', 'median', 'min', 'max', 'first' or
+            'nunique'. Other aggregations fall back to pandas groupby on the codes.
+    Returns:
+        np.ndarray: Reduced value per group, in group code order.
+    """
+    if func not in ["sum", "count", "mean", "var", "median", "min", "max", "first", "nunique"] or (
+        func != "nunique" and not isinstance(values.dtype, np.dtype)
+    ):
+        return values.groupby(codes).agg(func).reindex(range(n_groups)).to_numpy()
+
+    x = values.to_numpy()
+    notna = ~pd.isna(x) if func != "nunique" else None
+    if notna is not None and notna.all():
+        notna = slice(None)
+    if func in ["sum", "count", "mean", "var"]:
+        count = np.bincount(codes[notna], minlength=n_groups)
+        if func == "count":
+            return count
+        total = np.bincount(codes[notna], weights=x[notna], minlength=n_groups)
+        if func == "sum":
+            return total if x.dtype.kind == "f" else total.astype(np.int64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total / count
+            if func == "mean":
+                return mean
+            # Two-pass variance around the group mean, with one degree of freedom
+            squares = np.bincount(
+                codes[notna], weights=(x[notna] - mean[codes[notna]]) ** 2, minlength=n_groups
+            )
+            return np.where(count > 1, squares / (count - 1), np.nan)
+
+    if func == "nunique":
+        value_codes, uniques = pd.factorize(values)
+        keep = value_codes >= 0
+        pairs = pd.unique(codes[keep] * max(len(uniques), 1) + value_codes[keep])
+        return np.bincount(pairs // max(len(uniques), 1), minlength=n_groups)
+
+    # Remaining reductions work on rows sorted into contiguous group segments by a stable
+    # sort on the group code, which numpy radix sorts for small code dtypes
+    codes, x = codes[notna], x[notna]
+    codes = codes.astype(np.min_scalar_type(max(n_groups - 1, 0)))
+    large_groups = len(x) >= 32 * n_groups
+    if func == "median" and not large_groups:
+        # Many small groups: sort by value within each segment
+        order = np.argsort(x)
+    elif func == "first" and order_by is not None:
+        order = np.argsort(order_by.to_numpy()[notna], kind="stable")
+    else:
+        order = np.arange(len(x))
+    order = order[np.argsort(codes[order], kind="stable")]
+    sorted_x = x[order]
+    count = np.bincount(codes, minlength=n_groups)
+    starts = np.cumsum(count) - count
+    present = count > 0
+
+    if func == "median":
+        lower_rank, upper_rank = (count - 1) // 2, count // 2
+        if large_groups:
+            # Few large groups: select the middle values of each unsorted segment in linear time
+            for group in np.flatnonzero(present):
+                segment = sorted_x[starts[group] : starts[group] + count[group]]
+                segment.partition([lower_rank[group], upper_rank[group]])
+        lower = sorted_x[np.minimum(starts + lower_rank, len(x) - 1)]
+        upper = sorted_x[np.minimum(starts + upper_rank, len(x) - 1)]
+        return np.where(present, (lower + upper) / 2, np.nan)
+
+    result = np.full(n_groups, np.nan) if not present.all() else np.empty(n_groups, x.dtype)
+    if func == "first":
+        result[present] = sorted_x[starts[present]]
+    else:
+        reducer = np.minimum if func == "min" else np.maximum
+        result[present] = reducer.reduceat(sorted_x, starts[present])
+    return result
+
+
+def group_quantiles(values, codes, n_groups, q):
+    """
+    Exact quantiles per group, interpolated linearly between order statistics as in pandas
+    quantile and R quantile type 7. Groups are sorted into contiguous segments. Many small
+    groups are then sorted by value, while few large groups only have the order statistics
+    needed selected with np.partition. Missing values are skipped.
+
+    Args:
+        values (pd.Series | np.ndarray): Column to summarise, aligned with codes.
+        codes (np.ndarray): Group code per row from factorize_groups, without missing keys.
+        n_groups (int): Number of groups.
+        q (list): Quantiles between 0 and 1, e.g. deciles.
+    Returns:
+        np.ndarray: Array of shape (n_groups, len(q)), missing for groups without values.
+    """
+    x = np.asarray(values, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    notna = ~np.isnan(x)
+    codes, x = codes[notna], x[notna]
+    codes = codes.astype(np.min_scalar_type(max(n_groups - 1, 0)))
+    count = np.bincount(codes, minlength=n_groups)
+    starts = np.cumsum(count) - count
+    present = count > 0
+
+    # Position of each quantile between order statistics within each group
+    position = (count[:, None] - 1) * q[None, :]
+    lower_rank = np.floor(position).astype(np.int64)
+    upper_rank = np.minimum(lower_rank + 1, np.maximum(count[:, None] - 1, 0))
+    fraction = position - lower_rank
+
+    large_groups = len(x) >= 32 * n_groups
+    order = np.arange(len(x)) if large_groups else np.argsort(x)
+    order = order[np.argsort(codes[order], kind="stable")]
+    sorted_x = x[order]
+    if large_groups:
+        # Few large groups: select the order statistics of each unsorted segment
+        for group in np.flatnonzero(present):
+            segment = sorted_x[starts[group] : starts[group] + count[group]]
+            segment.partition(np.unique(np.concatenate([lower_rank[group], upper_rank[group]])))
+
+    last = max(len(x) - 1, 0)
+    lower = sorted_x[np.minimum(starts[:, None] + lower_rank, last)] if len(x) else np.full(position.shape, np.nan)
+    upper = sorted_x[np.minimum(starts[:, None] + upper_rank, last)] if len(x) else np.full(position.shape, np.nan)
+    return np.where(present[:, None], lower + fraction * (upper - lower), np.nan)
+
+
+def weighted_counts(df, variables, weight, by=None):
+    """
+    Sums a weight over the levels of several variables, e.g. the list size of each age group,
+    with one bincount per variable on its level codes instead of a dense indicator matrix.
+    Rows with a missing level are skipped, as in pd.get_dummies. Categorical variables keep
+    their unobserved categories with a zero count, other variables only their observed levels.
+
+    Args:
+        df (pd.DataFrame): Dataframe with the variable and weight columns.
+        variables (list): Columns to count the levels of.
+        weight (str): Column to sum, missing values count as zero.
+        by (list): Optional columns to count within, e.g. ['interval_start'] for each week.
+            They are factorised once and shared by every variable.
+    Returns:
+        pd.DataFrame: The by columns, then 'variable', 'level' and 'count', ordered by the by
+            keys, then variable and then sorted level.
+    """
+    by = list(by or [])
+    if by:
+        by_codes, n_by, by_df = factorize_groups(df, by)
+    else:
+        by_codes, n_by, by_df = np.zeros(len(df), dtype=np.int64), 1, pd.DataFrame(index=range(1))
+    weights = df[weight].to_numpy(dtype=np.float64, na_value=0)
+    integer_weight = pd.api.types.is_integer_dtype(df[weight]) or pd.api.types.is_bool_dtype(df[weight])
+
+    parts = []
+    part_by_codes = []
+    for var in variables:
+        codes, levels = factorize_column(df[var])
+        n_levels = len(levels)
+        keep = (codes >= 0) & (by_codes >= 0)
+        combined = by_codes[keep] * n_levels + codes[keep]
+        counts = np.bincount(combined, weights=weights[keep], minlength=n_by * n_levels)
+        if integer_weight:
+            counts = counts.astype(np.int64)
+        if isinstance(df[var].dtype, pd.CategoricalDtype):
+            present = np.ones(n_by * n_levels, dtype=bool)
+        else:
+            present = np.bincount(combined, minlength=n_by * n_levels) > 0
+
+        part_codes = np.repeat(np.arange(n_by), n_levels)[present]
+        part = by_df.iloc[part_codes].reset_index(drop=True)
+        part["variable"] = var
+        part["level"] = np.tile(np.asarray(levels, dtype=object), n_by)[present]
+        part["count"] = counts[present]
+        parts.append(part)
+        part_by_codes.append(part_codes)
+
+    # Order the rows of every variable by the by keys, keeping the variables in order
+    order = np.argsort(np.concatenate(part_by_codes), kind="stable")
+    return pd.concat(parts, ignore_index=True).iloc[order].reset_index(drop=True)
+
+
+def quantile_sketch(df, strata, col, k=256):
+    """
+    Builds a mergeable quantile sketch of a column per group. Each group keeps at most k
+    weighted values. Groups with more values are compacted by pairing neighbouring sorted
+    values into one value carrying both weights, alternating which one is kept. The sketch
+    records a bound on the rank error this introduces, so quantiles from it come with an
+    error bound. Groups with at most k values are kept exactly. Sketches of separate batches
+    of rows can be combined with merge_sketches.
+    Args:
+        df (pd.DataFrame): Dataframe to summarise.
+        strata (list): Columns to group by.
+        col (str): Column to summarise. Missing values are skipped.
+        k (int): Maximum number of values kept per group.
+    Returns:
+        pd.DataFrame: Sketch with strata, col, 'weight' and 'rank_error' columns, one row per
+            kept value. 'rank_error' is the absolute rank error bound of the value's group.
+    """
+    sketch = df.loc[df[col].notna(), strata + [col]].reset_index(drop=True)
+    sketch["weight"] = np.ones(len(sketch), dtype=np.int64)
+    sketch["rank_error"] = np.zeros(len(sketch))
+    return compact_sketch(sketch, strata, col, k)
+
+
+def merge_sketches(sketches, strata, col, k=256):
+    """
+    Combines quantile sketches of separate batches of rows. Ranks, and so rank error bounds,
+    add up across batches, before any further compaction.
+    Args:
+        sketches (list): Outputs of quantile_sketch or merge_sketches.
+        strata (list): Columns the sketches are grouped by.
+        col (str): Column the sketches summarise.
+        k (int): Maximum number of values kept per group.
+    Returns:
+        pd.DataFrame: Merged sketch.
+    """
+    sketch = pd.concat(sketches, ignore_index=True)
+    codes, n_groups, _ = factorize_groups(sketch, strata)
+    # Each batch repeats its error bound on every row of a group, so add one row per batch
+    batch = np.repeat(np.arange(len(sketches)), [len(part) for part in sketches])
+    _, first_rows = np.unique(codes * len(sketches) + batch, return_index=True)
+    error = np.bincount(
+        codes[first_rows], weights=sketch["rank_error"].to_numpy()[first_rows], minlength=n_groups
+    )
+    sketch["rank_error"] = error[codes]
+    return compact_sketch(sketch, strata, col, k)
+
+
+def compact_sketch(sketch, strata, col, k):
+    """
+    Halves the number of values of groups with more than k values until all fit, see
+    quantile_sketch. Each halving can shift any rank by at most the largest weight in the
+    group, which is added to the group's rank error bound.
+    Args:
+        sketch (pd.DataFrame): Sketch with strata, col, 'weight' and 'rank_error' columns.
+        strata (list): Columns the sketch is grouped by.
+        col (str): Column the sketch summarises.
+        k (int): Maximum number of values kept per group.
+    Returns:
+        pd.DataFrame: Compacted sketch, sorted by group and value.
+    """
+    codes, n_groups, _ = factorize_groups(sketch, strata)
+    order = np.lexsort((sketch[col].to_numpy(), codes))
+    sketch, codes = sketch.iloc[order].reset_index(drop=True), codes[order]
+
+    parity = 0
+    while True:
+        count = np.bincount(codes, minlength=n_groups)
+        over = count > k
+        if not over.any():
+            return sketch
+        starts = np.cumsum(count) - count
+        position = np.arange(len(sketch)) - starts[codes]
+        in_over = over[codes]
+        weight = sketch["weight"].to_numpy()
+        max_weight = np.zeros(n_groups, dtype=np.int64)
+        np.maximum.at(max_weight, codes, weight)
+
+        # Pair neighbouring values of over-full groups and keep one value per pair with the
+        # weight of both. Pair ids stay inside each group's range of rows, so they are unique
+        pair = np.where(in_over, starts[codes] + position // 2, np.arange(len(sketch)))
+        pair_weight = np.bincount(pair, weights=weight, minlength=len(sketch)).astype(np.int64)
+        pair_size = np.bincount(pair, minlength=len(sketch))
+        keep = ~in_over | (position % 2 == parity) | (pair_size[pair] == 1)
+        sketch = sketch[keep].reset_index(drop=True)
+        codes, pair = codes[keep], pair[keep]
+        sketch["weight"] = pair_weight[pair]
+        sketch["rank_error"] += np.where(over, max_weight, 0)[codes]
+        parity = 1 - parity
+
+
+def sketch_quantiles(sketch, strata, col, q):
+    """
+    Quantiles per group from a quantile sketch, interpolated as in group_quantiles. Each
+    kept value stands for as many values as its weight. Quantiles are exact for groups that
+    were never compacted.
+    Args:
+        sketch (pd.DataFrame): Output of quantile_sketch or merge_sketches.
+        strata (list): Columns the sketch is grouped by.
+        col (str): Column the sketch summarises.
+        q (list): Quantiles between 0 and 1.
+    Returns:
+        pd.DataFrame: One row per group with strata, '{col}_q{quantile}' columns, the total
+            count '{col}_count' and '{col}_rank_error', the rank error bound as a fraction of
+            the count.
+    """
+    codes, n_groups, quantiles = factorize_groups(sketch, strata)
+    order = np.lexsort((sketch[col].to_numpy(), codes))
+    codes, x = codes[order], sketch[col].to_numpy(dtype=np.float64)[order]
+    weight = sketch["weight"].to_numpy()[order]
+    cumulative = np.cumsum(weight)
+    count = np.bincount(codes, weights=weight, minlength=n_groups).astype(np.int64)
+    base = cumulative - weight
+    group_base = np.zeros(n_groups, dtype=np.int64)
+    group_base[codes[::-1]] = base[::-1]
+
+    # Value at an expanded rank is the kept value whose cumulative weight covers it
+    position = (count[:, None] - 1) * np.asarray(q, dtype=np.float64)[None, :]
+    lower_rank = np.floor(position).astype(np.int64)
+    upper_rank = np.minimum(lower_rank + 1, count[:, None] - 1)
+    last = max(len(x) - 1, 0)
+    lower = x[np.minimum(np.searchsorted(cumulative, group_base[:, None] + lower_rank, side="right"), last)]
+    upper = x[np.minimum(np.searchsorted(cumulative, group_base[:, None] + upper_rank, side="right"), last)]
+    values = lower + (position - lower_rank) * (upper - lower)
+
+    for i, quantile in enumerate(q):
+        quantiles[f"{col}_q{round(quantile * 100):g}"] = values[:, i]
+    quantiles[f"{col}_count"] = count
+    error = np.zeros(n_groups)
+    error[codes] = sketch["rank_error"].to_numpy()[order]
+    quantiles[f"{col}_rank_error"] = error / count
+    return quantiles
+
+
+def build_aggregate_df(rate_df, strata, aggregation_dict, initial_list_size=False, cache=None):
+    """
+    Aggregates a dataframe by strata in a single pass over factorised group codes.
+
+    Args:
+        rate_df (pd.DataFrame): Dataframe to aggregate.
+        strata (list): Columns to group by. Only observed key combinations are returned.
+        aggregation_dict (dict): Mapping of column to aggregation(s). Lists of aggregations
+            give flat 'column_aggregation' names, plain strings keep the column name.
+        initial_list_size (bool): Add 'list_size_initial', the denominator from the earliest
+            interval in each group, to avoid inflating list size by summing across weeks.
+        cache (dict): Optional dictionary to reuse group codes across calls on the same
+            dataframe, see factorize_groups.
+    Returns:
+        pd.DataFrame: One row per group with strata and flat aggregate columns.
+    """
+    codes, n_groups, agg = factorize_groups(rate_df, strata, cache)
+
+    # Drop rows with a missing key once, rather than per column
+    valid = codes >= 0
+    if not valid.all():
+        rate_df, codes = rate_df[valid], codes[valid]
 
-    # Ensure grouping columns are correct
-    agg = (rate_df.groupby(strata).agg(aggregation_dict)).reset_index()
+    single_level = all(isinstance(funcs, str) for funcs in aggregation_dict.values())
+    for col, funcs in aggregation_dict.items():
+        for func in [funcs] if isinstance(funcs, str) else funcs:
+            name = col if single_level else f"{col}_{func}"
+            agg[name] = reduce_groups(rate_df[col], codes, n_groups, func)
 
-    # If initial list size desired, use the first weekly denominator as yearly list size to avoid inflating denominator by summing list sizes across weeks.
     if initial_list_size == True:
-        first_week_denominator = (
-            rate_df
-            .sort_values('interval_start')
-            .groupby(strata, as_index=False)['denominator']
-            .first()
+        agg["list_size_initial"] = reduce_groups(
+            rate_df["denominator"], codes, n_groups, "first", order_by=rate_df["interval_start"]
         )
-        agg = agg.merge(first_week_denominator, on=strata, how='left')
-
-        # Rename denominator column to reflect that it's the first week denominator, not the sum of weekly denominators
-        agg.rename(columns={'denominator': 'list_size_initial'}, inplace=True)
-
-    # Handle both MultiIndex (tuple) and single-level column indexes safely
-    new_columns = []
-    for col in agg.columns.values:
-        if isinstance(col, tuple):
-            # Join non-None parts of the tuple with underscores
-            parts = [str(part) for part in col if part is not None]
-            new_col = "_".join(parts).strip("_")
-        else:
-            # Single-level column: use its string representation directly
-            new_col = str(col)
-        new_columns.append(new_col)
 
-    agg.columns = new_columns
-    
     return agg
 
 
+def group_moments(df, strata, col, cache=None):
+    """
+    Computes the count, mean and sum of squared deviations from the mean (M2) of a column per
+    group. Moments of different batches of rows can be combined with merge_moments, so
+    variances can be accumulated over record batches or worker processes.
+    Args:
+        df (pd.DataFrame): Dataframe to aggregate.
+        strata (list): Columns to group by.
+        col (str): Column to compute the moments of. Missing values are skipped.
+        cache (dict): Optional dictionary to reuse group codes, see factorize_groups.
+    Returns:
+        pd.DataFrame: One row per group with strata and '{col}_count', '{col}_mean' and
+            '{col}_m2' columns.
+    """
+    codes, n_groups, moments = factorize_groups(df, strata, cache)
+    x = df[col].to_numpy(dtype=np.float64)
+    keep = (codes >= 0) & ~np.isnan(x)
+    codes, x = codes[keep], x[keep]
+
+    count = np.bincount(codes, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(codes, weights=x, minlength=n_groups) / count
+    moments[f"{col}_count"] = count
+    moments[f"{col}_mean"] = mean
+    moments[f"{col}_m2"] = np.bincount(codes, weights=(x - mean[codes]) ** 2, minlength=n_groups)
+    return moments
+
+
+def merge_moments(moments_dfs, strata, col):
+    """
+    Combines moments from group_moments computed on separate batches of rows, using the
+    pairwise update of Chan et al. generalised to any number of batches. The result is the
+    same as the moments of all rows together, up to floating point rounding, and can itself
+    be merged again.
+    Args:
+        moments_dfs (list): Outputs of group_moments with the same strata and column.
+        strata (list): Columns the moments are grouped by.
+        col (str): Column the moments are computed on.
+    Returns:
+        pd.DataFrame: Merged moments, one row per group in the order of group_moments.
+    """
+    moments_df = pd.concat(moments_dfs, ignore_index=True)
+    codes, n_groups, merged = factorize_groups(moments_df, strata)
+    count = moments_df[f"{col}_count"].to_numpy()
+    # Batches without values for a group have a missing mean and add nothing
+    mean = np.where(count > 0, moments_df[f"{col}_mean"].to_numpy(), 0.0)
+
+    total_count = np.bincount(codes, weights=count, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total_mean = np.bincount(codes, weights=count * mean, minlength=n_groups) / total_count
+    # Within-batch deviations plus the deviation of each batch mean from the combined mean
+    between = count * (mean - np.nan_to_num(total_mean[codes])) ** 2
+    merged[f"{col}_count"] = total_count.astype(np.int64)
+    merged[f"{col}_mean"] = total_mean
+    merged[f"{col}_m2"] = np.bincount(
+        codes, weights=moments_df[f"{col}_m2"].to_numpy() + between, minlength=n_groups
+    )
+    return merged
+
+
+def moments_var(moments_df, col):
+    """
+    Sample variance, with one degree of freedom, from moments computed by group_moments.
+    Args:
+        moments_df (pd.DataFrame): Output of group_moments or merge_moments.
+        col (str): Column the moments are computed on.
+    Returns:
+        np.ndarray: Variance per group, missing for groups with fewer than two values.
+    """
+    count = moments_df[f"{col}_count"].to_numpy()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 1, moments_df[f"{col}_m2"].to_numpy() / (count - 1), np.nan)
+
+
 def transpose_summer(df, baseline):
 
     # 1. Extract the baseline (Jun-Jul rows) CURRENTLY PREV SUMMER ONLY
@@ -221,57 +837,166 @@ def transpose_summer(df, baseline):
     return df
 
 
-def test_difference(row, agg_df):
-
-    # Skip summer-summer comparisons
-    if row["season"] == "Jun-Jul":
-        return np.nan
+def test_difference(count, exposure, baseline_count, baseline_exposure):
+    """
+    Tests for a difference between two Poisson rates over whole arrays of (count, exposure)
+    pairs using the exact conditional binomial test. Under equal rates, and conditional on
+    the total count, count is binomial with probability exposure / (exposure + baseline_exposure).
+    The two-sided p-value doubles the smaller tail.
 
-    key_summer = (row["measure"], "Jun-Jul", row["practice_pseudo_id"], row["pandemic"])
-    key_season = (
-        row["measure"],
-        row["season"],
-        row["practice_pseudo_id"],
-        row["pandemic"],
+    Args:
+        count (array-like): Event counts to compare, e.g. seasonal numerator sums.
+        exposure (array-like): Exposure for each count, e.g. seasonal list size sums.
+        baseline_count (array-like): Event counts in the baseline (summer) period.
+        baseline_exposure (array-like): Exposure for each baseline count.
+    Returns:
+        np.ndarray: Two-sided p-values, NaN where a count is missing or an exposure is not positive.
+    """
+    count, exposure, baseline_count, baseline_exposure = (
+        np.asarray(values, dtype=float)
+        for values in [count, exposure, baseline_count, baseline_exposure]
+    )
+    valid = (
+        (exposure > 0) & (baseline_exposure > 0) & ~np.isnan(count) & ~np.isnan(baseline_count)
     )
 
-    print(f"Comparing {key_season} with {key_summer}")
+    # Midpoint-rounded counts are whole numbers stored as floats
+    k = np.rint(count[valid])
+    n = k + np.rint(baseline_count[valid])
+    p = exposure[valid] / (exposure[valid] + baseline_exposure[valid])
 
-    # Fetch rates for each season NEED TO UPDATE TOTAL_RATE
-    summer_rate = round(agg_df.loc[key_summer, "total_rate"])
-    summer_n = agg_df.loc[key_summer, "intervals"]
-    winter_rate = round(agg_df.loc[key_season, "total_rate"])
-    winter_n = agg_df.loc[key_season, "intervals"]
+    pvalues = np.full(count.shape, np.nan)
+    pvalues[valid] = np.minimum(
+        1, 2 * np.minimum(stats.binom.cdf(k, n, p), stats.binom.sf(k - 1, n, p))
+    )
+    return pvalues
 
-    # Skip comparisons with 0 intervals
-    if summer_n == 0 or winter_n == 0:
-        print("Skipping as n = 0")
-        return np.nan
 
-    result = stats.poisson_means_test(
-        summer_rate, summer_n, winter_rate, winter_n, alternative="two-sided"
-    )
-    return round(result.pvalue, 4)
+def assign_season(months, seasons=config["seasons"]):
+    """
+    Assigns seasons to an array of months using a lookup table instead of a per-row function.
+    Args:
+        months (array-like): Month numbers (1-12).
+        seasons (dict): Mapping of season name to its months, in chronological order
+            from the summer baseline (e.g. config["seasons"]).
+    Returns:
+        pd.Categorical: Ordered seasons, NaN for months outside every season.
+    """
+    # Index 0 is unused so months can index the lookup directly
+    lookup = np.full(13, -1, dtype=np.int8)
+    for code, season_months in enumerate(seasons.values()):
+        lookup[season_months] = code
 
+    codes = lookup[np.asarray(months, dtype=np.int64)]
+    return pd.Categorical.from_codes(codes, categories=list(seasons.keys()), ordered=True)
 
-def get_season(month):
+
+def assign_pandemic(dates, pandemic_start=config["pandemic_start"], pandemic_end=config["pandemic_end"]):
     """
-    Returns the season for a given month.
+    Assigns each date to the period before, during or after the pandemic.
     Args:
-        month (int): Month number (1-12).
+        dates (pd.Series): Dates to assign (e.g. interval_start).
+        pandemic_start (str): First date of the pandemic period.
+        pandemic_end (str): Last date of the pandemic period.
     Returns:
-        str: Season name (2 month period).
+        pd.Categorical: Ordered periods 'Before' < 'During' < 'After'.
     """
-    if month in [9, 10]:
-        return "Sep-Oct"
-    elif month in [11, 12]:
-        return "Nov-Dec"
-    elif month in [1, 2]:
-        return "Jan-Feb"
-    elif month in [6, 7]:
-        return "Jun-Jul"
-    else:
-        return None  # Exclude non-winter months
+    dates = pd.to_datetime(dates)
+    codes = (dates >= pd.to_datetime(pandemic_start)).to_numpy(dtype=np.int8)
+    codes += (dates > pd.to_datetime(pandemic_end)).to_numpy(dtype=np.int8)
+    return pd.Categorical.from_codes(codes, categories=["Before", "During", "After"], ordered=True)
+
+
+@pd.api.extensions.register_dataframe_accessor("wp")
+class DerivedColumns:
+    """
+    Derived columns of processed measures, available as df.wp.<name>. Each is computed from
+    interval_start and the rounded counts on first access and cached, so a script only pays
+    for the columns it uses. A column already stored in the frame is returned as is.
+    Call release() to free cached columns, and after changing interval_start or the counts.
+    """
+
+    # Accessor names and the columns they are stored as
+    columns = {
+        "month": "month",
+        "year": "year",
+        "summer_year": "summer_year",
+        "rate": "rate_per_1000_midpoint6_derived",
+        "pandemic": "pandemic",
+        "season": "season",
+    }
+
+    def __init__(self, df):
+        self._df = df
+        self._cache = {}
+
+    def _derived(self, name, derive):
+        column = self.columns[name]
+        if column in self._df.columns:
+            return self._df[column]
+        if name not in self._cache:
+            self._cache[name] = pd.Series(derive(), index=self._df.index, name=column)
+        return self._cache[name]
+
+    @property
+    def month(self):
+        """pd.Series: Month of interval_start."""
+        return self._derived("month", lambda: self._df["interval_start"].dt.month.to_numpy(dtype=np.int8))
+
+    @property
+    def year(self):
+        """pd.Series: Calendar year of interval_start."""
+        return self._derived("year", lambda: self._df["interval_start"].dt.year.to_numpy(dtype=np.int16))
+
+    @property
+    def summer_year(self):
+        """pd.Series: Year of the summer baseline for each interval."""
+        # If Jan - May, RR is relative to prev years summer. If June - Dec, RR is relative to same years summer.
+        return self._derived(
+            "summer_year", lambda: (self.year.to_numpy() - (self.month.to_numpy() <= 5)).astype(np.int16)
+        )
+
+    @property
+    def rate(self):
+        """pd.Series: Rate per 1000 from the rounded counts."""
+        return self._derived(
+            "rate", lambda: self._df["numerator_midpoint6"] / self._df["list_size_midpoint6"] * 1000
+        )
+
+    @property
+    def pandemic(self):
+        """pd.Series: Pandemic period of interval_start, using the dates in config."""
+        return self._derived(
+            "pandemic",
+            lambda: assign_pandemic(self._df["interval_start"], config["pandemic_start"], config["pandemic_end"]),
+        )
+
+    @property
+    def season(self):
+        """pd.Series: Season of interval_start from config["seasons"], NaN outside every season."""
+        return self._derived("season", lambda: assign_season(self.month))
+
+    def add(self, *names):
+        """
+        Stores derived columns in the frame and releases them from the cache.
+        Args:
+            names (str): Accessor names of the columns to add, e.g. 'month' or 'rate'.
+        Returns:
+            pd.DataFrame: The frame with the derived columns.
+        """
+        for name in names:
+            self._df[self.columns[name]] = getattr(self, name)
+            self._cache.pop(name, None)
+        return self._df
+
+    def release(self, *names):
+        """
+        Frees cached derived columns.
+        Args:
+            names (str): Accessor names of the columns to release, all if none are given.
+        """
+        for name in names or list(self._cache):
+            self._cache.pop(name, None)
 
 
 def read_write(
@@ -282,6 +1007,7 @@ def read_write(
     yearly=config["yearly"],
     df=None,
     dtype=None,
+    schema_read=config["schema_read"],
     **kwargs,
 ):
     """
@@ -291,6 +1017,8 @@ def read_write(
         read_or_write (str): 'read' or 'write' to specify the operation.
         test (bool): If True, use test versions of datasets.
         path (str): Path to the file.
+        dtype (dict): Mapping of column names to dtypes to apply when reading arrow files.
+        schema_read (bool): If True, apply dtype by casting at the arrow level before conversion to pandas.
     Returns:
         pd.DataFrame: DataFrame read from the file if read_or_write is 'read'.
     """
@@ -307,16 +1035,16 @@ def read_write(
             df = pd.read_csv(path + ".csv.gz", compression="gzip", **kwargs)
 
         elif file_type == "arrow":
+
+            if dtype is not None and schema_read:
+                # Cast at the arrow level and convert to pandas once
+                table = feather.read_table(path + ".arrow")
+                return typed_to_pandas(table, dtype)
+
             df = feather.read_feather(path + ".arrow")
 
             if dtype is not None:
-                df = df.astype(dtype)
-                df["interval_start"] = pd.to_datetime(df["interval_start"])
-
-                # Convert boolean columns to boolean type
-                bool_cols = [col for col, typ in dtype.items() if typ == "bool"]
-                for col in bool_cols:
-                    df[col] = df[col] == "T"
+                df = set_dtypes(df, dtype)
 
             return df
 
@@ -345,6 +1073,537 @@ def read_write(
                 pickle.dump(df, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
 
+def append_csv(df, path, first, header=True, test=config["test"], **kwargs):
+    """
+    Writes a chunk of results to a csv file, replacing the file with the first chunk and
+    appending later chunks, so results computed in chunks need not be held in memory.
+    Args:
+        df (pd.DataFrame): Chunk of results.
+        path (str): Path to the file, without extension.
+        first (bool): If True, this is the first chunk.
+        header (bool): If True, write the header with the first chunk.
+        test (bool): If True, use test versions of datasets.
+        **kwargs: Additional arguments passed to DataFrame.to_csv (e.g. index).
+    """
+    read_write(
+        read_or_write="write",
+        path=path,
+        df=df,
+        file_type="csv",
+        test=test,
+        mode="w" if first else "a",
+        header=header and first,
+        **kwargs,
+    )
+
+
+class ArrowChunkWriter:
+    """
+    Writes a dataframe to an arrow file one chunk at a time, so it need not be held in memory.
+    The file is opened with the schema of the first chunk and later chunks are converted to it.
+    Categorical columns must have the same categories in every chunk, as arrow files hold a
+    single dictionary per column. Use as a context manager to close the file.
+    """
+
+    def __init__(self, path, test=config["test"]):
+        self.path = path + "_test" if test else path
+        self.schema = None
+        self._writer = None
+
+    def write(self, df):
+        """
+        Appends a chunk to the file.
+        Args:
+            df (pd.DataFrame): Chunk to write.
+        """
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        if self._writer is None:
+            self.schema = table.schema
+            self._writer = pa.ipc.new_file(
+                self.path + ".arrow", self.schema, options=pa.ipc.IpcWriteOptions(compression="lz4")
+            )
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_partitioned(df, path, partition_cols=["measure", "year"], test=config["test"]):
+    """
+    Writes a processed measures dataframe as an arrow dataset partitioned by measure and year,
+    so downstream scripts can read only the partitions they need. Partition discovery sorts
+    the partition values, so the category order of categorical partition columns is kept in
+    the schema metadata for the readers to restore.
+    Args:
+        df (pd.DataFrame): Processed measures to write.
+        path (str): Path to the dataset directory.
+        partition_cols (list): Columns to partition by, year is derived from interval_start.
+        test (bool): If True, use test versions of datasets.
+    """
+    if test:
+        path = path + "_test"
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if "year" in partition_cols and "year" not in table.column_names:
+        table = table.append_column("year", pc.year(table["interval_start"]))
+
+    categories = {
+        col: df[col].cat.categories.tolist()
+        for col in partition_cols
+        if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype)
+    }
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), b"partition_categories": json.dumps(categories).encode()}
+    )
+
+    ds.write_dataset(
+        table,
+        path,
+        format="feather",
+        partitioning=partition_cols,
+        partitioning_flavor="hive",
+        existing_data_behavior="delete_matching",
+    )
+
+
+def open_partitioned(path):
+    """
+    Opens a dataset written by write_partitioned.
+    Args:
+        path (str): Path to the dataset directory.
+    Returns:
+        tuple: The dataset, and a mapping of categorical partition columns to their
+            categories in the order they were written.
+    """
+    dataset = ds.dataset(
+        path, format="feather", partitioning=ds.HivePartitioning.discover(infer_dictionary=True)
+    )
+    metadata = dataset.schema.metadata or {}
+    categories = json.loads(metadata.get(b"partition_categories", b"{}"))
+    return dataset, categories
+
+
+def restore_categories(df, categories):
+    """
+    Restores the written category order of partition columns read from a partitioned dataset.
+    Args:
+        df (pd.DataFrame): Rows read from the dataset.
+        categories (dict): Mapping of columns to their categories, from open_partitioned.
+    Returns:
+        pd.DataFrame: Rows with the written category order.
+    """
+    for col, col_categories in categories.items():
+        if col in df.columns:
+            df[col] = df[col].cat.set_categories(col_categories)
+    return df
+
+
+def read_measures(
+    path,
+    measures=None,
+    measure_pattern=None,
+    years=None,
+    months=None,
+    partitioned=config["partitioned"],
+    test=config["test"],
+):
+    """
+    Reads processed measures, optionally restricted to some measures, years or months.
+    For partitioned datasets, partitions not matching the measure and year filters are
+    skipped and the month filter is applied during the scan. Otherwise the monolithic
+    arrow file is read and filtered in memory.
+    Args:
+        path (str): Path to the processed measures, without extension.
+        measures (list): Measures to keep.
+        measure_pattern (str): Keep only measures containing this substring.
+        years (list): Calendar years of interval_start to keep.
+        months (list): Months of interval_start to keep.
+        partitioned (bool): If True, read the partitioned dataset written by write_partitioned.
+        test (bool): If True, use test versions of datasets.
+    Returns:
+        pd.DataFrame: Processed measures matching the filters.
+    """
+    if partitioned:
+        if test:
+            path = path + "_test"
+
+        scan_filter = None
+        filters = []
+        if measures is not None:
+            filters.append(pc.field("measure").isin(measures))
+        if measure_pattern is not None:
+            filters.append(pc.match_substring(pc.field("measure").cast(pa.string()), measure_pattern))
+        if years is not None:
+            filters.append(pc.field("year").isin(years))
+        dataset, categories = open_partitioned(path)
+        if months is not None:
+            if "month" in dataset.schema.names:
+                filters.append(pc.field("month").isin(months))
+            else:
+                filters.append(pc.month(pc.field("interval_start")).isin(months))
+        for expression in filters:
+            scan_filter = expression if scan_filter is None else scan_filter & expression
+
+        # Drop derived year partition and restore measure as the first column
+        columns = ["measure"] + [col for col in dataset.schema.names if col not in ["measure", "year"]]
+        df = dataset.to_table(columns=columns, filter=scan_filter).to_pandas()
+        df = restore_categories(df, categories)
+
+    else:
+        if measures is not None:
+            # Filter the record batches of the arrow file one at a time, so only the rows of the
+            # requested measures are held in memory
+            with pa.memory_map(f"{path}{'_test' if test else ''}.arrow") as source:
+                reader = pa.ipc.open_file(source)
+                value_set = pa.array(measures)
+                batches = [
+                    batch.filter(pc.is_in(batch.column("measure"), value_set=value_set))
+                    for batch in (reader.get_batch(i) for i in range(reader.num_record_batches))
+                ]
+                df = pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+        else:
+            df = read_write("read", path, test=test)
+
+        # Apply the remaining filters in memory
+        mask = pd.Series(True, index=df.index)
+        if measure_pattern is not None:
+            mask &= df["measure"].str.contains(measure_pattern)
+        if years is not None:
+            mask &= df["interval_start"].dt.year.isin(years)
+        if months is not None:
+            if "month" in df.columns:
+                mask &= df["month"].isin(months)
+            else:
+                mask &= df["interval_start"].dt.month.isin(months)
+        if not mask.all():
+            df = df[mask]
+
+    # Remove categories of measures that were filtered out
+    if measures is not None or measure_pattern is not None:
+        df["measure"] = df["measure"].cat.remove_unused_categories()
+
+    return df
+
+
+def compact_dtypes(
+    df,
+    int_cols=["numerator_midpoint6", "list_size_midpoint6", "month", "summer_year"],
+    seasons=config["seasons"],
+):
+    """
+    Applies the dtype policy for processed measures before they are written: integer columns
+    are downcast to the smallest integer type that holds their values, and pandemic and season
+    are stored as ordered categoricals.
+    Args:
+        df (pd.DataFrame): Processed measures.
+        int_cols (list): Integer columns to downcast, float columns (e.g. counts with
+            missing values) are left unchanged.
+        seasons (dict): Mapping of season name to its months, in chronological order.
+    Returns:
+        pd.DataFrame: Processed measures with compact dtypes.
+    """
+    for col in int_cols:
+        if col in df.columns and df[col].dtype.kind in "iu":
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+
+    categories = {"pandemic": ["Before", "During", "After"], "season": list(seasons.keys())}
+    for col, col_categories in categories.items():
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(pd.CategoricalDtype(col_categories, ordered=True))
+
+    return df
+
+
+def iter_measures(
+    path, measures=None, months=None, columns=None, partitioned=config["partitioned"], test=config["test"]
+):
+    """
+    Reads processed measures one record batch at a time, optionally restricted to some
+    measures, months or columns, so that only one batch of rows is held in memory.
+    Args:
+        path (str): Path to the processed measures, without extension.
+        measures (list): Measures to keep.
+        months (list): Months of interval_start to keep.
+        columns (list): Columns to return, all if None. Other columns are not read.
+        partitioned (bool): If True, read the partitioned dataset written by write_partitioned.
+        test (bool): If True, use test versions of datasets.
+    Yields:
+        pd.DataFrame: Rows of one record batch matching the filters.
+    """
+    if test:
+        path = path + "_test"
+
+    categories = {}
+    if partitioned:
+        dataset, categories = open_partitioned(path)
+        schema_names = dataset.schema.names
+        month_col = "month" if "month" in schema_names else "interval_start"
+        scan_columns = ["measure"] + [
+            col for col in schema_names
+            if col not in ["measure", "year"] and (columns is None or col in columns or col == month_col)
+        ]
+        scan_filter = pc.field("measure").isin(measures) if measures is not None else None
+        batches = dataset.to_batches(columns=scan_columns, filter=scan_filter)
+    else:
+        # Memory mapped, so columns that are not used are not read
+        source = pa.memory_map(path + ".arrow")
+        reader = pa.ipc.open_file(source)
+        schema_names = reader.schema.names
+        month_col = "month" if "month" in schema_names else "interval_start"
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+
+    for batch in batches:
+        mask = None
+        if measures is not None and not partitioned:
+            mask = pc.is_in(batch.column("measure"), value_set=pa.array(measures))
+        if months is not None:
+            month = batch.column(month_col)
+            month = month if month_col == "month" else pc.month(month)
+            month_mask = pc.is_in(month, value_set=pa.array(months).cast(month.type))
+            mask = month_mask if mask is None else pc.and_(mask, month_mask)
+        if columns is not None:
+            batch = batch.select(columns)
+        if mask is not None:
+            batch = batch.filter(mask)
+        if batch.num_rows > 0:
+            yield restore_categories(batch.to_pandas(), categories)
+
+
+def list_measures(path, partitioned=config["partitioned"], test=config["test"]):
+    """
+    Lists the measures in processed measures without loading the other columns.
+    Args:
+        path (str): Path to the processed measures, without extension.
+        partitioned (bool): If True, read the partitioned dataset written by write_partitioned.
+        test (bool): If True, use test versions of datasets.
+    Returns:
+        list: Measures, in the category order read_measures gives them.
+    """
+    if test:
+        path = path + "_test"
+    if partitioned:
+        dataset, categories = open_partitioned(path)
+        if "measure" in categories:
+            return categories["measure"]
+        measures = dataset.to_table(columns=["measure"])["measure"]
+    else:
+        measures = feather.read_table(path + ".arrow", columns=["measure"])["measure"]
+    return measures.to_pandas().astype("category").cat.categories.tolist()
+
+
+def set_dtypes(df, dtype):
+    """
+    Applies the configured dtypes to the columns of a measures dataframe.
+    Args:
+        df (pd.DataFrame): DataFrame read from a measures file.
+        dtype (dict): Mapping of column names to dtypes, columns not in df are ignored.
+    Returns:
+        pd.DataFrame: DataFrame with converted dtypes.
+    """
+    df = df.astype({col: typ for col, typ in dtype.items() if col in df.columns})
+    df["interval_start"] = pd.to_datetime(df["interval_start"])
+
+    # Convert boolean columns to boolean type
+    bool_cols = [col for col, typ in dtype.items() if typ == "bool" and col in df.columns]
+    for col in bool_cols:
+        df[col] = df[col] == "T"
+
+    return df
+
+
+def build_arrow_schema(dtype, schema):
+    """
+    Builds the arrow schema matching the configured dtypes for the columns of a table.
+    Category columns are dictionary encoded, interval_start is a timestamp and boolean
+    columns use the native arrow boolean type. Columns without a dtype keep their type.
+    Args:
+        dtype (dict): Mapping of column names to dtypes (e.g. config["dtype_dict"]).
+        schema (pa.Schema): Schema of the table to be cast.
+    Returns:
+        pa.Schema: Target schema.
+    """
+    arrow_types = {
+        "string": pa.string(),
+        "int64": pa.int64(),
+        "int16": pa.int16(),
+        "int8": pa.int8(),
+        "Int8": pa.int8(),
+        "bool": pa.bool_(),
+        "boolean": pa.bool_(),
+    }
+    fields = []
+    for field in schema:
+        typ = dtype.get(field.name)
+        if field.name == "interval_start":
+            fields.append(pa.field(field.name, pa.timestamp("ns")))
+        elif typ == "category":
+            # Keep existing dictionaries rather than re-encoding them
+            if pa.types.is_dictionary(field.type):
+                fields.append(field)
+            else:
+                fields.append(pa.field(field.name, pa.dictionary(pa.int32(), field.type)))
+        elif typ in arrow_types:
+            fields.append(pa.field(field.name, arrow_types[typ]))
+        else:
+            fields.append(field)
+
+    return pa.schema(fields)
+
+
+def typed_to_pandas(table, dtype):
+    """
+    Casts an arrow table to the configured dtypes and converts it to pandas in a single pass.
+    Numeric columns without nulls are converted zero-copy where arrow allows it, and nullable
+    pandas dtypes (e.g. Int8, boolean, string) are built directly from the arrow buffers.
+    Args:
+        table (pa.Table): Table read from a measures file.
+        dtype (dict): Mapping of column names to dtypes (e.g. config["dtype_dict"]).
+    Returns:
+        pd.DataFrame: DataFrame with the configured dtypes.
+    """
+    schema = build_arrow_schema(dtype, table.schema)
+
+    columns = {}
+    for field in schema:
+        column = table[field.name]
+        typ = dtype.get(field.name)
+
+        if typ == "bool" and pa.types.is_string(column.type):
+            # Boolean columns stored as "T"/"F" strings
+            column = pc.fill_null(pc.equal(column, "T"), False)
+        elif pa.types.is_dictionary(field.type) and not pa.types.is_dictionary(column.type):
+            column = pc.dictionary_encode(column)
+        elif column.type != field.type:
+            column = column.cast(field.type)
+
+        # interval_start is converted from its arrow timestamp rather than its configured dtype
+        if typ is not None and field.name != "interval_start":
+            pandas_dtype = pd.api.types.pandas_dtype(typ)
+        else:
+            pandas_dtype = None
+
+        if hasattr(pandas_dtype, "__from_arrow__"):
+            columns[field.name] = pd.Series(pandas_dtype.__from_arrow__(column), copy=False)
+        else:
+            columns[field.name] = column.to_pandas()
+
+        # Newly encoded dictionaries are in order of appearance, sort to match astype("category")
+        if pa.types.is_dictionary(field.type) and not pa.types.is_dictionary(table[field.name].type):
+            categories = columns[field.name].cat.categories
+            columns[field.name] = columns[field.name].cat.reorder_categories(categories.sort_values())
+
+    return pd.DataFrame(columns, copy=False)
+
+
+def batch_to_pandas(table, dtype, schema_read):
+    """
+    Converts one scanned batch of a measures file to pandas with the configured dtypes.
+    Args:
+        table (pa.Table): Table holding a single record batch.
+        dtype (dict): Mapping of column names to dtypes, or None to keep the arrow types.
+        schema_read (bool): If True, apply dtype by casting at the arrow level before conversion to pandas.
+    Returns:
+        pd.DataFrame: DataFrame of the batch.
+    """
+    if dtype is not None and schema_read:
+        return typed_to_pandas(table, dtype)
+    df = table.to_pandas()
+    if dtype is not None:
+        df = set_dtypes(df, dtype)
+    return df
+
+
+def load_subgroup_measures(
+    path,
+    subgroups,
+    core_columns,
+    practice_subgroup,
+    dtype=None,
+    test=config["test"],
+    batch_size=2**20,
+    schema_read=config["schema_read"],
+    drop_empty_list_size=True,
+):
+    """
+    Loads a yearly measures file as one dataframe per subgroup, using an arrow dataset scan.
+    Each scan reads only the core columns plus the subgroup column, and the list_size > 0 and
+    measure suffix filters are pushed down into the scan. Each filtered record batch is
+    converted to pandas as it is read, so only one batch is held in arrow at a time.
+    Args:
+        path (str): Path to the measures file, without extension.
+        subgroups (list): Subgroup identifiers to load.
+        core_columns (list): Columns to keep for every subgroup.
+        practice_subgroup (bool): If True, keep only measures ending with the subgroup name.
+        dtype (dict): Mapping of column names to dtypes to apply after loading.
+        test (bool): If True, use test versions of datasets.
+        batch_size (int): Maximum number of rows per record batch.
+        schema_read (bool): If True, apply dtype by casting at the arrow level before conversion to pandas.
+        drop_empty_list_size (bool): If True, drop rows with 0 or nan list_size during the scan.
+    Returns:
+        dict: Mapping of subgroup to its DataFrame of measures.
+    """
+    if test:
+        path = path + "_test"
+
+    dataset = ds.dataset(path + ".arrow", format="feather")
+    print(f"Rows in input: {dataset.count_rows()}", flush=True)
+
+    subgroup_dfs = {}
+    for subgroup in subgroups:
+
+        # Ethnicity_sus needed for imputation
+        core_columns_i = core_columns.copy()
+        if subgroup == "ethnicity":
+            core_columns_i = core_columns_i + ["ethnicity_sus"]
+
+        # Only read the subgroup identifier and core columns
+        columns = [
+            col for col in dataset.schema.names if subgroup.endswith(col) or col in core_columns_i
+        ]
+
+        # Drop rows with 0 list_size or nan list_size (null comparisons are filtered out)
+        scan_filter = pc.field("denominator") > 0 if drop_empty_list_size else None
+        if practice_subgroup:
+            measure_filter = pc.ends_with(pc.field("measure").cast(pa.string()), subgroup)
+            scan_filter = measure_filter if scan_filter is None else scan_filter & measure_filter
+
+        scanner = dataset.scanner(columns=columns, filter=scan_filter, batch_size=batch_size)
+        schema = scanner.projected_schema
+
+        # Convert each batch as it is read rather than collecting the year in arrow first
+        batch_dfs = []
+        for batch in scanner.to_reader():
+            if batch.num_rows > 0:
+                batch_dfs.append(batch_to_pandas(pa.Table.from_batches([batch]), dtype, schema_read))
+            del batch
+        if not batch_dfs:
+            batch_dfs.append(batch_to_pandas(schema.empty_table(), dtype, schema_read))
+        subgroup_df = concat_categorical(batch_dfs).reset_index(drop=True)
+        del batch_dfs
+
+        # Categories encoded while converting are sorted within each batch, so sort their union
+        for field in schema:
+            if not pa.types.is_dictionary(field.type) and isinstance(
+                subgroup_df[field.name].dtype, pd.CategoricalDtype
+            ):
+                categories = subgroup_df[field.name].cat.categories
+                subgroup_df[field.name] = subgroup_df[field.name].cat.reorder_categories(
+                    categories.sort_values()
+                )
+
+        print(f"Rows loaded for {subgroup}: {len(subgroup_df)}", flush=True)
+        subgroup_dfs[subgroup] = subgroup_df
+
+    return subgroup_dfs
+
+
 def simulate_dataframe(dtype_dict, n_rows):
     """
     Simulate a DataFrame with specified dtypes and number of rows.
@@ -362,8 +1621,17 @@ def simulate_dataframe(dtype_dict, n_rows):
             data[col] = np.random.randint(-30000, 30000, size=n_rows).astype(np.int16)
         elif dtype == "int8":
             data[col] = np.random.randint(1, 6, size=n_rows).astype(np.int8)
+        elif dtype == "Int8":
+            data[col] = pd.arrays.IntegerArray(
+                np.random.randint(1, 6, size=n_rows).astype(np.int8),
+                np.random.rand(n_rows) < 0.1,
+            )
         elif dtype == "bool":
             data[col] = np.random.choice(["T", "F"], size=n_rows)
+        elif dtype == "boolean":
+            data[col] = pd.arrays.BooleanArray(
+                np.random.rand(n_rows) < 0.5, np.random.rand(n_rows) < 0.1
+            )
         elif dtype == "category":
             data[col] = pd.Categorical(np.random.choice(["A", "B", "C"], size=n_rows))
         elif dtype == "string":
@@ -377,46 +1645,123 @@ def simulate_dataframe(dtype_dict, n_rows):
     return df
 
 
+def factorize_keys(dfs, cols):
+    """
+    Encodes multi-column keys as single non-negative integer codes shared across dataframes,
+    so equal keys get equal codes. Missing values are treated as equal, as in DataFrame.merge.
+    Categoricals with shared categories use their category codes and integer columns use
+    their offset values, so only other columns need to be hashed.
+    Args:
+        dfs (list): Dataframes containing the key columns.
+        cols (list): Key columns.
+    Returns:
+        list: One int64 numpy array of key codes per dataframe.
+    """
+    lengths = [len(df) for df in dfs]
+    key_codes = np.zeros(sum(lengths), dtype=np.int64)
+    n_keys = 1
+    for col in cols:
+        values = [df[col] for df in dfs]
+        if all(
+            isinstance(value.dtype, pd.CategoricalDtype)
+            and value.cat.categories.equals(values[0].cat.categories)
+            for value in values
+        ):
+            # Missing values have code -1, so shift codes up by one
+            col_codes = np.concatenate([value.cat.codes.to_numpy() for value in values]).astype(np.int64) + 1
+            n_codes = len(values[0].cat.categories) + 1
+        elif all(value.dtype.kind in "iu" and isinstance(value.dtype, np.dtype) for value in values) and sum(lengths):
+            col_codes = np.concatenate([value.to_numpy(dtype=np.int64) for value in values])
+            col_min = col_codes.min()
+            col_codes -= col_min
+            n_codes = col_codes.max() + 1
+        else:
+            col_codes, col_uniques = pd.factorize(
+                pd.concat(values, ignore_index=True), use_na_sentinel=False
+            )
+            n_codes = len(col_uniques)
+        key_codes = key_codes * n_codes + col_codes
+        n_keys *= max(n_codes, 1)
+        # Renumber densely before the combined codes could overflow
+        if n_keys > 2**31:
+            key_codes, key_uniques = pd.factorize(key_codes)
+            key_codes = key_codes.astype(np.int64)
+            n_keys = len(key_uniques)
+    return np.split(key_codes, np.cumsum(lengths)[:-1])
+
+
+def join_mask(df, keys_df, cols, how="semi"):
+    """
+    Boolean mask of the rows of df whose key appears (semi-join) or does not appear
+    (anti-join) in keys_df, without merging the dataframes.
+    Args:
+        df (pd.DataFrame): Dataframe to filter.
+        keys_df (pd.DataFrame): Dataframe containing the keys to look up.
+        cols (list): Key columns, present in both dataframes.
+        how (str): 'semi' to keep matching rows, 'anti' to keep rows without a match.
+    Returns:
+        np.ndarray: Boolean mask aligned with the rows of df.
+    """
+    if how not in ["semi", "anti"]:
+        raise ValueError(f"Unhandled join: {how}")
+    df_codes, key_codes = factorize_keys([df, keys_df], cols)
+    return np.isin(df_codes, key_codes, invert=how == "anti")
+
+
 def merge_seasons(summer_df, non_summer_df, practice_level):
     """
-    Merges summer (baseline) and non-summer dataframes
+    Merges summer (baseline) and non-summer dataframes. Each non-summer row gets the counts of
+    the previous summer and of the first summer of its measure, for the same pandemic period
+    (and practice if practice_level). Both baselines are looked up in one index of summer rows,
+    keyed on factorised codes, and attached by position, giving the same result as left merges.
     Args:
-        summer_df: Summer dataframe of counts
+        summer_df: Summer dataframe of counts, with one row per baseline key
         non_summer_df: Non-Summer dataframe of counts
         practice_level: Boolean, determines whether merging is done at practice level
     Returns:
         pd.DataFrame: Merged dataframe containing columns for summer and non_summer rates per measure
     """
 
-    # Merge keys: use summer_year, measure, pandemic, and practice if practice_level
-    merge_cols = ["measure", "summer_year", "pandemic"]
+    # Baseline keys: measure, pandemic and practice if practice_level, plus summer_year
+    group_cols = ["measure", "pandemic"]
     if practice_level:
-        merge_cols.append("practice_pseudo_id")
-
-    # Perform left merge: every non-summer row gets the same summer baseline
-    combined_seasons_df = non_summer_df.merge(
-        summer_df, on=merge_cols, how="left", suffixes=[None, "_prev_summr"]
+        group_cols.append("practice_pseudo_id")
+    summer_groups, non_summer_groups = factorize_keys([summer_df, non_summer_df], group_cols)
+    summer_years = summer_df["summer_year"].to_numpy(dtype=np.int64)
+    non_summer_years = non_summer_df["summer_year"].to_numpy(dtype=np.int64)
+    n_years = max(summer_years.max(initial=0), non_summer_years.max(initial=0)) + 1
+
+    # Baseline index: position of each summer row by group and summer_year
+    baseline_index = pd.Index(summer_groups * n_years + summer_years)
+    if not baseline_index.is_unique:
+        raise ValueError("merge_seasons needs one summer row per measure, pandemic, practice and summer_year")
+    prev_positions = baseline_index.get_indexer(non_summer_groups * n_years + non_summer_years)
+
+    # First summer year of each measure, looked up in the same index
+    summer_measures, non_summer_measures = factorize_keys([summer_df, non_summer_df], ["measure"])
+    first_years = np.full(
+        max(summer_measures.max(initial=-1), non_summer_measures.max(initial=-1)) + 1, n_years
     )
-
-    # Find the first valid summer year for each measure
-    first_summer_years = summer_df.groupby("measure")["summer_year"].min().reset_index()
-    # Merge to keep only the first summer for a given practice and measure
-    first_summer_df = summer_df.merge(
-        first_summer_years, on=["measure", "summer_year"]
-    ).drop(
-        columns="summer_year"
-    )  # Drop original summer_year after filtering
-
-    # Merge first summer counts into main df
-    merge_cols = ["measure", "pandemic"]
-    if practice_level == True:
-        merge_cols.append("practice_pseudo_id")
-
-    combined_seasons_df_final = combined_seasons_df.merge(
-        first_summer_df, on=merge_cols, how="left", suffixes=[None, "_first_summr"]
+    np.minimum.at(first_years, summer_measures, summer_years)
+    non_summer_first_years = first_years[non_summer_measures]
+    first_positions = np.where(
+        non_summer_first_years < n_years,
+        baseline_index.get_indexer(non_summer_groups * n_years + non_summer_first_years),
+        -1,
     )
 
-    return combined_seasons_df_final
+    # Attach baseline columns by position, with missing values where there is no baseline.
+    # Columns already present get the baseline suffix, as with merge suffixes
+    combined_seasons_df = non_summer_df.reset_index(drop=True)
+    baseline_cols = [col for col in summer_df.columns if col not in group_cols + ["summer_year"]]
+    for suffix, positions in [("_prev_summr", prev_positions), ("_first_summr", first_positions)]:
+        names = [f"{col}{suffix}" if col in combined_seasons_df.columns else col for col in baseline_cols]
+        for name, col in zip(names, baseline_cols):
+            combined_seasons_df[name] = pd.api.extensions.take(
+                summer_df[col].values, positions, allow_fill=True
+            )
+
+    return combined_seasons_df
 
 def generate_dist_plot(df, var, facet_var, **kwargs):
     
@@ -438,3 +1783,70 @@ def roundmid_any(x, to=6):
     x = np.asarray(x)
     return np.ceil(x / to) * to - (np.floor(to / 2) * (x != 0))
 
+
+
+def roundmid_int(x, to=6, out=None):
+    """
+    Integer-only midpoint rounding, giving the same values as roundmid_any without float
+    temporaries: values are rounded up to a multiple of 'to', then shifted down by half of
+    'to', with zero staying zero. Numpy arrays keep their integer dtype and can be rounded
+    in place. Unsigned values, and values within 'to' of the limits of their dtype, are
+    rounded in a wider signed dtype, which is kept if the rounded values do not fit the input
+    dtype. Arrow arrays are rounded with arrow compute and keep their type and nulls, raising
+    on overflow.
+    Args:
+        x (np.ndarray | pa.Array | pa.ChunkedArray): Integer values to round.
+        to (int): Rounding base, e.g. 6 for midpoint 6 rounding.
+        out (np.ndarray): Optional numpy output array, e.g. x itself to round in place. Not
+            used if the rounded values do not fit its dtype.
+    Returns:
+        np.ndarray | pa.Array | pa.ChunkedArray: Rounded values with the input's integer type,
+            or a wider signed type if they do not fit it.
+    """
+    if isinstance(x, (pa.Array, pa.ChunkedArray)):
+        if not pa.types.is_integer(x.type):
+            raise TypeError(f"roundmid_int needs integer values, got {x.type}")
+        # Arrow integer division truncates towards zero, so positive values with a remainder
+        # are rounded up by adding the rest of 'to' less the half, and the others only have the
+        # half subtracted. No intermediate value is further from zero than the result
+        truncated = pc.multiply(pc.divide(x, pa.scalar(to, x.type)), pa.scalar(to, x.type))
+        remainder = pc.greater(pc.subtract(x, truncated), pa.scalar(0, x.type))
+        zero = pa.scalar(0, x.type)
+        rounded = pc.add_checked(truncated, pc.if_else(remainder, pa.scalar(to - to // 2, x.type), zero))
+        half = pc.if_else(pc.or_(remainder, pc.equal(x, 0)), zero, pa.scalar(to // 2, x.type))
+        return pc.subtract_checked(rounded, half)
+
+    x = np.asarray(x)
+    if x.dtype.kind not in "iu":
+        raise TypeError(f"roundmid_int needs integer values, got {x.dtype}")
+
+    info = np.iinfo(x.dtype)
+    if x.size > 0 and (x.dtype.kind == "u" or x.max() > info.max - to or x.min() < info.min + to):
+        # Unsigned values cannot be negated and values near the limits of their dtype would
+        # overflow, so round in the smallest signed dtype that holds the rounded values
+        max_value, min_value = int(x.max()), int(x.min())
+        wide = next(
+            (
+                dtype
+                for dtype in [np.int16, np.int32, np.int64]
+                if np.iinfo(dtype).max - to >= max_value and np.iinfo(dtype).min + to <= min_value
+            ),
+            None,
+        )
+        if wide is None:
+            raise OverflowError(f"roundmid_int cannot round values from {min_value} to {max_value}")
+        rounded = roundmid_int(x.astype(wide), to=to)
+        if rounded.size > 0 and (rounded.max() > info.max or rounded.min() < info.min):
+            return rounded
+        if out is None:
+            return rounded.astype(x.dtype)
+        np.copyto(out, rounded, casting="unsafe")
+        return out
+
+    # Ceiling division as negated floor division of the negated values
+    nonzero = x != 0
+    out = np.negative(x, out=out)
+    np.floor_divide(out, to, out=out)
+    np.multiply(out, -to, out=out)
+    np.subtract(out, to // 2, out=out, where=nonzero)
+    return out